@@ -0,0 +1,186 @@
+"""
+Writing the processed terms, problems and HPOScorer results as Parquet (or Arrow) with proper list columns,
+so whatever reads them next gets lists of term IDs straight away instead of splitting "; " strings again
+Needs pyarrow (pip install pyarrow), HPOFunc and HPOPipeline work fine without it
+
+For each processed column there's:
+<column>_TermIds: list<int32> of the integer term IDs (717 for HP:0000717)
+<column>_TermList: list of "HP:0000717 | Autism" labels, dictionary encoded so each label is only stored once
+<column>_Problems: list of "Error: ..." (and "Fuzzy: ..." term matcher) strings, also dictionary encoded
+"""
+import os
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import HPOFunc
+import HPOPipeline
+
+def _offsets(rows: list) -> pa.Array:
+    # Where each row's list starts and ends in the flattened values
+    return pa.array(np.concatenate([[0], np.cumsum([len(row) for row in rows])]).astype(np.int32))
+
+def _dictionary_lists(rows: list, values: np.ndarray, labels: list[str]) -> pa.ListArray:
+    # rows of values, stored as positions in labels (which has one label for each of the sorted unique values)
+    flat = np.concatenate(rows) if rows else np.array([], dtype=values.dtype)
+    indices = np.searchsorted(values, flat).astype(np.int32)
+    dictionary = pa.DictionaryArray.from_arrays(pa.array(indices), pa.array(labels, type=pa.string()))
+    return pa.ListArray.from_arrays(_offsets(rows), dictionary)
+
+def term_id_lists(rows) -> pa.ListArray:
+    """
+    Turns rows of integer term IDs (like process_series_ids gives) into a list<int32> array
+    """
+    rows = [np.asarray(row, dtype=np.int32) for row in rows]
+    flat = np.concatenate(rows) if rows else np.array([], dtype=np.int32)
+    return pa.ListArray.from_arrays(_offsets(rows), pa.array(flat, type=pa.int32()))
+
+def term_label_lists(rows) -> pa.ListArray:
+    """
+    Turns rows of integer term IDs into lists of dictionary encoded "HP:0000717 | Autism" labels
+    Each term is only looked up in the ontology once however many rows it's in
+    """
+    rows = [np.asarray(row, dtype=np.int32) for row in rows]
+    ids = np.unique(np.concatenate(rows)) if rows else np.array([], dtype=np.int32)
+    ontology = HPOFunc.get_ontology() if len(ids) else None
+    return _dictionary_lists(rows, ids, [str(ontology[int(term_id)]) for term_id in ids])
+
+def string_lists(rows) -> pa.ListArray:
+    """
+    Turns rows of lists of strings (e.g. problems or HPO codes) into lists of dictionary encoded strings
+    """
+    rows = [np.array(row, dtype=object) for row in rows]
+    values = np.unique(np.concatenate(rows)) if any(len(row) for row in rows) else np.array([], dtype=object)
+    return _dictionary_lists([row.astype(str) for row in rows], values.astype(str), values.tolist())
+
+def process_chunk_table(chunk: pd.DataFrame, columns: list[str], store: HPOPipeline.HPOResultStore = None) -> pa.Table:
+    """
+    process_chunk, but returning an Arrow table with <column>_TermIds, <column>_TermList and <column>_Problems
+    list columns for each of the given columns (the rest of the chunk's columns are kept as strings)
+    With a HPOResultStore, only cells that haven't been processed before are (see incremental_process_series)
+    """
+    table = {name: pa.array(chunk[name].astype(object).where(chunk[name].notna(), None).tolist(), type=pa.string())
+             for name in chunk.columns}
+    for column in columns:
+        if store is None:
+            TermIds, Problems = HPOFunc.process_series_ids(chunk[column])
+        else:
+            TermList, Problems = HPOPipeline.incremental_process_series(chunk[column], store)
+            TermIds = TermList.map(HPOFunc.parse_term_ids)
+        table[column + "_TermIds"] = term_id_lists(TermIds)
+        table[column + "_TermList"] = term_label_lists(TermIds)
+        table[column + "_Problems"] = string_lists(Problems.map(HPOPipeline.split_problems))
+    return pa.table(table)
+
+def scores_table(scores: pd.DataFrame, term_ids: bool = False) -> pa.Table:
+    """
+    Turns the output of score_cohort (or score_cohort_ids, with term_ids=True) into an Arrow table, with the quantity and
+    quality scores as int32 and the codes as lists (of dictionary encoded codes, or int32 for score_cohort_ids)
+    The list type comes from term_ids rather than the codes, so a chunk with no codes at all gets the same schema as the rest
+    The index is kept as a string column called Row
+    """
+    table = {"Row": pa.array([str(row) for row in scores.index], type=pa.string())}
+    for column in HPOFunc.SCORE_COLUMNS:
+        if column.endswith("_Codes"):
+            rows = list(scores[column])
+            table[column] = term_id_lists(rows) if term_ids else string_lists(rows)
+        else:
+            table[column] = pa.array(scores[column].to_numpy(dtype=np.int32))
+    return pa.table(table)
+
+def _file_format(path: str) -> str:
+    return "arrow" if path.lower().endswith(".arrow") else "parquet"
+
+class TableWriter:
+    """
+    Writes Arrow tables one after another to a single file, as Parquet (compressed, with zstd by default)
+    or as an uncompressed Arrow stream that read_table can memory map without copying
+    file_format is "parquet" or "arrow", by default it's "arrow" if the path ends in .arrow and "parquet" otherwise
+    Use it as a context manager, or call close() when done
+    """
+
+    def __init__(self, path: str, schema: pa.Schema, compression: str = "zstd", file_format: str = None):
+        self.path = path
+        if file_format is None:
+            file_format = _file_format(path)
+        if file_format not in ("parquet", "arrow"):
+            raise ValueError("file_format must be 'parquet' or 'arrow'")
+        if file_format == "arrow":
+            self._file = pa.OSFile(path, "wb")
+            self._writer = pa.ipc.new_stream(self._file, schema)
+        else:
+            self._file = None
+            self._writer = pq.ParquetWriter(path, schema, compression=compression, use_dictionary=True)
+
+    def write(self, table: pa.Table) -> None:
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        self._writer.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self) -> "TableWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def stream_process_file_table(input_path: str, output_path: str, columns: list[str], chunksize: int = 10000,
+                              sheet_name=0, store: HPOPipeline.HPOResultStore = None, compression: str = "zstd") -> Iterator[int]:
+    """
+    stream_process_file, but writing a Parquet (or .arrow) file with list columns (see process_chunk_table),
+    one row group per chunk, yielding the number of rows done after each chunk
+    It's written to <output_path>.tmp and only moved to output_path once every chunk is done,
+    so there's never half a file there (unlike the CSV version it doesn't carry on after a crash)
+    """
+    temp_path = output_path + ".tmp"
+    rows_done = 0
+    writer = None
+    try:
+        for chunk in HPOPipeline.read_in_chunks(input_path, chunksize, sheet_name):
+            table = process_chunk_table(chunk, columns, store)
+            if writer is None:
+                writer = TableWriter(temp_path, table.schema, compression, _file_format(output_path))
+            writer.write(table)
+            rows_done += len(chunk)
+            yield rows_done
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(temp_path, output_path)
+
+def process_file_table(input_path: str, output_path: str, columns: list[str], chunksize: int = 10000,
+                       sheet_name=0, store: HPOPipeline.HPOResultStore = None, compression: str = "zstd") -> int:
+    """
+    Runs stream_process_file_table all the way through and returns the number of rows processed
+    """
+    rows_done = 0
+    for rows_done in stream_process_file_table(input_path, output_path, columns, chunksize, sheet_name, store, compression):
+        pass
+    return rows_done
+
+def write_scores(scores: pd.DataFrame, path: str, compression: str = "zstd", term_ids: bool = False) -> None:
+    """
+    Writes the output of score_cohort (or score_cohort_ids, with term_ids=True) to a Parquet (or .arrow) file, see scores_table
+    """
+    table = scores_table(scores, term_ids)
+    with TableWriter(path, table.schema, compression) as writer:
+        writer.write(table)
+
+def read_table(path: str, columns: list[str] = None) -> pa.Table:
+    """
+    Reads a file written by process_file_table or write_scores, memory mapped rather than read into memory
+    .arrow files don't need decoding so their columns point straight at the mapped file (zero-copy),
+    Parquet files still have to be decompressed
+    table.to_pandas() gives a dataframe with the list columns as arrays
+    """
+    if _file_format(path) == "arrow":
+        # The table keeps the mapping open for as long as it's around
+        table = pa.ipc.open_stream(pa.memory_map(path)).read_all()
+        return table.select(columns) if columns is not None else table
+    return pq.read_table(path, columns=columns, memory_map=True)
@@ -0,0 +1,303 @@
+"""
+Benchmarks for the HPO processing in HPOFunc.py
+Run it with: python HPOBench.py --rows 10000 --seed 0 --output bench_output.json
+(or python HPOBench.py --micro for just the HPOSorter micro-benchmark)
+"""
+import argparse
+import json
+import platform
+import random
+import re
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import HPOFunc
+
+# A few cells that look like the ones in the referral exports
+EXAMPLE_CELLS = ["HP:0001250 Seizure, HP:0000717 Autism, Global developmental delay",
+                 "hp:0001263",
+                 "Hypotonia, Nystagmus,  feeding difficulties",
+                 "HP:0500093 Food allergy Nystagmus HP:0000639",
+                 "Delayed speech",
+                 "None"]
+
+# Bits of free text that come up in the exports but aren't anything in the HPO
+JUNK_PHRASES = ["Pizza", "see letter", "awaiting review", "?", "not sure", "query syndrome"]
+
+# The different ways people write the HP prefix
+ID_PREFIXES = ["HP:", "hp:", "Hp:", "hP:", "HP", ""]
+
+def legacy_HPOSorter(strg: str) -> tuple[list[str], list[str]]:
+    """
+    HPOSorter the way it used to be, with a chain of re.subs, kept so there's something to compare against
+    The chain of re.subs is HPOFunc._strip_hp_chained, the same one HPOSorter falls back on for odd strings
+    """
+    strg = HPOFunc.check_and_set_nan(strg, HPOFunc.NullList)
+    numeric_values = re.findall(r'\d{2,}', strg)
+    strg = HPOFunc._strip_hp_chained(strg)
+    non_numeric_values = re.split(r',|  ', strg)
+    non_numeric_values = [value for value in non_numeric_values if re.search('[a-zA-Z]', value)]
+    non_numeric_values = [r.lstrip() for r in non_numeric_values]
+    non_numeric_values = [HPOFunc.drop_leading_hp(r) for r in non_numeric_values]
+    return numeric_values, non_numeric_values
+
+def benchmark_HPOSorter(cells: list[str] = EXAMPLE_CELLS, number: int = 10000) -> dict:
+    """
+    Times the old and new HPOSorter over the same cells
+    Checks they give the same answers first, then returns the time per cell (in microseconds) for both and the speedup
+    """
+    for cell in cells:
+        assert HPOFunc.HPOSorter(cell) == legacy_HPOSorter(cell), "HPOSorter and legacy_HPOSorter disagree on: " + cell
+
+    legacy = timeit.timeit(lambda: [legacy_HPOSorter(cell) for cell in cells], number=number)
+    current = timeit.timeit(lambda: [HPOFunc.HPOSorter(cell) for cell in cells], number=number)
+    calls = number * len(cells)
+
+    return {"legacy_us_per_cell": legacy / calls * 1e6,
+            "HPOSorter_us_per_cell": current / calls * 1e6,
+            "speedup": legacy / current}
+
+def _vocabulary(seed: int, size: int) -> list:
+    # Same seed, same terms, as long as it's the same HPO release
+    terms = sorted((term for term in HPOFunc.get_ontology() if not term.is_obsolete), key=int)
+    return random.Random(seed).sample(terms, size)
+
+def _misspell(rng: random.Random, strg: str) -> str:
+    # One random typo: a letter dropped, doubled or swapped with the next one
+    if len(strg) < 4:
+        return strg
+    i = rng.randrange(1, len(strg) - 2)
+    typo = rng.choice(["drop", "double", "swap"])
+    if typo == "drop":
+        return strg[:i] + strg[i + 1:]
+    if typo == "double":
+        return strg[:i] + strg[i] + strg[i:]
+    return strg[:i] + strg[i + 1] + strg[i] + strg[i + 2:]
+
+def _mention(rng: random.Random, term) -> str:
+    # One way of writing a term down, roughly in proportion to how often each turns up
+    kind = rng.choices(["id", "id_and_name", "name", "synonym", "misspelt", "junk"], weights=[30, 15, 25, 5, 15, 10])[0]
+    code = term.id[3:]
+    if kind == "id":
+        return rng.choice(ID_PREFIXES) + code
+    if kind == "id_and_name":
+        return rng.choice(ID_PREFIXES) + code + " " + term.name
+    if kind == "synonym" and term.synonym:
+        return rng.choice(term.synonym)
+    if kind == "misspelt":
+        return _misspell(rng, term.name)
+    if kind == "junk":
+        return rng.choice(JUNK_PHRASES)
+    name = term.name
+    return rng.choice([name, name.lower(), name.upper()])
+
+def generate_synthetic_cells(n_rows: int, seed: int = 0, vocabulary_size: int = 500) -> pd.Series:
+    """
+    Makes a column of made up referral cells for benchmarking, always the same for the same seed
+    Cells are a mix of HPO IDs (with every case of "HP:" and none), names, synonyms, misspellings and junk,
+    plus empty cells and phrases from NullList
+    Terms come from a vocabulary of vocabulary_size terms with a few very common and lots of rare ones,
+    like in the real exports
+    """
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(seed, vocabulary_size)
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+    cells = []
+    for _ in range(n_rows):
+        kind = rng.choices(["empty", "null", "terms"], weights=[10, 5, 85])[0]
+        if kind == "empty":
+            cells.append(pd.NA)
+        elif kind == "null":
+            phrase = rng.choice(HPOFunc.NullList)
+            cells.append(rng.choice([phrase, phrase.capitalize(), phrase.upper()]))
+        else:
+            terms = rng.choices(vocabulary, weights=weights, k=rng.randint(1, 5))
+            separator = rng.choice([", ", ",", "  "])
+            cells.append(separator.join(_mention(rng, term) for term in terms))
+    return pd.Series(cells, dtype=object, name="Synthetic")
+
+def generate_synthetic_pairs(n_rows: int, seed: int = 0, vocabulary_size: int = 500) -> pd.DataFrame:
+    """
+    Makes doctor/parent TermList columns (like process_column gives) for benchmarking HPOScorer
+    The parent often picks a parent or child of one of the doctor's terms, so there's something to score
+    """
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(seed, vocabulary_size)
+    doctor = []
+    parent = []
+    for _ in range(n_rows):
+        doctor_terms = set(rng.sample(vocabulary, rng.randint(1, 5)))
+        parent_terms = set()
+        for term in doctor_terms:
+            related = sorted(term.parents | term.children, key=int)
+            if related and rng.random() < 0.5:
+                parent_terms.add(rng.choice(related))
+        parent_terms |= set(rng.sample(vocabulary, rng.randint(0, 2)))
+        doctor.append(HPOFunc.list_to_csv(sorted(map(str, doctor_terms))) if rng.random() > 0.05 else pd.NA)
+        parent.append(HPOFunc.list_to_csv(sorted(map(str, parent_terms))) if parent_terms else pd.NA)
+    return pd.DataFrame({"Doctor": doctor, "Parent": parent})
+
+def _stage_result(latencies: list[float], total: float, rows: int) -> dict:
+    result = {"rows": rows, "total_s": total, "rows_per_s": rows / total if total else float("inf")}
+    if latencies:
+        latencies_us = np.array(latencies) * 1e6
+        for percentile in [50, 95, 99]:
+            result[f"p{percentile}_us"] = float(np.percentile(latencies_us, percentile))
+        result["max_us"] = float(latencies_us.max())
+    return result
+
+def _peak_memory_mb(run) -> float:
+    # Separate run with tracemalloc on, since it slows everything down too much to time at the same time
+    reset_caches()
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+def reset_caches() -> None:
+    """
+    Empties the caches in HPOFunc, so every stage starts from cold and runs can be compared
+    """
+    HPOFunc.resolution_cache.clear()
+    HPOFunc.default_path_index = HPOFunc.HPOPathIndex()
+
+def _time_per_call(function, inputs: list) -> tuple[list, list[float], float]:
+    outputs = []
+    latencies = []
+    start = time.perf_counter()
+    for args in inputs:
+        call_start = time.perf_counter()
+        outputs.append(function(*args))
+        latencies.append(time.perf_counter() - call_start)
+    return outputs, latencies, time.perf_counter() - start
+
+def run_benchmarks(n_rows: int = 10000, seed: int = 0, memory: bool = True, workers: int = 2) -> dict:
+    """
+    Runs each stage of the pipeline over the same synthetic data and returns, for each stage, the rows per second,
+    the per-call latency percentiles (for the stages that go a row at a time) and, if memory is True,
+    the peak memory it allocated
+    Caches are emptied before each stage, and the workload only depends on the seed and the HPO release
+    (both recorded in the results) so runs with the same settings can be compared
+    """
+    start = time.perf_counter()
+    HPOFunc.preload()
+    ontology_load_s = time.perf_counter() - start
+
+    cells = generate_synthetic_cells(n_rows, seed)
+    pairs = generate_synthetic_pairs(n_rows, seed)
+    stages = {}
+
+    reset_caches()
+    sorted_cells, latencies, total = _time_per_call(HPOFunc.HPOSorter, [(cell,) for cell in cells])
+    stages["HPOSorter"] = _stage_result(latencies, total, n_rows)
+
+    reset_caches()
+    outputs, latencies, total = _time_per_call(HPOFunc.HPOOutPutter, sorted_cells)
+    stages["HPOOutPutter"] = _stage_result(latencies, total, n_rows)
+
+    _, latencies, total = _time_per_call(HPOFunc.HPOSquisher, [(terms1, terms2) for terms1, terms2, _ in outputs])
+    stages["HPOSquisher"] = _stage_result(latencies, total, n_rows)
+
+    reset_caches()
+    _, latencies, total = _time_per_call(HPOFunc.process_column, [(cell,) for cell in cells])
+    stages["process_column"] = _stage_result(latencies, total, n_rows)
+
+    reset_caches()
+    start = time.perf_counter()
+    HPOFunc.process_series(cells)
+    stages["process_series"] = _stage_result([], time.perf_counter() - start, n_rows)
+
+    reset_caches()
+    start = time.perf_counter()
+    HPOFunc.process_series_ids(cells)
+    stages["process_series_ids"] = _stage_result([], time.perf_counter() - start, n_rows)
+
+    reset_caches()
+    _, latencies, total = _time_per_call(HPOFunc.HPOScorer, list(zip(pairs["Doctor"], pairs["Parent"])))
+    stages["HPOScorer"] = _stage_result(latencies, total, n_rows)
+
+    reset_caches()
+    start = time.perf_counter()
+    HPOFunc.score_cohort(pairs, "Doctor", "Parent", workers=workers)
+    stages["score_cohort"] = _stage_result([], time.perf_counter() - start, n_rows)
+    stages["score_cohort"]["workers"] = workers
+
+    id_pairs = pairs.map(HPOFunc.parse_term_ids)
+    reset_caches()
+    start = time.perf_counter()
+    HPOFunc.score_cohort_ids(id_pairs, "Doctor", "Parent", workers=workers)
+    stages["score_cohort_ids"] = _stage_result([], time.perf_counter() - start, n_rows)
+    stages["score_cohort_ids"]["workers"] = workers
+
+    if memory:
+        stages["HPOSorter"]["peak_memory_mb"] = _peak_memory_mb(lambda: [HPOFunc.HPOSorter(cell) for cell in cells])
+        stages["HPOOutPutter"]["peak_memory_mb"] = _peak_memory_mb(lambda: [HPOFunc.HPOOutPutter(*sorted_cell) for sorted_cell in sorted_cells])
+        stages["HPOSquisher"]["peak_memory_mb"] = _peak_memory_mb(lambda: [HPOFunc.HPOSquisher(terms1, terms2) for terms1, terms2, _ in outputs])
+        stages["process_column"]["peak_memory_mb"] = _peak_memory_mb(lambda: [HPOFunc.process_column(cell) for cell in cells])
+        stages["process_series"]["peak_memory_mb"] = _peak_memory_mb(lambda: HPOFunc.process_series(cells))
+        stages["process_series_ids"]["peak_memory_mb"] = _peak_memory_mb(lambda: HPOFunc.process_series_ids(cells))
+        stages["HPOScorer"]["peak_memory_mb"] = _peak_memory_mb(lambda: [HPOFunc.HPOScorer(doc, par) for doc, par in zip(pairs["Doctor"], pairs["Parent"])])
+    reset_caches()
+
+    metadata = {"rows": n_rows, "seed": seed, "hpo_version": HPOFunc.ontology_version(),
+                "python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                "machine": platform.machine(), "ontology_load_s": ontology_load_s,
+                "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+    return {"metadata": metadata, "stages": stages}
+
+def compare_results(old: dict, new: dict) -> pd.DataFrame:
+    """
+    Puts two sets of run_benchmarks results side by side, with how many times faster (rows per second)
+    the new one is for each stage
+    Warns if they weren't run on the same workload, since then the numbers don't mean much
+    """
+    for setting in ["rows", "seed", "hpo_version"]:
+        if old["metadata"].get(setting) != new["metadata"].get(setting):
+            print(f"Warning: {setting} is different ({old['metadata'].get(setting)} vs {new['metadata'].get(setting)})")
+    rows = []
+    for stage, result in new["stages"].items():
+        before = old["stages"].get(stage, {})
+        rows.append({"stage": stage, "old_rows_per_s": before.get("rows_per_s"), "new_rows_per_s": result["rows_per_s"],
+                     "speedup": result["rows_per_s"] / before["rows_per_s"] if before.get("rows_per_s") else None})
+    return pd.DataFrame(rows).set_index("stage")
+
+def format_results(results: dict) -> str:
+    """
+    Turns run_benchmarks results into a table for printing
+    """
+    table = pd.DataFrame(results["stages"]).T
+    metadata = ", ".join(f"{key}={value}" for key, value in results["metadata"].items())
+    return metadata + "\n" + table.to_string(float_format=lambda value: f"{value:.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the HPO pipeline")
+    parser.add_argument("--rows", type=int, default=10000, help="How many synthetic rows to make")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data, keep it the same to compare runs")
+    parser.add_argument("--workers", type=int, default=2, help="Workers for the score_cohort stage")
+    parser.add_argument("--no-memory", action="store_true", help="Skip measuring peak memory (it means running everything twice)")
+    parser.add_argument("--output", help="Save the results here as JSON")
+    parser.add_argument("--compare", help="JSON results from an earlier run to compare against")
+    parser.add_argument("--micro", action="store_true", help="Just run the HPOSorter micro-benchmark")
+    parser.add_argument("--number", type=int, default=10000, help="Repeats for the micro-benchmark")
+    args = parser.parse_args()
+
+    if args.micro:
+        result = benchmark_HPOSorter(number=args.number)
+        print(f"legacy HPOSorter: {result['legacy_us_per_cell']:.2f} us per cell")
+        print(f"HPOSorter:        {result['HPOSorter_us_per_cell']:.2f} us per cell")
+        print(f"speedup:          {result['speedup']:.2f}x")
+    else:
+        results = run_benchmarks(args.rows, args.seed, memory=not args.no_memory, workers=args.workers)
+        print(format_results(results))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                print(compare_results(json.load(f), results).to_string(float_format=lambda value: f"{value:.2f}"))
@@ -1,14 +1,207 @@
 import pandas as pd
 import re
-from pyhpo.ontology import Ontology
 import numpy as np
 import itertools
 import math
+import os
+import sqlite3
+import threading
+import atexit
+import functools
+import importlib.util
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 
-ontology=Ontology()
+# The ontology takes a long time to load, so it only gets loaded the first time something needs it
+# (use get_ontology() rather than touching _ontology directly, or preload() to load it on purpose)
+_ontology = None
+_ontology_lock = threading.Lock()
+
+def get_ontology():
+    """
+    Returns the pyhpo Ontology, loading it first if nothing has needed it yet
+    If the HPO_SNAPSHOT environment variable is set, it's a HPOSnapshot memory mapped from that folder instead,
+    which is a lot quicker for worker processes to start up with (it has to be from the same HPO release as pyhpo's,
+    since that's what ontology_version() reports and everything cached is stored against, otherwise it raises a RuntimeError)
+    Safe to call from several threads at once, it still only gets loaded once
+    """
+    global _ontology
+    if _ontology is None:
+        with _ontology_lock:
+            if _ontology is None:
+                if os.environ.get("HPO_SNAPSHOT"):
+                    import HPOSnapshot
+                    snapshot = HPOSnapshot.HPOSnapshot.load(os.environ["HPO_SNAPSHOT"])
+                    if snapshot.version != ontology_version():
+                        raise RuntimeError(f"HPO_SNAPSHOT {os.environ['HPO_SNAPSHOT']} is from {snapshot.version} but pyhpo has "
+                                           f"{ontology_version()}, rebuild it with: python HPOSnapshot.py {os.environ['HPO_SNAPSHOT']}")
+                    _ontology = snapshot
+                else:
+                    from pyhpo.ontology import Ontology
+                    _ontology = Ontology()
+    return _ontology
+
+def use_ontology(ontology) -> None:
+    """
+    Makes everything use the given ontology, usually a HPOSnapshot (anything with get_hpo_object,
+    indexing by integer ID and iteration that gives terms like pyhpo's), or goes back to loading pyhpo's with None
+    Clears resolution_cache and default_path_index, since they hold terms from the old one
+    """
+    global _ontology, _name_index, default_path_index
+    with _ontology_lock:
+        _ontology = ontology
+        _name_index = None
+    resolution_cache.clear()
+    default_path_index = HPOPathIndex()
+
+def preload():
+    """
+    Loads the ontology now rather than waiting for the first lookup to do it
+    Handy for servers that want to warm up before they start taking requests
+    """
+    return get_ontology()
+
+def __getattr__(name):
+    # Anything still using HPOFunc.ontology gets the lazily loaded one
+    if name == "ontology":
+        return get_ontology()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# The StageProfiler that's currently collecting, None the rest of the time so the stages don't pay for it
+_profiler = None
+
+class StageProfiler:
+    """
+    Collects timings for the stages of the processing (HPOSorter, HPOOutPutter, HPOSquisher, HPOScorer,
+    and process_column/process_series around them) while it's turned on, e.g.
+        with HPOFunc.StageProfiler() as profiler:
+            df["TermList"], df["Problems"] = HPOFunc.process_series(df["HPO"])
+        profiler.to_json("profile.json")
+    For each stage it records the number of calls, the total time and latency percentiles,
+    and how often the caches it used (resolution_cache, HPOPathIndex) already had the answer
+    Times are inclusive, so process_column's time includes the HPOSorter etc. it called
+    Cache lookups count towards whichever stage was running most recently when they happened
+    callbacks are called with (stage, seconds) after every call, if you want to send them somewhere else
+    Only counts what runs in this process, so not the workers of score_cohort with workers > 1
+    """
+
+    def __init__(self, callbacks=()):
+        self.callbacks = list(callbacks)
+        self._latencies = {}  # stage -> seconds for every call
+        self._cache = {}  # stage -> [hits, misses]
+        self._lock = threading.Lock()
+        self._local = threading.local()  # each thread has its own stack of stages that are running
+
+    def __enter__(self) -> "StageProfiler":
+        global _profiler
+        if _profiler is not None:
+            raise RuntimeError("There's already a StageProfiler running")
+        _profiler = self
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _profiler
+        _profiler = None
+
+    def _stack(self) -> list[str]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def run(self, stage: str, function, args: tuple, kwargs: dict):
+        """
+        Runs function(*args, **kwargs), recording how long it took under stage
+        """
+        stack = self._stack()
+        stack.append(stage)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            self.record(stage, seconds)
+
+    def record(self, stage: str, seconds: float) -> None:
+        """
+        Adds one call of stage that took seconds
+        """
+        with self._lock:
+            self._latencies.setdefault(stage, []).append(seconds)
+        for callback in self.callbacks:
+            callback(stage, seconds)
+
+    def record_cache(self, hit: bool) -> None:
+        """
+        Counts a cache lookup (hit or miss) towards the stage that's running
+        """
+        stack = self._stack()
+        stage = stack[-1] if stack else "other"
+        with self._lock:
+            counts = self._cache.setdefault(stage, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def reset(self) -> None:
+        """
+        Throws away everything recorded so far
+        """
+        with self._lock:
+            self._latencies.clear()
+            self._cache.clear()
+
+    def summary(self) -> dict:
+        """
+        Returns a dictionary of stage -> calls, total_s, mean_us, p50/p95/p99/max_us and,
+        for stages that used a cache, cache_hits, cache_misses and cache_hit_rate
+        """
+        with self._lock:
+            latencies = {stage: list(seconds) for stage, seconds in self._latencies.items()}
+            cache = {stage: list(counts) for stage, counts in self._cache.items()}
+        report = {}
+        for stage in sorted(set(latencies) | set(cache)):
+            result = {"calls": 0, "total_s": 0.0}
+            if stage in latencies:
+                latencies_us = np.array(latencies[stage]) * 1e6
+                result = {"calls": len(latencies_us), "total_s": float(latencies_us.sum() / 1e6),
+                          "mean_us": float(latencies_us.mean())}
+                for percentile in [50, 95, 99]:
+                    result[f"p{percentile}_us"] = float(np.percentile(latencies_us, percentile))
+                result["max_us"] = float(latencies_us.max())
+            if stage in cache:
+                hits, misses = cache[stage]
+                result.update(cache_hits=hits, cache_misses=misses, cache_hit_rate=hits / (hits + misses))
+            report[stage] = result
+        return report
+
+    def to_json(self, path: str = None) -> str:
+        """
+        Returns the summary as JSON, and saves it to path as well if one is given
+        """
+        report = json.dumps(self.summary(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(report)
+        return report
+
+def _profiled(stage: str):
+    # Decorator for the stages, so they get timed when a StageProfiler is running and are just called when not
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return function(*args, **kwargs)
+            return profiler.run(stage, function, args, kwargs)
+        return wrapper
+    return decorate
 
 NullList=["none", "none documented", "nil", "(borderline)", "no concerns"]
 
+# Order matters here, the versions with colons have to go first
+HP_PREFIXES=['HP:', 'hp:', 'hP:', 'Hp:', 'HP', 'hp', 'hP', 'Hp']
+
 def check_and_set_nan(strg: str, NullList: list = ["none", "none documented", "nil", "(borderline)", "no concerns"])->str:
     """
     Some of the HPO responses are different variations of people saying "no"
@@ -25,10 +218,15 @@ def check_and_set_nan(strg: str, NullList: list = ["none", "none documented", "n
     """
     if pd.isna(strg):
         strg = ""
-    if strg.lower() in [s.lower() for s in NullList]:
+    if strg.lower() in _null_values(tuple(NullList)):
         strg = ""
     return strg
 
+@functools.lru_cache(maxsize=16)
+def _null_values(NullList: tuple) -> frozenset:
+    # Lowercased once per NullList rather than on every call
+    return frozenset(s.lower() for s in NullList)
+
 def drop_leading_hp(strg: str)->str:
     """
     Takes in a string, ideally a HPO term, and removes the leading HP or hp from it
@@ -36,6 +234,61 @@ def drop_leading_hp(strg: str)->str:
     return strg[2:] if strg.startswith('HP') else strg
 
 
+# HPOSorter used to do a dozen or so re.sub passes over every cell, now it's one scan using these
+# A "run" is a stretch of digits, HPs (any case, with or without a colon) and colons, which all come out of the free text
+_HP_RUN_RE = re.compile(r'((?:\d|[Hh][Pp]:?|:)+)')
+_NUMERIC_RE = re.compile(r'\d{2,}')
+_NON_DIGIT_RE = re.compile(r'\D')
+_LEFTOVER_HP_RE = re.compile(r'[Hh][Pp]')
+_SPLIT_RE = re.compile(r',|  ')
+_LETTER_RE = re.compile(r'[a-zA-Z]')
+_HPO_CODE_RE = re.compile(r'HP:\d{7}')
+
+def _cut_run(run: str) -> str:
+    # The whole run goes, unless once the HPs and colons are out all that's left is a single digit
+    # (that's what the old chain of re.subs ended up doing)
+    digits = _NON_DIGIT_RE.sub('', run)
+    return digits if len(digits) == 1 else ''
+
+def _strip_hp_chained(strg: str) -> str:
+    """
+    The old way of cleaning the free text, one re.sub after another
+    Only needed for odd strings where taking something out leaves another HP behind, e.g. "hHP:p"
+    """
+    for prefix in HP_PREFIXES:
+        strg = re.sub(prefix, '', strg)
+    strg = re.sub(r':', '', strg)
+    strg = re.sub(r'\d{2,}', '', strg)
+    return strg
+
+def tokenize_hpo_cell(strg: str) -> tuple[list[str], list[str]]:
+    """
+    Splits a cleaned up cell into its numeric HPO IDs and free text fragments in one scan
+    Gives exactly the same as the old chain of re.subs in HPOSorter, just a lot quicker
+    Returns two lists, one of numeric values and one of non_numeric values
+    """
+    parts = _HP_RUN_RE.split(strg)
+    numeric_values = []
+    # Every other part is a run, with the free text in between
+    for i in range(1, len(parts), 2):
+        ids = _NUMERIC_RE.findall(parts[i])
+        if ids:
+            numeric_values.extend(ids)
+            parts[i] = ''
+        else:
+            parts[i] = _cut_run(parts[i])
+    text = ''.join(parts)
+
+    if _LEFTOVER_HP_RE.search(text):
+        # Taking things out has stuck an HP back together, fall back to the old way for this one
+        text = _strip_hp_chained(strg)
+        non_numeric_values = [drop_leading_hp(value.lstrip()) for value in _SPLIT_RE.split(text) if _LETTER_RE.search(value)]
+    else:
+        non_numeric_values = [value.lstrip() for value in _SPLIT_RE.split(text) if _LETTER_RE.search(value)]
+
+    return numeric_values, non_numeric_values
+
+@_profiled("HPOSorter")
 def HPOSorter(strg: str) -> tuple[list[str], list[str]]:
     """
     Takes a string from a single cell from the HPOData dataframe
@@ -46,36 +299,332 @@ def HPOSorter(strg: str) -> tuple[list[str], list[str]]:
     """
 
     strg=check_and_set_nan(strg, NullList)
+    if cleanup_rules is not None and cleanup_rules.is_null(strg):
+        strg = ""
 
     if pd.isna(strg): 
         non_numeric_values=[]
         numeric_values=[]
     else:
-        numeric_values = re.findall(r'\d{2,}', strg)
         # I want free text to have a leading capital preserved, but I want to remove any leading HP: or hp:
         # different entries have upper or lower case combinations of HP, so I'm going to remove all of them
+        # (and split one thing into the entire list while we're at it)
+        numeric_values, non_numeric_values = tokenize_hpo_cell(strg)
+        if cleanup_rules is not None:
+            numeric_values, non_numeric_values = cleanup_rules.apply(numeric_values, non_numeric_values)
+    
+    return numeric_values, non_numeric_values
 
-        strg = re.sub(r'HP:', '', strg)
-        strg = re.sub(r'hp:', '', strg)
-        strg = re.sub(r'hP:', '', strg)
-        strg = re.sub(r'Hp:', '', strg)
-        strg = re.sub(r'HP', '', strg)
-        strg = re.sub(r'hp', '', strg)
-        strg = re.sub(r'hP', '', strg)
-        strg = re.sub(r'Hp', '', strg)
+# Off unless use_cleanup_rules is called
+cleanup_rules = None
 
-        strg = re.sub(r':', '', strg)
+def use_cleanup_rules(rules) -> None:
+    """
+    Turns on site-specific cleanup rules (null phrases, abbreviations and synonyms) for HPOSorter and process_series,
+    usually a HPORules.HPOCleanupRules loaded from a JSON file, or turns them off again with None
+    The rules are applied before anything is looked up, so resolution_cache doesn't need clearing,
+    but HPOResultStores opened afterwards keep their results apart from ones made without the rules
+    """
+    global cleanup_rules
+    cleanup_rules = rules
 
+class HPOResolutionCache:
+    """
+    Remembers what get_hpo_or_error came up with for each (normalised string, Process_Type)
+    so that the same free text or code doesn't have to go to the ontology again
+    Failures ("Error: ..." and "") are remembered too, because they're the slow ones
+    Once there's more than maxsize entries, the least recently used one gets thrown away
+    maxsize=None means it never throws anything away, maxsize=0 turns the cache off
+    Keeps count of hits, misses and evictions so you can see if it's actually helping
+    """
 
-        strg = re.sub(r'\d{2,}', '', strg)
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        # Ingestion workers can share this between threads so don't let them trample each other
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple[str, str], default=None):
+        """
+        Returns the cached result for key, or default if it isn't in there
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if _profiler is not None:
+                    _profiler.record_cache(True)
+                return self._entries[key]
+            self.misses += 1
+            if _profiler is not None:
+                _profiler.record_cache(False)
+            return default
+
+    def put(self, key: tuple[str, str], value) -> None:
+        """
+        Adds a result to the cache, throwing out the least recently used ones if it's full
+        """
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def resize(self, maxsize: int) -> None:
+        """
+        Changes the maximum size, evicting straight away if it's now too big
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self) -> None:
+        """
+        Empties the cache and resets the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss/eviction counters and the current size as a dictionary
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "size": len(self._entries), "maxsize": self.maxsize}
+
+    def _evict(self) -> None:
+        if self.maxsize is None:
+            return
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
-        # Once that's been handled, split one thing into the entire list
-        non_numeric_values=re.split(r',|  ', strg)
-        non_numeric_values=[value for value in non_numeric_values if re.search('[a-zA-Z]', value)]
-        non_numeric_values=[r.lstrip() for r in non_numeric_values]
-        non_numeric_values=[drop_leading_hp(r) for r in non_numeric_values]
-    
-    return numeric_values, non_numeric_values
+
+resolution_cache = HPOResolutionCache()
+
+# Used to tell "not in the cache" apart from a cached result
+_NOT_CACHED = object()
+
+def ontology_version() -> str:
+    """
+    Returns the data-version of the HPO release pyhpo ships with (e.g. "hp/releases/2025-01-16")
+    Read straight from the top of hp.obo, so it doesn't need the ontology to be loaded
+    (or even pyhpo imported, which a worker using HPO_SNAPSHOT doesn't need to do)
+    """
+    pyhpo_folder = importlib.util.find_spec("pyhpo").submodule_search_locations[0]
+    with open(os.path.join(pyhpo_folder, "data", "hp.obo")) as f:
+        for line in f:
+            if line.startswith("data-version:"):
+                return line.split(":", 1)[1].strip()
+            if line.startswith("[Term]"):
+                break
+    return "unknown"
+
+class HPOPersistentCache:
+    """
+    An on-disk version of resolution_cache, kept in a SQLite file so it carries over between runs
+    Maps (normalised string, Process_Type) to the HPO ID it resolved to, or the error text if it didn't
+    Everything is stored against the ontology version, so when the HPO release changes the old results
+    just stop being used, and processes on different releases can share the file without touching each other's
+    results (prune() clears out the ones that aren't for this version)
+    SQLite's WAL mode means lots of worker processes can read it at once, each process opens its own connection
+    New results are written in batches of batch_size, call flush() to write any that are left
+    """
+
+    def __init__(self, path: str, version: str = None, batch_size: int = 500):
+        self.path = path
+        self.version = version if version is not None else ontology_version()
+        self.batch_size = batch_size
+        self._connection = None
+        self._pid = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections can't be shared with forked processes, so each process gets its own
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS resolutions (version TEXT, process_type TEXT, query TEXT, "
+                               "kind TEXT, value TEXT, PRIMARY KEY (version, process_type, query))")
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+            self._pending = []
+        return self._connection
+
+    def get(self, key: tuple[str, str]):
+        """
+        Returns (kind, value) for key, where kind is "term" (value is a HPO ID) or "text" (value is what
+        get_hpo_or_error returned, e.g. "Error: Pizza"), or None if it hasn't been seen before
+        """
+        strg, Process_Type = key
+        with self._lock:
+            return self._connect().execute(
+                "SELECT kind, value FROM resolutions WHERE version = ? AND process_type = ? AND query = ?",
+                (self.version, Process_Type, strg)).fetchone()
+
+    def put(self, key: tuple[str, str], kind: str, value: str) -> None:
+        """
+        Queues up a result to be written, and writes the queue once there's batch_size of them
+        """
+        strg, Process_Type = key
+        with self._lock:
+            self._connect()
+            self._pending.append((self.version, Process_Type, strg, kind, value))
+            if len(self._pending) >= self.batch_size:
+                self._write_pending()
+
+    def flush(self) -> None:
+        """
+        Writes anything still queued up
+        """
+        with self._lock:
+            if self._pending and self._pid == os.getpid():
+                self._write_pending()
+
+    def close(self) -> None:
+        """
+        Writes anything still queued up and closes the connection
+        """
+        self.flush()
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+    def _write_pending(self) -> None:
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?, ?, ?)", self._pending)
+        self._pending = []
+
+    def prune(self) -> int:
+        """
+        Deletes every result that isn't for this version (e.g. once nothing is running on the old HPO release any more)
+        and returns how many were deleted
+        """
+        self.flush()
+        with self._lock:
+            with self._connect() as connection:
+                return connection.execute("DELETE FROM resolutions WHERE version != ?", (self.version,)).rowcount
+
+    def __len__(self) -> int:
+        self.flush()
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM resolutions WHERE version = ?", (self.version,)).fetchone()[0]
+
+
+# Off unless use_persistent_cache is called
+persistent_cache = None
+
+def use_persistent_cache(path: str, **kwargs):
+    """
+    Turns on the on-disk cache for get_hpo_or_error, stored in the SQLite file at path
+    (any extra arguments go to HPOPersistentCache), or turns it off again if path is None
+    Returns the HPOPersistentCache being used
+    """
+    global persistent_cache
+    if persistent_cache is not None:
+        persistent_cache.close()
+    persistent_cache = HPOPersistentCache(path, **kwargs) if path is not None else None
+    return persistent_cache
+
+@atexit.register
+def _flush_persistent_cache() -> None:
+    if persistent_cache is not None:
+        persistent_cache.close()
+
+# Off unless use_term_matcher is called
+term_matcher = None
+
+def use_term_matcher(matcher) -> None:
+    """
+    Gives get_hpo_or_error something to try for free text that doesn't exactly match a HPO name or synonym,
+    usually a HPOMatch.HPOTermMatcher (anything with a match(strg) that returns (HPOTerm, score) or None,
+    a review_score and a cache_tag), or turns it off again with None
+    """
+    global term_matcher
+    term_matcher = matcher
+
+class HPOFuzzyMatch:
+    """
+    What get_hpo_or_error gives for free text that the term matcher could only find by edit distance,
+    with a score below the matcher's review_score (exact matches ignoring case and punctuation are just the HPOTerm)
+    It stands in for the HPOTerm (same str, id, name and so on, so it goes in the TermList like any other term)
+    but also keeps the text it was matched from and the matcher's score, so the match can be put in Problems
+    for someone to check (see problem_text)
+    """
+    __slots__ = ("term", "text", "score")
+
+    def __init__(self, term, text: str, score: float):
+        self.term = term
+        self.text = text
+        self.score = score
+
+    @property
+    def note(self) -> str:
+        # e.g. "Fuzzy: Seizurs -> HP:0001250 | Seizure (0.93)"
+        return f"Fuzzy: {self.text} -> {self.term} ({self.score:.2f})"
+
+    def __getattr__(self, name):
+        # Only gets here for things that aren't in __slots__, like id and name (or anything before unpickling is done)
+        if name in HPOFuzzyMatch.__slots__:
+            raise AttributeError(name)
+        return getattr(self.term, name)
+
+    def __int__(self) -> int:
+        return int(self.term)
+
+    def __hash__(self) -> int:
+        return hash(self.term)
+
+    def __eq__(self, other) -> bool:
+        return self.term == (other.term if isinstance(other, HPOFuzzyMatch) else other)
+
+    def __str__(self) -> str:
+        return str(self.term)
+
+    def __repr__(self) -> str:
+        return f"HPOFuzzyMatch({self.term!r}, {self.text!r}, {self.score!r})"
+
+def problem_text(term):
+    """
+    What a result from get_hpo_or_error adds to Problems: the "Error: ..." text if it failed,
+    a "Fuzzy: ..." note if the term matcher found it, otherwise None
+    """
+    if isinstance(term, HPOFuzzyMatch):
+        return term.note
+    if isinstance(term, str) and term.startswith('Error:'):
+        return term
+    return None
+
+def normalise_non_numeric(strg: str) -> str:
+    """
+    Cleans up free text before it gets looked up in the ontology
+    Strips whitespace and any leading/trailing non-word characters, then makes it look like
+    a HPO name (capital first letter, everything else lower case)
+    """
+    # Remove trailing whitespace
+    strg = strg.rstrip()
+    # Remove leading and trailing non-word characters
+    strg = re.sub(r'^\W+|\W+$', '', strg)
+    if len(strg) > 1:
+        strg = strg[0].upper() + strg[1:].lower()
+    else:
+        strg = strg.upper()
+    return strg
 
 def get_hpo_or_error(strg: str, Process_Type: str="Non_numeric")->str:
     """
@@ -89,6 +638,13 @@ def get_hpo_or_error(strg: str, Process_Type: str="Non_numeric")->str:
     it tries a few different ways of cleaning up the string
     Designed to work with non_numeric values
     If it still fails, it returns an error message, which can then be added to a list of problems
+
+    If a term matcher has been turned on with use_term_matcher, free text that doesn't match exactly gets
+    a second go with that before being called an error, and anything it only finds by edit distance (scoring
+    under its review_score) comes back as a HPOFuzzyMatch
+
+    Results (including the errors) are kept in resolution_cache, so repeats don't hit the ontology again
+    (and in persistent_cache too if use_persistent_cache has been turned on, so the next run can use them)
     """
 
     # Maybe I want process type and error type
@@ -97,45 +653,119 @@ def get_hpo_or_error(strg: str, Process_Type: str="Non_numeric")->str:
     # If numerical, try it, then check if there's any "HPs"
     # If there are HPs but no colons, add colons
     # If t
+    if Process_Type == "Non_numeric":
+        strg = normalise_non_numeric(strg)
+    elif Process_Type not in ("None", "Numeric"):
+        print("Process_Type must be one of 'None', 'Non_numeric', or 'Numeric'")
+        return None
+
+    key = (strg, Process_Type)
+    if Process_Type == "Non_numeric" and term_matcher is not None:
+        # The matcher can change the answer, so keep what it finds apart from the plain lookups
+        key = (strg, Process_Type + term_matcher.cache_tag)
+    out = resolution_cache.get(key, _NOT_CACHED)
+    if out is _NOT_CACHED:
+        if persistent_cache is None:
+            out = _lookup_hpo(strg, Process_Type)
+        else:
+            out = _lookup_hpo_persistent(key, strg, Process_Type)
+        resolution_cache.put(key, out)
+    return out
+
+def _lookup_hpo_persistent(key: tuple[str, str], strg: str, Process_Type: str):
+    # Check the on-disk cache before going to the ontology, and remember anything new
+    found = persistent_cache.get(key)
+    if found is not None:
+        kind, value = found
+        if kind == "fuzzy":
+            code, score = value.split(" ")
+            return HPOFuzzyMatch(get_ontology().get_hpo_object(code), strg, float(score))
+        return get_ontology().get_hpo_object(value) if kind == "term" else value
+    out = _lookup_hpo(strg, Process_Type)
+    if isinstance(out, str):
+        persistent_cache.put(key, "text", out)
+    elif isinstance(out, HPOFuzzyMatch):
+        persistent_cache.put(key, "fuzzy", f"{out.term.id} {out.score!r}")
+    else:
+        persistent_cache.put(key, "term", out.id)
+    return out
+
+# Every name and synonym in the ontology, as (ontology, {name or synonym: term}) for the ontology it was built from
+_name_index = None
+_name_index_lock = threading.Lock()
+
+def _names(ontology) -> dict:
+    # Built the first time it's needed for each ontology, it's the same answers as pyhpo's synonym_match:
+    # a name beats a synonym, and a synonym shared by several terms goes to the first of them
+    global _name_index
+    index = _name_index
+    if index is None or index[0] is not ontology:
+        with _name_index_lock:
+            index = _name_index
+            if index is None or index[0] is not ontology:
+                names = {}
+                synonyms = {}
+                for term in ontology:
+                    names.setdefault(term.name, term)
+                    for synonym in term.synonym:
+                        synonyms.setdefault(synonym, term)
+                synonyms.update(names)
+                index = _name_index = (ontology, synonyms)
+    return index[1]
+
+def _get_hpo_object(ontology, strg: str):
+    """
+    ontology.get_hpo_object(strg), but names and synonyms are a dict lookup rather than pyhpo going through
+    every term for each one (a HPOSnapshot already finds them by binary search, so it's left to do it itself)
+    Raises a RuntimeError if there's no such term, like pyhpo does
+    """
+    if strg.startswith("HP:") or getattr(ontology, "indexed_names", False):
+        return ontology.get_hpo_object(strg)
+    term = _names(ontology).get(strg)
+    if term is None:
+        raise RuntimeError("Unknown HPO term")
+    return term
+
+def _lookup_hpo(strg: str, Process_Type: str):
+    """
+    The actual ontology lookup behind get_hpo_or_error, without any caching
+    Non_numeric strings should already have been through normalise_non_numeric
+    """
+    ontology = get_ontology()
     if Process_Type == "None":
         try:
-            out = ontology.get_hpo_object(strg)
+            out = _get_hpo_object(ontology, strg)
             return out
         except RuntimeError:
                 out = ""
                 return out
     elif Process_Type == "Non_numeric":
-        # Remove trailing whitespace
-        strg = strg.rstrip()
-        # Remove leading and trailing non-word characters
-        strg = re.sub(r'^\W+|\W+$', '', strg)
-        if len(strg) > 1:
-            strg = strg[0].upper() + strg[1:].lower()
-        else:
-            strg = strg.upper()
         try:
             # Attempt to get the HPO object
-            out = ontology.get_hpo_object(strg)
+            out = _get_hpo_object(ontology, strg)
             return out
         except RuntimeError:
+            # If there's a matcher turned on, see if it can find something close enough
+            match = term_matcher.match(strg) if term_matcher is not None else None
+            if match is not None:
+                term, score = match
+                # Exact matches (ignoring case and punctuation) score 1, so they never need checking
+                return HPOFuzzyMatch(term, strg, score) if score < term_matcher.review_score else term
             # Return an error message if both attempts fail
             out = f"Error: {strg}"
         return out
-    elif Process_Type == "Numeric":
+    else:
         try:
-            out = ontology.get_hpo_object(strg)
+            out = _get_hpo_object(ontology, strg)
             return out
         except RuntimeError:
             try:
                 hpstrg = "HP:"+strg
-                out = ontology.get_hpo_object(hpstrg)
+                out = _get_hpo_object(ontology, hpstrg)
                 return out
             except RuntimeError:
                 out = f"Error: HP:{strg}"
         return out
-    else:
-        print("Process_Type must be one of 'None', 'Non_numeric', or 'Numeric'")
-        return None
 
 
 #print(get_hpo_or_error("arachnodactyly"))             
@@ -147,6 +777,7 @@ def list_to_csv(lst: list)->str:
     """
     return '; '.join(map(str, lst)) 
     
+@_profiled("HPOOutPutter")
 def HPOOutPutter(numeric_values: list[str], non_numeric_values: list[str])->tuple[list[str], list[str], str]:
     """
     Takes the two lists from HPOSorter and then runs them through the get_hpo_or_error function
@@ -164,21 +795,23 @@ def HPOOutPutter(numeric_values: list[str], non_numeric_values: list[str])->tupl
         # No contribution to ProblemList
     else:
         #numeric_terms = ["HP:" + str(r) for r in numeric_values]
-        numeric_terms = [str(get_hpo_or_error(r, Process_Type="Numeric")) for r in numeric_values]
-        ProblemList.extend([value for value in numeric_terms if isinstance(value, str) and value.startswith('Error:')])
-        numeric_terms = [value for value in numeric_terms if not (isinstance(value, str) and value.startswith('Error:'))]
+        found = [get_hpo_or_error(r, Process_Type="Numeric") for r in numeric_values]
+        ProblemList.extend([problem_text(value) for value in found if problem_text(value) is not None])
+        numeric_terms = [str(value) for value in found if not str(value).startswith('Error:')]
     if not non_numeric_values:  # If the list is empty
         non_numeric_terms = []
         # No contribution to ProblemList
     else: 
-        non_numeric_terms = [str(get_hpo_or_error(r, Process_Type="Non_numeric")) for r in non_numeric_values]
-        ProblemList.extend([value for value in non_numeric_terms if isinstance(value, str) and value.startswith('Error:')])
-        non_numeric_terms = [value for value in non_numeric_terms if not (isinstance(value, str) and value.startswith('Error:'))]
+        # Fuzzy matches go in the TermList, but also in Problems so they get checked
+        found = [get_hpo_or_error(r, Process_Type="Non_numeric") for r in non_numeric_values]
+        ProblemList.extend([problem_text(value) for value in found if problem_text(value) is not None])
+        non_numeric_terms = [str(value) for value in found if not str(value).startswith('Error:')]
 
     Problems = list_to_csv(ProblemList)
     
     return numeric_terms, non_numeric_terms, Problems # Note that outputs include the Problem cases so that they can be manually checked
 
+@_profiled("HPOSquisher")
 def HPOSquisher(terms1, terms2):
     """
     Takes the list of HPO terms from the numeric and non_numeric lists and does the union of them to give a list of all possible mentions
@@ -193,6 +826,7 @@ def HPOSquisher(terms1, terms2):
 
     return TermList
 
+@_profiled("process_column")
 def process_column(entry: str)  -> tuple[str, str]:
     """
     Takes the cell entry, runs it through the HPOSorter, HPOOutPutter and HPOSquisher functions
@@ -202,60 +836,541 @@ def process_column(entry: str)  -> tuple[str, str]:
     numeric_values, non_numeric_values = HPOSorter(entry)
     terms1, terms2, Problems = HPOOutPutter(numeric_values, non_numeric_values)
     TermList = HPOSquisher(terms1, terms2)
-    
+
     return TermList, Problems
 
-def HPOScorer(doctor_responses, parent_responses):
+def process_column_ids(entry: str) -> tuple[np.ndarray, str]:
+    """
+    process_column, but the terms come back as a sorted array of integer term IDs instead of a TermList string
+    (format_term_ids gives the TermList back when it's time to write it out)
+    """
+    numeric_values, non_numeric_values = HPOSorter(entry)
+    terms = [get_hpo_or_error(r, Process_Type="Numeric") for r in numeric_values]
+    terms += [get_hpo_or_error(r, Process_Type="Non_numeric") for r in non_numeric_values]
+
+    Problems = list_to_csv([problem_text(term) for term in terms if problem_text(term) is not None])
+    ids = np.unique(np.array([int(term) for term in terms if not isinstance(term, str)], dtype=np.int32))
+
+    return ids, Problems
+
+def format_term_ids(ids) -> str:
+    """
+    Turns an array of integer term IDs into a TermList string, the same as HPOSquisher would give
+    e.g. [717, 1250] -> "HP:0000717 | Autism; HP:0001250 | Seizure"
+    """
+    ontology = get_ontology()
+    return list_to_csv([ontology[term_id] for term_id in sorted(set(np.asarray(ids).tolist()))])
+
+def term_ids_to_codes(ids) -> list[str]:
+    """
+    Turns integer term IDs into HPO codes, e.g. [717, 1250] -> ["HP:0000717", "HP:0001250"]
+    """
+    return [f"HP:{term_id:07d}" for term_id in np.asarray(ids).tolist()]
+
+def parse_term_ids(responses) -> np.ndarray:
+    """
+    Goes the other way from format_term_ids, for TermList columns that have already been written out
+    Returns the sorted integer term IDs in a TermList string (an empty array for an empty TermList),
+    or None if it's missing, so score_term_ids can tell the two apart the same way HPOScorer does
+    """
+    if _missing_ids(responses):
+        return None
+    ids = [int(code[3:]) for code in split_hpo_codes(responses) if _HPO_CODE_RE.fullmatch(code)]
+    return np.unique(np.array(ids, dtype=np.int32))
+
+@_profiled("process_series")
+def process_series(series: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """
+    Batch version of process_column for a whole dataframe column
+    Instead of going through the column one cell at a time, the cleaning is done with the
+    pandas .str methods on the whole column, then every unique token is only looked up once
+    in the ontology and the results are put back into the rows they came from
+    (Most tokens turn up loads of times in the referral exports so this saves a lot of lookups)
+    Returns two series (TermList and Problems) with the same index as the input,
+    which should be exactly the same as running process_column on every cell
+    """
+    index = series.index
+    rows, terms = _resolve_series(series)
+    problems = terms.map(problem_text).dropna().astype(str)
+    terms = terms.astype(str)
+    is_error = terms.str.startswith('Error:')
+
+    # Same as HPOSquisher, drop the repeats in each row and sort them
+    found = terms[~is_error].rename("Term").rename_axis("Row").reset_index()
+    found = found.drop_duplicates().sort_values(["Row", "Term"])
+
+    TermList = pd.Series(_join_rows(found["Row"], found["Term"], len(rows)), index=index, name="TermList", dtype=str)
+    Problems = pd.Series(_join_rows(problems.index, problems, len(rows)), index=index, name="Problems", dtype=str)
+
+    return TermList, Problems
+
+def _join_rows(row_numbers, values, n_rows: int) -> list[str]:
+    # Joins up the values for each row number with list_to_csv, "" for rows without any
+    # (a plain loop, since groupby().agg makes a little series for every row, which took longer than the lookups)
+    rows = [[] for _ in range(n_rows)]
+    for row, value in zip(row_numbers.tolist(), values.tolist()):
+        rows[row].append(value)
+    return [list_to_csv(row) for row in rows]
+
+@_profiled("process_series_ids")
+def process_series_ids(series: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """
+    process_series, but the terms for each row come back as a sorted array of integer term IDs
+    (e.g. [717, 1250] for HP:0000717 and HP:0001250) instead of a TermList string
+    All the rows' arrays are slices of one big array, so this takes a lot less memory than the strings,
+    and score_term_ids/score_cohort_ids can use them without splitting anything
+    format_term_ids turns a row back into the TermList process_series would have given
+    Returns two series (TermIds and Problems) with the same index as the input
+    """
+    index = series.index
+    rows, terms = _resolve_series(series)
+    is_error = terms.map(lambda term: isinstance(term, str)).astype(bool)
+
+    problems = terms.map(problem_text).dropna().astype(str)
+    Problems = pd.Series(_join_rows(problems.index, problems, len(rows)), index=index, name="Problems", dtype=str)
+
+    # Sort by row then ID, and drop the repeats within each row
+    row_numbers = terms[~is_error].index.to_numpy()
+    ids = np.array([int(term) for term in terms[~is_error]], dtype=np.int32)
+    order = np.lexsort((ids, row_numbers))
+    row_numbers = row_numbers[order]
+    ids = ids[order]
+    keep = np.ones(len(ids), dtype=bool)
+    keep[1:] = (row_numbers[1:] != row_numbers[:-1]) | (ids[1:] != ids[:-1])
+    row_numbers = row_numbers[keep]
+    ids = ids[keep]
+
+    bounds = np.searchsorted(row_numbers, np.arange(len(rows) + 1))
+    TermIds = pd.Series([ids[bounds[i]:bounds[i + 1]] for i in range(len(rows))], index=index, name="TermIds", dtype=object)
+
+    return TermIds, Problems
+
+def _resolve_series(series: pd.Series) -> tuple[pd.Index, pd.Series]:
+    # The cleaning and lookups shared by process_series and process_series_ids
+    # Returns the row numbers, and a series of the HPOTerm or "Error: ..." for every token, indexed by row number
+    cells = series.reset_index(drop=True).astype(object)
+
+    # Same as check_and_set_nan, but for the whole column at once
+    cells = cells.where(cells.notna(), "")
+    cells = cells.where(~cells.str.lower().isin(_null_values(tuple(NullList))), "")
+    if cleanup_rules is not None:
+        cells = cells.where(~cells.map(cleanup_rules.is_null).astype(bool), "")
+
+    # Same steps as HPOSorter
+    numeric_values = cells.str.findall(_NUMERIC_RE).explode().dropna().astype(str)
+
+    text = cells.str.replace(_HP_RUN_RE, lambda run: _cut_run(run.group()), regex=True)
+    leftover_hp = text.str.contains(_LEFTOVER_HP_RE)
+    text[leftover_hp] = cells[leftover_hp].map(_strip_hp_chained)
+
+    non_numeric_values = text.str.split(_SPLIT_RE).explode().dropna().astype(str)
+    non_numeric_values = non_numeric_values[non_numeric_values.str.contains(_LETTER_RE)]
+    non_numeric_values = non_numeric_values.str.lstrip()
+    non_numeric_values = non_numeric_values.str.replace(r'^HP', '', regex=True)
+
+    if cleanup_rules is not None:
+        # Same as cleanup_rules.apply, once for each unique fragment
+        cleaned = non_numeric_values.map({value: cleanup_rules.clean(value) for value in non_numeric_values.unique()}).dropna()
+        Process_Types = cleaned.map(lambda result: result[1])
+        values = cleaned.map(lambda result: result[0]).astype(str)
+        # Synonyms for codes go on the end of the row's numeric values, same as in HPOSorter
+        numeric_values = pd.concat([numeric_values, values[Process_Types == "Numeric"]]).sort_index(kind="stable")
+        non_numeric_values = values[Process_Types == "Non_numeric"]
+
+    # Same steps as HPOOutPutter, but each unique token only goes to the ontology once
+    numeric_lookup = {value: get_hpo_or_error(value, Process_Type="Numeric")
+                      for value in numeric_values.unique()}
+    non_numeric_lookup = {value: get_hpo_or_error(value, Process_Type="Non_numeric")
+                          for value in non_numeric_values.unique()}
+    # Numeric goes first so the problems come out in the same order as HPOOutPutter
+    terms = pd.concat([numeric_values.map(numeric_lookup), non_numeric_values.map(non_numeric_lookup)])
+    terms = terms.astype(object).sort_index(kind="stable")
+
+    return cells.index, terms
+
+def split_hpo_codes(responses: str) -> list[str]:
+    """
+    Takes a semicolon separated cell of HPO terms (like the TermList from process_column)
+    and returns just the codes, e.g. "HP:0001250 | Seizure; HP:0000717 | Autism" -> ["HP:0001250", "HP:0000717"]
+    """
+    codes = responses.split(";")
+    codes = [hpo.split(" | ")[0] for hpo in codes]
+    codes = [code.replace(" ", "") for code in codes]
+    return codes
+
+class HPOPathIndex:
+    """
+    Precomputes the ancestors of each HPO term, and how many steps up it takes to get to each of them,
+    so that HPOScorer doesn't need to walk the whole graph with ontology.path for every pair
+    Terms get added the first time they're asked about, or all at once with add/from_columns
+    pair_steps gives the same (a, b) as the last two things ontology.path returns:
+    the number of steps from each term to their closest common ancestor
+    (except that when two paths are equally short it always picks the same one, ontology.path doesn't)
+    """
+
+    def __init__(self, codes=()):
+        self._terms = {}  # code -> integer term ID, or None if it isn't in the ontology
+        self._ancestors = {}  # term ID -> set of ancestor IDs, including itself
+        self._steps = {}  # term ID -> {ancestor ID: fewest steps up to get there}
+        self.add(codes)
+
+    @classmethod
+    def from_columns(cls, *columns: pd.Series) -> "HPOPathIndex":
+        """
+        Builds an index for every term that turns up in the given TermList columns
+        """
+        index = cls()
+        for column in columns:
+            for responses in column.dropna().unique():
+                index.add(split_hpo_codes(responses))
+        return index
+
+    def add(self, codes) -> None:
+        """
+        Looks up each code and precomputes its ancestors, skipping any that are already in
+        Codes can be "HP:..." strings or integer term IDs
+        """
+        for code in codes:
+            self._term_id(code)
+
+    def term(self, code):
+        """
+        Returns the HPOTerm for a code, or None if the ontology doesn't know it
+        """
+        term_id = self._term_id(code)
+        return None if term_id is None else get_ontology()[term_id]
+
+    def _term_id(self, code):
+        # Everything is kept as integer IDs, which are a lot quicker to hash than HPOTerms
+        if _profiler is not None:
+            _profiler.record_cache(code in self._terms)
+        if code not in self._terms:
+            try:
+                term_id = int(get_ontology().get_hpo_object(code))
+            except (RuntimeError, ValueError):
+                term_id = None
+            if term_id is not None and term_id not in self._steps:
+                self._steps[term_id] = self._count_steps(get_ontology()[term_id])
+                self._ancestors[term_id] = set(self._steps[term_id])
+            self._terms[code] = term_id
+        return self._terms[code]
+
+    def pair_steps(self, code1, code2):
+        """
+        Returns (a, b), the steps from code1 and code2 to their closest common ancestor,
+        or None if either of them can't be found in the ontology or they aren't connected
+        """
+        term1 = self._term_id(code1)
+        term2 = self._term_id(code2)
+        if term1 is None or term2 is None:
+            return None
+        steps1 = self._steps[term1]
+        steps2 = self._steps[term2]
+        common = self._ancestors[term1] & self._ancestors[term2]
+        if not common:
+            # Obsolete terms aren't connected to the rest of the ontology, so there's no path
+            return None
+        # pyhpo picks between equally short paths in whatever order its sets come out, which changes
+        # from run to run (and between worker processes), so settle ties the same way every time:
+        # prefer one term being an ancestor of the other, then the lowest ancestor ID
+        closest = min(common, key=lambda ancestor: (steps1[ancestor] + steps2[ancestor],
+                                                    ancestor not in (term1, term2),
+                                                    ancestor))
+        return steps1[closest], steps2[closest]
+
+    @staticmethod
+    def _count_steps(term) -> dict:
+        # Breadth first up through the parents, so the first time we reach an ancestor is the shortest way there
+        steps = {int(term): 0}
+        current = [term]
+        distance = 0
+        while current:
+            distance += 1
+            parents = []
+            for child in current:
+                for parent in child.parents:
+                    if int(parent) not in steps:
+                        steps[int(parent)] = distance
+                        parents.append(parent)
+            current = parents
+        return steps
+
+    def __len__(self) -> int:
+        return len(self._steps)
+
+
+# Default index that HPOScorer fills up as it goes
+default_path_index = HPOPathIndex()
+
+@_profiled("HPOScorer")
+def HPOScorer(doctor_responses, parent_responses, path_index: HPOPathIndex = None):
     """
     Takes a list of HPO terms from the doctor and parent
     returns the quantity and quality scores for both
     as well as the codes where the quality score is non-zero
+
+    The distances between terms come from a HPOPathIndex, if one isn't given default_path_index is used
+    (HPOPathIndex.from_columns can build one up front for a whole cohort)
     """
+    if path_index is None:
+        path_index = default_path_index
     
     if pd.notna(doctor_responses):
-        doctor_hpo = doctor_responses.split(";")
-        doctor_hpo = [hpo.split(" | ")[0] for hpo in doctor_hpo]
-        doctor_hpo = [doc.replace(" ", "") for doc in doctor_hpo]
+        doctor_hpo = split_hpo_codes(doctor_responses)
         doc_quant = len(doctor_hpo)
     else:
         doc_quant = 0
 
     if pd.notna(parent_responses):
-        parent_hpo = parent_responses.split(";")
-        parent_hpo = [hpo.split(" | ")[0] for hpo in parent_hpo]
-        parent_hpo = [par.replace(" ", "") for par in parent_hpo]
+        parent_hpo = split_hpo_codes(parent_responses)
         par_quant = len(parent_hpo)
     else:
         par_quant = 0
 
+    if pd.notna(doctor_responses) and pd.notna(parent_responses):
+        doc_qual, par_qual, doc_codes, par_codes = _score_pairs(doctor_hpo, parent_hpo, path_index.pair_steps)
+    else:
+        doc_qual, par_qual, doc_codes, par_codes = 0, 0, [], []
+    
+    return int(doc_quant), int(par_quant), int(doc_qual), int(par_qual), doc_codes, par_codes
+
+def _score_pairs(doctor_hpo: list, parent_hpo: list, pair_steps) -> tuple[int, int, list, list]:
+    # The quality scores and codes for every doctor/parent pair, the codes can be strings or integer IDs
+    # pair_steps(doc, par) gives the steps for a pair, usually HPOPathIndex.pair_steps
     doc_qual = 0
     par_qual = 0
 
     doc_codes = []
     par_codes = []
 
-    if pd.notna(doctor_responses) and pd.notna(parent_responses):
-        for doc, par in itertools.product(doctor_hpo, parent_hpo):
-            #print(doc, par)
-            # Assuming ontology.path returns a list or tuple where the 3rd and 4th elements are needed
-            try: 
-                path_result = ontology.path(doc, par)
-            except: 
-                continue
-            a, b = path_result[2], path_result[3]  # Corrected indexing
-            if a == 0:
-                doc_qual += 0  # This line could be omitted as it has no effect
-                par_qual += b
-                if b != 0:
-                    par_codes.append(par)
-            elif b == 0:
-                doc_qual += a
-                par_qual += 0  # This line could also be omitted
-                if a != 0:
-                    doc_codes.append(doc)
-    
-    return int(doc_quant), int(par_quant), int(doc_qual), int(par_qual), doc_codes, par_codes
+    for doc, par in itertools.product(doctor_hpo, parent_hpo):
+        #print(doc, par)
+        # Same as the 3rd and 4th elements of ontology.path, None where ontology.path would have failed
+        path_result = pair_steps(doc, par)
+        if path_result is None:
+            continue
+        a, b = path_result
+        if a == 0:
+            doc_qual += 0  # This line could be omitted as it has no effect
+            par_qual += b
+            if b != 0:
+                par_codes.append(par)
+        elif b == 0:
+            doc_qual += a
+            par_qual += 0  # This line could also be omitted
+            if a != 0:
+                doc_codes.append(doc)
+
+    return doc_qual, par_qual, doc_codes, par_codes
+
+@_profiled("score_term_ids")
+def score_term_ids(doctor_ids, parent_ids, path_index: HPOPathIndex = None):
+    """
+    HPOScorer for rows that are arrays of integer term IDs (like process_series_ids gives) instead of TermList strings,
+    so there's no splitting and stripping of strings for every row
+    Gives the same scores as HPOScorer on the matching TermLists, except the codes come back as integer IDs
+    (term_ids_to_codes turns them back into "HP:..." codes)
+    A missing answer (None or NA) counts as 0 terms, like a missing TermList does in HPOScorer
+    An empty array counts as 1 term, since HPOScorer counts the empty TermList ("") process_series gives
+    a blank cell as one (blank) term
+    """
+    if path_index is None:
+        path_index = default_path_index
+
+    doctor_hpo = [] if _missing_ids(doctor_ids) else np.asarray(doctor_ids).tolist()
+    parent_hpo = [] if _missing_ids(parent_ids) else np.asarray(parent_ids).tolist()
+    doc_quant = 0 if _missing_ids(doctor_ids) else max(len(doctor_hpo), 1)
+    par_quant = 0 if _missing_ids(parent_ids) else max(len(parent_hpo), 1)
+    doc_qual, par_qual, doc_codes, par_codes = _score_pairs(doctor_hpo, parent_hpo, path_index.pair_steps)
+
+    return doc_quant, par_quant, int(doc_qual), int(par_qual), doc_codes, par_codes
+
+def _missing_ids(ids) -> bool:
+    # None or NA, rather than an array (which might be empty)
+    return ids is None or (np.ndim(ids) == 0 and pd.isna(ids))
+
+
+
+SCORE_COLUMNS = ["Doctor_Quantity", "Parent_Quantity", "Doctor_Quality", "Parent_Quality", "Doctor_Codes", "Parent_Codes"]
+
+# Each worker process keeps its own index for the whole cohort, so it only gets built once per worker
+_cohort_path_index = None
+
+def _init_scoring_worker(codes: list[str]) -> None:
+    """
+    Runs once when each score_cohort worker starts
+    Forked workers already have the ontology and the index from the main process,
+    otherwise the ontology gets loaded and the index is built here
+    """
+    global _cohort_path_index
+    if _cohort_path_index is None:
+        preload()
+        _cohort_path_index = HPOPathIndex(codes)
+
+def _score_rows(rows: list[tuple], scorer=HPOScorer) -> list[tuple]:
+    return [scorer(doctor, parent, path_index=_cohort_path_index) for doctor, parent in rows]
+
+def score_cohort(df: pd.DataFrame, doctor_col: str, parent_col: str, workers: int = 1, chunksize: int = 500) -> pd.DataFrame:
+    """
+    Runs HPOScorer on every row of df, comparing the doctor_col and parent_col TermLists
+    With workers > 1 the rows are split into chunks of chunksize and shared out over a process pool
+    Returns a dataframe with the six HPOScorer outputs as columns (SCORE_COLUMNS), in the same order
+    and with the same index as df, and the answers don't depend on how many workers there are
+    """
+    codes = sorted(set(itertools.chain.from_iterable(
+        split_hpo_codes(responses) for responses in pd.concat([df[doctor_col], df[parent_col]]).dropna().unique())))
+    return _score_cohort(df, doctor_col, parent_col, codes, HPOScorer, workers, chunksize)
+
+def score_cohort_ids(df: pd.DataFrame, doctor_col: str, parent_col: str, workers: int = 1, chunksize: int = 500) -> pd.DataFrame:
+    """
+    score_cohort for columns of integer term ID arrays (like process_series_ids gives), using score_term_ids
+    The Doctor_Codes and Parent_Codes columns have integer IDs in them rather than "HP:..." codes
+    """
+    arrays = [ids for ids in pd.concat([df[doctor_col], df[parent_col]]) if not _missing_ids(ids) and len(ids)]
+    codes = np.unique(np.concatenate(arrays)).tolist() if arrays else []
+    return _score_cohort(df, doctor_col, parent_col, codes, score_term_ids, workers, chunksize)
+
+def _score_cohort(df: pd.DataFrame, doctor_col: str, parent_col: str, codes: list, scorer, workers: int, chunksize: int) -> pd.DataFrame:
+    global _cohort_path_index
+    rows = list(zip(df[doctor_col], df[parent_col]))
+    index = HPOPathIndex(codes)
+
+    if workers <= 1 or len(rows) <= chunksize:
+        results = [scorer(doctor, parent, path_index=index) for doctor, parent in rows]
+    else:
+        chunks = [rows[i:i + chunksize] for i in range(0, len(rows), chunksize)]
+        # Set before the pool starts so forked workers inherit it rather than building their own
+        _cohort_path_index = index
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_scoring_worker, initargs=(codes,)) as pool:
+                # map hands the chunks back in the order they went in
+                results = list(itertools.chain.from_iterable(pool.map(functools.partial(_score_rows, scorer=scorer), chunks)))
+        finally:
+            _cohort_path_index = None
+
+    return pd.DataFrame(results, columns=SCORE_COLUMNS, index=df.index)
+
+PAIR_COLUMNS = ["Doctor_Code", "Parent_Code", "Doctor_Steps", "Parent_Steps", "Relation", "Occurrences", "Patients"]
+
+def _scored_terms(responses) -> tuple[int, list]:
+    # How many terms HPOScorer (for a TermList) or score_term_ids (for an ID array) would count, and the codes worth
+    # pairing up (None if there's no answer). A blank TermList counts as a term but its "" code can't match anything
+    if isinstance(responses, str):
+        codes = split_hpo_codes(responses)
+        return len(codes), [code for code in codes if code]
+    if _missing_ids(responses):
+        return 0, None
+    ids = np.asarray(responses).tolist()
+    return max(len(ids), 1), ids
+
+def _pair_steps_rows(pairs: list[tuple]) -> list:
+    return [_cohort_path_index.pair_steps(doc, par) for doc, par in pairs]
+
+def _relation(steps) -> str:
+    # What a doctor/parent pair's steps to their closest common ancestor say about them
+    if steps is None:
+        return "Unrelated"
+    a, b = steps
+    if a == 0 and b == 0:
+        return "Same"
+    if a == 0:
+        # The doctor's term is an ancestor of the parent's, so the parent was more specific
+        return "Parent_Refines"
+    if b == 0:
+        return "Doctor_Refines"
+    return "Related"
+
+def score_cohort_pairs(df: pd.DataFrame, doctor_col: str, parent_col: str, workers: int = 1, chunksize: int = 5000) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Gives the same scores as score_cohort (or score_cohort_ids, for integer term ID arrays), but works out every
+    distinct (doctor term, parent term) pair in the cohort only once, then puts each patient's scores together
+    from that table, since the same pairs come up for lots of patients
+    With workers > 1 the distinct pairs are split into chunks of chunksize and shared out over a process pool
+    Returns two dataframes:
+    the scores (SCORE_COLUMNS, same order and index as df)
+    and the pairs (PAIR_COLUMNS), with the steps from each term to their closest common ancestor, how they're related
+    ("Same", "Parent_Refines" where the parent's term is below the doctor's, "Doctor_Refines", "Related" or "Unrelated"),
+    how many times the pair came up and in how many patients, most common first
+    """
+    global _cohort_path_index
+    rows = [(_scored_terms(doctor), _scored_terms(parent)) for doctor, parent in zip(df[doctor_col], df[parent_col])]
+
+    # Number every distinct pair in the order it first turns up, counting as we go
+    pair_numbers = {}
+    occurrences = []
+    patients = []
+    for (_, doctor_hpo), (_, parent_hpo) in rows:
+        if doctor_hpo is None or parent_hpo is None:
+            continue
+        seen = set()
+        for pair in itertools.product(doctor_hpo, parent_hpo):
+            number = pair_numbers.setdefault(pair, len(pair_numbers))
+            if number == len(occurrences):
+                occurrences.append(0)
+                patients.append(0)
+            occurrences[number] += 1
+            if number not in seen:
+                seen.add(number)
+                patients[number] += 1
+
+    pairs = list(pair_numbers)
+    codes = sorted({code for pair in pairs for code in pair})
+    index = HPOPathIndex(codes)
+    if workers <= 1 or len(pairs) <= chunksize:
+        steps = [index.pair_steps(doc, par) for doc, par in pairs]
+    else:
+        chunks = [pairs[i:i + chunksize] for i in range(0, len(pairs), chunksize)]
+        # Same as _score_cohort, forked workers inherit the index
+        _cohort_path_index = index
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_scoring_worker, initargs=(codes,)) as pool:
+                steps = list(itertools.chain.from_iterable(pool.map(_pair_steps_rows, chunks)))
+        finally:
+            _cohort_path_index = None
+
+    # Each patient's scores, looking their pairs up in the table rather than working them out again
+    pair_steps = dict(zip(pairs, steps))
+    results = []
+    for (doc_quant, doctor_hpo), (par_quant, parent_hpo) in rows:
+        if doctor_hpo is not None and parent_hpo is not None:
+            doc_qual, par_qual, doc_codes, par_codes = _score_pairs(doctor_hpo, parent_hpo, lambda doc, par: pair_steps[doc, par])
+        else:
+            doc_qual, par_qual, doc_codes, par_codes = 0, 0, [], []
+        results.append((int(doc_quant), int(par_quant), int(doc_qual), int(par_qual), doc_codes, par_codes))
+    scores = pd.DataFrame(results, columns=SCORE_COLUMNS, index=df.index)
+
+    pair_table = pd.DataFrame({"Doctor_Code": [doc for doc, _ in pairs], "Parent_Code": [par for _, par in pairs],
+                               "Doctor_Steps": pd.array([None if step is None else step[0] for step in steps], dtype="Int64"),
+                               "Parent_Steps": pd.array([None if step is None else step[1] for step in steps], dtype="Int64"),
+                               "Relation": [_relation(step) for step in steps],
+                               "Occurrences": occurrences, "Patients": patients}, columns=PAIR_COLUMNS)
+    pair_table = pair_table.sort_values(["Patients", "Occurrences"], ascending=False, kind="stable").reset_index(drop=True)
+    return scores, pair_table
+
+def cohort_summary(scores: pd.DataFrame, pairs: pd.DataFrame, top: int = 10) -> dict:
+    """
+    Cohort level statistics from the outputs of score_cohort_pairs, as a dictionary that can go straight to JSON:
+    how many patients, the mean of each score, how many patients had a non-zero quality score on each side,
+    how many pairs (and distinct pairs) were compared, how many of them were related in each way,
+    and the top most common refinement pairs (where one side's term is below the other's)
+    """
+    relations = pairs.groupby("Relation")["Occurrences"].sum()
+    refinements = pairs[pairs["Relation"].isin(["Parent_Refines", "Doctor_Refines"])].head(top)
+    return {
+        "patients": len(scores),
+        "mean_scores": {column: float(scores[column].mean()) if len(scores) else 0.0 for column in SCORE_COLUMNS[:4]},
+        "patients_doctor_refines": int((scores["Doctor_Quality"] > 0).sum()),
+        "patients_parent_refines": int((scores["Parent_Quality"] > 0).sum()),
+        "pairs_compared": int(pairs["Occurrences"].sum()),
+        "distinct_pairs": len(pairs),
+        "relations": {relation: int(count) for relation, count in relations.items()},
+        "top_refinements": [{"Doctor_Code": _plain(row.Doctor_Code), "Parent_Code": _plain(row.Parent_Code),
+                             "Relation": row.Relation, "Patients": int(row.Patients)} for row in refinements.itertuples()],
+    }
 
+def _plain(code):
+    # numpy integers don't go into JSON
+    return code.item() if isinstance(code, np.generic) else code
 
 
 def Turn_Lists_Of_HPOs_Into_Just_Codes(HPOString):
@@ -0,0 +1,197 @@
+"""
+Matching free text to HPO terms by name and synonym, for the entries get_hpo_or_error can't find exactly
+The index is built once per HPO release and can be saved to disk so it doesn't need building again
+Turn it on for get_hpo_or_error with: HPOFunc.use_term_matcher(HPOMatch.HPOTermMatcher.load_or_build("matcher.pkl"))
+"""
+import os
+import pickle
+import re
+
+import numpy as np
+
+import HPOFunc
+
+# Size of the character n-grams used to find candidates for fuzzy matching
+GRAM_SIZE = 3
+
+_NOT_ALPHANUMERIC_RE = re.compile(r'[^0-9a-z]+')
+
+def normalise_phrase(strg: str) -> str:
+    """
+    Turns a phrase into the key it's looked up by, ignoring case, punctuation and extra spaces
+    e.g. "Nail-biting " -> "nail biting"
+    """
+    return _NOT_ALPHANUMERIC_RE.sub(' ', strg.casefold()).strip()
+
+def _grams(phrase: str) -> set[str]:
+    # Padded at both ends so the first and last letters count as much as the ones in the middle
+    padded = "$" * (GRAM_SIZE - 1) + phrase + "$" * (GRAM_SIZE - 1)
+    return {padded[i:i + GRAM_SIZE] for i in range(len(padded) - GRAM_SIZE + 1)}
+
+def bounded_levenshtein(a: str, b: str, max_distance: int) -> int:
+    """
+    Edit distance between a and b, giving up as soon as it's clear it's more than max_distance
+    (in which case it returns max_distance + 1)
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+def term_phrases() -> tuple[list[str], list[int]]:
+    """
+    Returns the normalised name and synonyms of every (non-obsolete) HPO term, and the integer ID of the term
+    each one belongs to, with all the names first then all the synonyms
+    """
+    terms = sorted((term for term in HPOFunc.get_ontology() if not term.is_obsolete), key=int)
+    phrases = []
+    term_ids = []
+    for term in terms:
+        phrases.append(normalise_phrase(term.name))
+        term_ids.append(int(term))
+    for term in terms:
+        for synonym in term.synonym:
+            phrases.append(normalise_phrase(synonym))
+            term_ids.append(int(term))
+    return phrases, term_ids
+
+class HPOTermMatcher:
+    """
+    Index over the names and synonyms of every (non-obsolete) HPO term
+    Exact matches come from a hash map of normalised phrases, so case and punctuation don't matter
+    Anything else is matched by edit distance, only checking phrases that share enough character
+    n-grams with the query that they could be within max_distance edits
+    match gives back the term along with a confidence score between 0 and 1, and nothing if the best
+    one scores less than min_score
+    get_hpo_or_error flags matches scoring less than review_score for someone to check (see HPOFunc.HPOFuzzyMatch),
+    by default that's every edit distance match, but never an exact one (which scores 1)
+    """
+
+    # For matchers pickled before there was a review_score
+    review_score = 1.0
+
+    def __init__(self, phrases: list[str], term_ids: list[int], version: str, max_distance: int = 2, min_score: float = 0.8,
+                 review_score: float = 1.0):
+        self.phrases = phrases
+        self.term_ids = term_ids
+        self.version = version
+        self.max_distance = max_distance
+        self.min_score = min_score
+        self.review_score = review_score
+
+        self._exact = {}
+        # Phrases are grouped by length, since only ones of about the same length can be a few edits apart
+        # length -> (positions of the phrases that long, n-gram -> which of those phrases contain it)
+        self._by_length = {}
+        for position, phrase in enumerate(phrases):
+            self._exact.setdefault(phrase, position)
+            positions, by_gram = self._by_length.setdefault(len(phrase), ([], {}))
+            for gram in _grams(phrase):
+                by_gram.setdefault(gram, []).append(len(positions))
+            positions.append(position)
+        for length, (positions, by_gram) in self._by_length.items():
+            self._by_length[length] = (np.array(positions), {gram: np.array(found, dtype=np.int32) for gram, found in by_gram.items()})
+
+    @classmethod
+    def build(cls, **kwargs) -> "HPOTermMatcher":
+        """
+        Builds the index from the ontology
+        Names go in before synonyms, so if a name of one term is a synonym of another the name wins
+        """
+        phrases, term_ids = term_phrases()
+        return cls(phrases, term_ids, HPOFunc.ontology_version(), **kwargs)
+
+    @classmethod
+    def load_or_build(cls, path: str, **kwargs) -> "HPOTermMatcher":
+        """
+        Loads a saved index from path, or builds one and saves it there if there isn't one
+        for the current HPO release
+        """
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                matcher = pickle.load(f)
+            if isinstance(matcher, cls) and matcher.version == HPOFunc.ontology_version():
+                for setting, value in kwargs.items():
+                    setattr(matcher, setting, value)
+                return matcher
+        matcher = cls.build(**kwargs)
+        matcher.save(path)
+        return matcher
+
+    def save(self, path: str) -> None:
+        """
+        Saves the whole index (pickled) so it can be loaded again without the ontology
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @property
+    def cache_tag(self) -> str:
+        # get_hpo_or_error keeps results found with the matcher apart from ones without it
+        return f"+match({self.max_distance},{self.min_score},{self.review_score})"
+
+    def candidates(self, strg: str, max_distance: int = None) -> list[tuple[int, int]]:
+        """
+        Returns (position, edit distance) for every phrase within max_distance edits of strg,
+        closest first, ties in the order the phrases went into the index
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        query = normalise_phrase(strg)
+        if not query:
+            return []
+        if query in self._exact:
+            return [(self._exact[query], 0)]
+
+        query_grams = _grams(query)
+        # Every edit can knock out at most GRAM_SIZE of the query's n-grams
+        needed = len(query_grams) - max_distance * GRAM_SIZE
+        found = []
+        for length in range(len(query) - max_distance, len(query) + max_distance + 1):
+            if length not in self._by_length:
+                continue
+            positions, by_gram = self._by_length[length]
+            postings = [by_gram[gram] for gram in query_grams if gram in by_gram]
+            if not postings:
+                continue
+            shared = np.bincount(np.concatenate(postings), minlength=len(positions))
+            for position in positions[shared >= needed]:
+                distance = bounded_levenshtein(query, self.phrases[position], max_distance)
+                if distance <= max_distance:
+                    found.append((int(position), distance))
+        return sorted(found, key=lambda candidate: (candidate[1], candidate[0]))
+
+    def score(self, strg: str, position: int, distance: int) -> float:
+        """
+        Confidence for a match, 1 for an exact match going down by how much of the phrase had to be edited
+        """
+        query = normalise_phrase(strg)
+        return 1 - distance / max(len(query), len(self.phrases[position]))
+
+    def match(self, strg: str):
+        """
+        Returns (HPOTerm, score) for the best match to strg, or None if nothing scores at least min_score
+        """
+        # No point looking further away than could still reach min_score
+        length = len(normalise_phrase(strg))
+        max_distance = min(self.max_distance, int((1 - self.min_score) * (length + self.max_distance) + 1e-9))
+        best = None
+        for position, distance in self.candidates(strg, max_distance):
+            score = self.score(strg, position, distance)
+            # Strictly better only, so ties go to the closest then the earliest phrase
+            if best is None or score > best[1]:
+                best = (position, score)
+        if best is None or best[1] < self.min_score:
+            return None
+        position, score = best
+        return HPOFunc.get_ontology()[self.term_ids[position]], score
+
+    def __len__(self) -> int:
+        return len(self.phrases)
@@ -0,0 +1,196 @@
+"""
+Patient x HPO term matrices for cohort level analysis, so things like term frequencies and co-occurrence
+are sparse matrix sums rather than loops over the semicolon strings process_column gives
+Needs scipy (pip install scipy), HPOFunc works fine without it
+"""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import HPOFunc
+
+class HPOAncestorClosure:
+    """
+    Every term's ancestors (including itself) for the whole ontology, as a sparse term x term matrix
+    Row i has a 1 in column j if terms[j] is terms[i] or one of its ancestors
+    Only depends on the HPO release, so it's built once and can be saved to disk and loaded again
+    (get_ancestor_closure() keeps one around for the current release)
+    """
+
+    def __init__(self, terms: np.ndarray, matrix: sparse.csr_matrix, version: str):
+        self.terms = terms  # sorted integer term IDs, one per row/column
+        self.matrix = matrix
+        self.version = version
+
+    @classmethod
+    def build(cls) -> "HPOAncestorClosure":
+        """
+        Builds the closure from the ontology
+        """
+        ontology = HPOFunc.get_ontology()
+        terms = np.array(sorted(int(term) for term in ontology), dtype=np.int32)
+        rows = []
+        columns = []
+        for row, term_id in enumerate(terms):
+            term = ontology[int(term_id)]
+            ancestors = [term_id] + [int(ancestor) for ancestor in term.all_parents]
+            rows.extend([row] * len(ancestors))
+            columns.extend(ancestors)
+        columns = np.searchsorted(terms, np.array(columns, dtype=np.int32))
+        matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=(len(terms), len(terms)))
+        matrix.sort_indices()
+        return cls(terms, matrix, HPOFunc.ontology_version())
+
+    @classmethod
+    def load_or_build(cls, path: str) -> "HPOAncestorClosure":
+        """
+        Loads a saved closure from path (a .npz file), or builds one and saves it there if there isn't one
+        for the current HPO release
+        """
+        if os.path.exists(path):
+            saved = np.load(path, allow_pickle=False)
+            if str(saved["version"]) == HPOFunc.ontology_version():
+                matrix = sparse.csr_matrix((saved["data"], saved["indices"], saved["indptr"]),
+                                           shape=(len(saved["terms"]), len(saved["terms"])))
+                return cls(saved["terms"], matrix, str(saved["version"]))
+        closure = cls.build()
+        closure.save(path)
+        return closure
+
+    def save(self, path: str) -> None:
+        """
+        Saves the closure as a .npz file
+        """
+        with open(path, "wb") as f:
+            np.savez(f, terms=self.terms, data=self.matrix.data, indices=self.matrix.indices,
+                     indptr=self.matrix.indptr, version=np.array(self.version))
+
+    def columns(self, ids) -> np.ndarray:
+        """
+        Returns the column of each integer term ID
+        """
+        ids = np.asarray(ids, dtype=np.int32)
+        positions = np.searchsorted(self.terms, ids)
+        positions = np.minimum(positions, len(self.terms) - 1)
+        if not np.array_equal(self.terms[positions], ids):
+            missing = ids[self.terms[positions] != ids]
+            raise ValueError("Not in the ontology: " + ", ".join(HPOFunc.term_ids_to_codes(missing)))
+        return positions
+
+    def ancestors(self, term_id: int) -> np.ndarray:
+        """
+        Returns the integer IDs of a term and all its ancestors
+        """
+        row = self.columns([term_id])[0]
+        return self.terms[self.matrix.indices[self.matrix.indptr[row]:self.matrix.indptr[row + 1]]]
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+
+_closure = None
+_closure_lock = threading.Lock()
+
+def get_ancestor_closure() -> HPOAncestorClosure:
+    """
+    Returns the HPOAncestorClosure for the ontology, building it the first time it's needed
+    """
+    global _closure
+    if _closure is None:
+        with _closure_lock:
+            if _closure is None:
+                _closure = HPOAncestorClosure.build()
+    return _closure
+
+class HPOTermMatrix:
+    """
+    A cohort as a sparse patient x term matrix (scipy CSR), with a 1 where a patient has a term
+    Columns are every term in the ontology (in the order of closure.terms) so matrices for different
+    cohorts line up, and rows are in the same order as the column the matrix was built from (index)
+    Build one with build_term_matrix
+    """
+
+    def __init__(self, matrix: sparse.csr_matrix, index: pd.Index, closure: HPOAncestorClosure, propagated: bool):
+        self.matrix = matrix
+        self.index = index
+        self.closure = closure
+        self.propagated = propagated
+
+    @property
+    def codes(self) -> list[str]:
+        # "HP:..." code for each column
+        return HPOFunc.term_ids_to_codes(self.closure.terms)
+
+    def propagate(self) -> "HPOTermMatrix":
+        """
+        Returns a copy where every patient also has all the ancestors of their terms
+        """
+        if self.propagated:
+            return self
+        matrix = (self.matrix @ self.closure.matrix).tocsr()
+        matrix.data[:] = 1
+        return HPOTermMatrix(matrix, self.index, self.closure, True)
+
+    def term_frequencies(self, min_count: int = 1) -> pd.Series:
+        """
+        Number of patients with each term (at least min_count of them), most common first
+        """
+        counts = np.asarray(self.matrix.sum(axis=0)).ravel()
+        found = np.flatnonzero(counts >= max(min_count, 1))
+        frequencies = pd.Series(counts[found], index=HPOFunc.term_ids_to_codes(self.closure.terms[found]), name="Patients")
+        return frequencies.sort_values(ascending=False, kind="stable")
+
+    def co_occurrence(self) -> sparse.csr_matrix:
+        """
+        Term x term matrix of how many patients have both terms (the diagonal is the term frequencies)
+        """
+        return (self.matrix.T @ self.matrix).tocsr()
+
+    def shared_terms(self) -> sparse.csr_matrix:
+        """
+        Patient x patient matrix of how many terms each pair of patients have in common
+        """
+        return (self.matrix @ self.matrix.T).tocsr()
+
+    def jaccard_similarity(self) -> sparse.csr_matrix:
+        """
+        Patient x patient Jaccard similarity (shared terms / terms either of them has),
+        only stored for pairs that share at least one term
+        """
+        shared = self.shared_terms().tocoo()
+        sizes = np.asarray(self.matrix.sum(axis=1)).ravel()
+        union = sizes[shared.row] + sizes[shared.col] - shared.data
+        return sparse.csr_matrix((shared.data / union, (shared.row, shared.col)), shape=shared.shape)
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+
+def build_term_matrix(column: pd.Series, propagate: bool = False, closure: HPOAncestorClosure = None) -> HPOTermMatrix:
+    """
+    Turns a processed column into a patient x term HPOTermMatrix
+    The column can be TermList strings (from process_column/process_series) or integer term ID arrays
+    (from process_series_ids), missing rows are patients with no terms
+    With propagate=True each patient also gets all the ancestors of their terms
+    """
+    if closure is None:
+        closure = get_ancestor_closure()
+    rows = []
+    for value in column:
+        if isinstance(value, str) or value is None or (np.ndim(value) == 0 and pd.isna(value)):
+            value = HPOFunc.parse_term_ids(value)
+        rows.append(np.asarray([] if value is None else value, dtype=np.int32))
+
+    lengths = np.array([len(row) for row in rows], dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    ids = np.concatenate(rows) if rows else np.array([], dtype=np.int32)
+    matrix = sparse.csr_matrix((np.ones(len(ids), dtype=np.int32), closure.columns(ids), indptr),
+                               shape=(len(rows), len(closure)))
+    # Repeats in a row would get added together, and a patient either has a term or they don't
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    term_matrix = HPOTermMatrix(matrix, column.index, closure, False)
+    return term_matrix.propagate() if propagate else term_matrix
@@ -0,0 +1,432 @@
+"""
+Running the HPOFunc processing over whole files
+The clinical exports are too big to load in one go, so everything in here works a chunk at a time
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+import HPOFunc
+import HPOMatch
+
+def read_in_chunks(path: str, chunksize: int = 10000, sheet_name=0, skip_rows: int = 0) -> Iterator[pd.DataFrame]:
+    """
+    Reads a CSV or Excel file a chunk of rows at a time, so the whole thing never has to be in memory
+    Everything is read in as text, otherwise HPO codes like 0001250 lose their leading zeros
+    The first skip_rows rows are left out, counting rows the same way the chunks do (so blank lines in a CSV,
+    which get dropped, don't count), which is how stream_process_file carries on from where it got to
+    A file with a header but no rows gives one empty chunk, so the columns are still known
+    Excel files need openpyxl, and are streamed with its read only mode
+    """
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        chunks = _read_excel_in_chunks(path, chunksize, sheet_name)
+    else:
+        chunks = pd.read_csv(path, chunksize=chunksize, dtype=str)
+    for chunk in chunks:
+        if skip_rows:
+            # Still has to be read, to know where the rows end, but that's quick next to processing them
+            skipped = min(skip_rows, len(chunk))
+            skip_rows -= skipped
+            chunk = chunk.iloc[skipped:]
+            if chunk.empty:
+                continue
+        yield chunk
+
+def _read_excel_in_chunks(path: str, chunksize: int, sheet_name) -> Iterator[pd.DataFrame]:
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        header = [str(name) for name in next(sheet.iter_rows(max_row=1, values_only=True), [])]
+        chunk = []
+        yielded = False
+        for row in sheet.iter_rows(min_row=2, values_only=True):
+            chunk.append([None if value is None else str(value) for value in row])
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk, columns=header, dtype=object)
+                yielded = True
+                chunk = []
+        if chunk or (header and not yielded):
+            # Same as read_csv, a sheet with just a header still gives an (empty) chunk
+            yield pd.DataFrame(chunk, columns=header, dtype=object)
+    finally:
+        workbook.close()
+
+def process_chunk(chunk: pd.DataFrame, columns: list[str], store: "HPOResultStore" = None) -> pd.DataFrame:
+    """
+    Runs process_series over each of the given columns in a chunk
+    Adds a <column>_TermList and <column>_Problems column for each of them
+    With a HPOResultStore, only cells that haven't been processed before are (see incremental_process_series)
+    """
+    for column in columns:
+        if store is None:
+            chunk[column + "_TermList"], chunk[column + "_Problems"] = HPOFunc.process_series(chunk[column])
+        else:
+            chunk[column + "_TermList"], chunk[column + "_Problems"] = incremental_process_series(chunk[column], store)
+    return chunk
+
+# What HPOResultStore keeps for each fingerprint: TermList and Problems for a cell, the HPOScorer outputs (as JSON) for a pair
+_STORE_TABLES = {"cells": ["term_list", "problems"], "pairs": ["scores"]}
+
+class HPOResultStore:
+    """
+    Results of processing cells (TermList and Problems) and scoring doctor/parent pairs (the HPOScorer outputs),
+    kept in a SQLite file and keyed by a fingerprint of the input, so a rerun over a file that's only had
+    a few edits only has to work out the rows that are new or changed
+    Everything is stored against the HPO release, the term matcher and the cleanup rules (if they're turned on
+    when the store is made), since any of those can change the answers, so runs with different settings can share
+    the file without seeing (or clearing out) each other's results, prune() deletes everything else
+    hits and misses count the rows that were and weren't already in the store
+    """
+
+    def __init__(self, path: str, version: str = None):
+        self.path = path
+        if version is None:
+            version = HPOFunc.ontology_version()
+            if HPOFunc.term_matcher is not None:
+                version += HPOFunc.term_matcher.cache_tag
+            if HPOFunc.cleanup_rules is not None:
+                version += HPOFunc.cleanup_rules.cache_tag
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for table, columns in _STORE_TABLES.items():
+                connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (version TEXT, fingerprint TEXT, "
+                                   f"{', '.join(column + ' TEXT' for column in columns)}, PRIMARY KEY (version, fingerprint))")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get(self, table: str, fingerprints) -> dict:
+        """
+        Returns fingerprint -> stored result for each of the fingerprints that are in table ("cells" or "pairs")
+        """
+        connection = self._connect()
+        columns = ", ".join(_STORE_TABLES[table])
+        fingerprints = list(fingerprints)
+        found = {}
+        # SQLite only takes so many ? at once
+        for start in range(0, len(fingerprints), 500):
+            batch = fingerprints[start:start + 500]
+            rows = connection.execute(f"SELECT fingerprint, {columns} FROM {table} WHERE version = ? AND fingerprint IN "
+                                      f"({', '.join('?' * len(batch))})", [self.version] + batch)
+            found.update((row[0], row[1:]) for row in rows)
+        return found
+
+    def put(self, table: str, results: dict) -> None:
+        """
+        Stores fingerprint -> result for each of the results, all in one go
+        """
+        with self._connect() as connection:
+            connection.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, {', '.join('?' * len(_STORE_TABLES[table]))})",
+                                   [(self.version, key) + tuple(result) for key, result in results.items()])
+
+    def prune(self) -> int:
+        """
+        Deletes every stored result that isn't for this version and returns how many were deleted
+        """
+        with self._connect() as connection:
+            return sum(connection.execute(f"DELETE FROM {table} WHERE version != ?", (self.version,)).rowcount
+                       for table in _STORE_TABLES)
+
+    def close(self) -> None:
+        """
+        Closes the connection
+        """
+        if self._connection is not None:
+            self._connection.close()
+        self._connection = None
+
+    def __len__(self) -> int:
+        connection = self._connect()
+        return sum(connection.execute(f"SELECT COUNT(*) FROM {table} WHERE version = ?", (self.version,)).fetchone()[0]
+                   for table in _STORE_TABLES)
+
+
+def fingerprint(*values) -> str:
+    """
+    A short hash of the input values (empty cells included), the same every run
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for value in values:
+        # A character that can't be typed into a cell, so missing values can't clash with any text
+        digest.update(b"\x00" if pd.isna(value) else str(value).encode("utf-8"))
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+def incremental_process_series(series: pd.Series, store: HPOResultStore) -> tuple[pd.Series, pd.Series]:
+    """
+    process_series, but cells that have been processed before (by any earlier run using the same store)
+    are taken from the store rather than worked out again, and the new ones are added to it
+    Gives exactly the same answers as process_series
+    """
+    fingerprints = pd.Series([fingerprint(value) for value in series], index=series.index, dtype=object)
+    found = store.get("cells", fingerprints.unique())
+    missing = ~fingerprints.isin(found.keys())
+    store.hits += int((~missing).sum())
+    store.misses += int(missing.sum())
+
+    if missing.any():
+        # Each new cell only needs doing once, however many rows it's in
+        new = ~fingerprints.duplicated() & missing
+        TermList, Problems = HPOFunc.process_series(series[new])
+        results = dict(zip(fingerprints[new], zip(TermList, Problems)))
+        store.put("cells", results)
+        found.update(results)
+
+    TermList = fingerprints.map(lambda key: found[key][0]).rename("TermList")
+    Problems = fingerprints.map(lambda key: found[key][1]).rename("Problems")
+    return TermList, Problems
+
+def incremental_score_cohort(df: pd.DataFrame, doctor_col: str, parent_col: str, store: HPOResultStore,
+                             workers: int = 1, chunksize: int = 500) -> pd.DataFrame:
+    """
+    score_cohort, but doctor/parent pairs that have been scored before are taken from the store
+    and only the new or changed ones get scored (over workers processes, like score_cohort)
+    Gives exactly the same answers as score_cohort
+    """
+    fingerprints = pd.Series([fingerprint(doctor, parent) for doctor, parent in zip(df[doctor_col], df[parent_col])],
+                             index=df.index, dtype=object)
+    found = {key: json.loads(scores) for key, (scores,) in store.get("pairs", fingerprints.unique()).items()}
+    missing = ~fingerprints.isin(found.keys())
+    store.hits += int((~missing).sum())
+    store.misses += int(missing.sum())
+
+    if missing.any():
+        new = ~fingerprints.duplicated() & missing
+        scores = HPOFunc.score_cohort(df[new], doctor_col, parent_col, workers=workers, chunksize=chunksize)
+        results = {key: [int(value) if isinstance(value, np.integer) else value for value in row]
+                   for key, row in zip(fingerprints[new], scores.itertuples(index=False))}
+        store.put("pairs", {key: (json.dumps(row),) for key, row in results.items()})
+        found.update(results)
+
+    return pd.DataFrame([found[key] for key in fingerprints], columns=HPOFunc.SCORE_COLUMNS, index=df.index)
+
+def _progress_path(output_path: str) -> str:
+    return output_path + ".progress"
+
+def _save_progress(output_path: str, progress: dict) -> None:
+    # Write it somewhere else first then swap it in, so a crash can't leave half a progress file
+    path = _progress_path(output_path)
+    with open(path + ".tmp", "w") as f:
+        json.dump(progress, f)
+    os.replace(path + ".tmp", path)
+
+def _load_progress(output_path: str, settings: dict):
+    # Only worth resuming if it was the same job that got interrupted
+    path = _progress_path(output_path)
+    if not os.path.exists(path) or not os.path.exists(output_path):
+        return None
+    with open(path) as f:
+        progress = json.load(f)
+    if any(progress.get(key) != value for key, value in settings.items()):
+        return None
+    return progress
+
+def stream_process_file(input_path: str, output_path: str, columns: list[str], chunksize: int = 10000,
+                        resume: bool = True, sheet_name=0, store: HPOResultStore = None) -> Iterator[int]:
+    """
+    Processes the HPO columns of a CSV/Excel file a chunk at a time, appending each chunk to output_path (a CSV)
+    once it's done, so memory use depends on the chunksize rather than how big the file is
+    After each chunk is safely written, a <output_path>.progress file records how far it got and the number
+    of rows done so far is yielded
+    If it crashes part way through, running it again with the same settings carries on from the last chunk
+    that was finished, skipping the rows that were already done without processing them again
+    (resume=False always starts again from scratch, and so does an input file that's changed since)
+    An input with a header but no rows still gives an output file with a header
+    The progress file is removed once the whole file has been done
+    With a HPOResultStore (store), cells that were processed in an earlier run are taken from it rather than
+    done again, so rerunning over a file with a few edits only takes as long as the edits
+    """
+    input_stat = os.stat(input_path)
+    settings = {"input_path": os.path.abspath(input_path), "input_size": input_stat.st_size,
+                "input_mtime": input_stat.st_mtime_ns, "columns": list(columns),
+                "chunksize": chunksize, "sheet_name": sheet_name}
+    progress = _load_progress(output_path, settings) if resume else None
+
+    if progress is None:
+        progress = dict(settings, chunks_done=0, rows_done=0, output_bytes=0)
+        output = open(output_path, "w", newline="")
+    else:
+        # Anything written after the last checkpoint is from a chunk that didn't finish, so get rid of it
+        output = open(output_path, "r+", newline="")
+        output.truncate(progress["output_bytes"])
+        output.seek(progress["output_bytes"])
+
+    with output:
+        chunks = read_in_chunks(input_path, chunksize, sheet_name, skip_rows=progress["rows_done"])
+        for number, chunk in enumerate(chunks, progress["chunks_done"]):
+            chunk = process_chunk(chunk, columns, store)
+            chunk.to_csv(output, header=(number == 0), index=False)
+            output.flush()
+            os.fsync(output.fileno())
+
+            progress["chunks_done"] = number + 1
+            progress["rows_done"] += len(chunk)
+            progress["output_bytes"] = os.fstat(output.fileno()).st_size
+            _save_progress(output_path, progress)
+            yield progress["rows_done"]
+
+    if os.path.exists(_progress_path(output_path)):
+        os.remove(_progress_path(output_path))
+
+def process_file(input_path: str, output_path: str, columns: list[str], chunksize: int = 10000,
+                 resume: bool = True, sheet_name=0, store: HPOResultStore = None) -> int:
+    """
+    Runs stream_process_file all the way through and returns the number of rows processed in this run
+    and any earlier runs it carried on from
+    """
+    rows_done = 0
+    for rows_done in stream_process_file(input_path, output_path, columns, chunksize, resume, sheet_name, store):
+        pass
+    return rows_done
+
+# Problems cells are "; " separated, but only split where the next one starts, in case a phrase had "; " in it
+_PROBLEM_SPLIT_RE = re.compile(r'; (?=(?:Error|Fuzzy): )')
+
+def split_problems(problems) -> list[str]:
+    """
+    Splits a Problems cell back into its "Error: ..." (and "Fuzzy: ..." term matcher) entries
+    """
+    if pd.isna(problems) or not problems:
+        return []
+    return _PROBLEM_SPLIT_RE.split(problems)
+
+def _format_suggestions(suggestions: list[tuple]) -> str:
+    # (HPOTerm, score) suggestions as one cell, e.g. "HP:0001250 | Seizure (0.72); HP:0033349 | Seizure cluster (0.56)"
+    return HPOFunc.list_to_csv([f"{term} ({score:.2f})" for term, score in suggestions])
+
+class ProblemReport:
+    """
+    Counts the unresolved phrases in Problems columns, so curators can fix the most common ones first
+    Phrases are grouped by a normalised key (case, punctuation and spacing ignored, see HPOMatch.normalise_phrase)
+    so "Error: Hypotonia." and "Error: hypotonia" count as one, with the spellings actually used kept as variants
+    Memory is bounded by max_keys: once there are more different phrases than that, the rarest half are dropped
+    (so the counts of very rare phrases can come out a bit low, but the common ones are right)
+    """
+
+    def __init__(self, max_keys: int = 100_000, max_variants: int = 5, max_examples: int = 3):
+        self.max_keys = max_keys
+        self.max_variants = max_variants
+        self.max_examples = max_examples
+        self._counts = {}  # key -> [count, rows, {variant: count}, [example rows], {columns}]
+        self.rows = 0
+        self.problems = 0
+        self.dropped = 0
+
+    def add(self, problems, row=None, column: str = None) -> None:
+        """
+        Counts the entries in one Problems cell, row and column are kept as examples of where it turned up
+        """
+        entries = split_problems(problems)
+        self.rows += 1
+        seen = set()
+        for entry in entries:
+            if entry.startswith("Fuzzy: "):
+                # Found by the term matcher, so not unresolved
+                continue
+            phrase = entry[len("Error: "):] if entry.startswith("Error: ") else entry
+            key = HPOMatch.normalise_phrase(phrase)
+            if not key:
+                continue
+            self.problems += 1
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0, 0, {}, [], set()]
+            counts[0] += 1
+            if key not in seen:
+                seen.add(key)
+                counts[1] += 1
+                if row is not None and len(counts[3]) < self.max_examples:
+                    counts[3].append(row)
+            variants = counts[2]
+            if phrase in variants or len(variants) < self.max_variants:
+                variants[phrase] = variants.get(phrase, 0) + 1
+            if column is not None:
+                counts[4].add(column)
+        if len(self._counts) > self.max_keys:
+            self._prune()
+
+    def _prune(self) -> None:
+        # Keep the most common half
+        keep = sorted(self._counts.items(), key=lambda item: -item[1][0])[:self.max_keys // 2]
+        self.dropped += len(self._counts) - len(keep)
+        self._counts = dict(keep)
+
+    def add_series(self, problems: pd.Series, column: str = None) -> None:
+        """
+        Counts every cell of a Problems column, with the series' index as the rows
+        """
+        for row, cell in problems.items():
+            self.add(cell, row, column)
+
+    def ranked(self, min_count: int = 1, suggester=None, k: int = 5, min_score: float = 0.3) -> pd.DataFrame:
+        """
+        Returns the phrases seen at least min_count times, most common first, with
+        the number of times they came up, how many rows they were in, the spellings used (most common first),
+        the columns they were in and a few example rows
+        With a suggester (usually a HPOSuggest.HPOTermSuggester) there's also a Suggestions column
+        with the (up to) k terms each phrase most looks like that score at least min_score, and how alike they are
+        (the same defaults as HPOTermSuggester.suggest)
+        """
+        report = []
+        for key, (count, rows, variants, examples, columns) in self._counts.items():
+            if count < min_count:
+                continue
+            spellings = sorted(variants, key=lambda variant: (-variants[variant], variant))
+            report.append({"Phrase": spellings[0], "Key": key, "Count": count, "Rows": rows,
+                           "Variants": " | ".join(spellings), "Columns": ", ".join(sorted(columns)),
+                           "Example_Rows": ", ".join(map(str, examples)), "Fix": ""})
+        report = pd.DataFrame(report, columns=["Phrase", "Key", "Count", "Rows", "Variants", "Columns", "Example_Rows", "Fix"])
+        report = report.sort_values(["Count", "Key"], ascending=[False, True], kind="stable").reset_index(drop=True)
+        if suggester is not None:
+            suggestions = suggester.suggest(list(report["Phrase"]), k=k, min_score=min_score)
+            report.insert(report.columns.get_loc("Fix"), "Suggestions",
+                          [_format_suggestions(row) for row in suggestions])
+        return report
+
+    def write(self, path: str, min_count: int = 1, suggester=None, k: int = 5, min_score: float = 0.3) -> None:
+        """
+        Writes the ranked phrases to a CSV for curators to go through, with an empty Fix column to fill in
+        """
+        self.ranked(min_count, suggester, k, min_score).to_csv(path, index=False)
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+
+def problem_report(processed_path: str, report_path: str = None, columns: list[str] = None, chunksize: int = 10000,
+                   min_count: int = 1, id_column: str = None, suggester=None, k: int = 5, min_score: float = 0.3,
+                   **kwargs) -> ProblemReport:
+    """
+    Goes through a processed file (like process_file writes) once, a chunk at a time, counting the unresolved phrases
+    in its Problems columns (all the <column>_Problems ones unless columns is given)
+    and writes the ranked review file to report_path if one is given
+    Example rows are the values in id_column (e.g. a patient ID), or the row numbers if there isn't one
+    With a suggester (see ProblemReport.ranked) the review file gets up to k suggested terms for each phrase too
+    Any other arguments go to ProblemReport
+    """
+    report = ProblemReport(**kwargs)
+    for chunk in read_in_chunks(processed_path, chunksize):
+        if columns is None:
+            columns = [column for column in chunk.columns if column.endswith("_Problems")]
+        if id_column is not None:
+            chunk = chunk.set_index(id_column)
+        for column in columns:
+            report.add_series(chunk[column], column)
+    if report_path is not None:
+        report.write(report_path, min_count, suggester, k, min_score)
+    return report
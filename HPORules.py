@@ -0,0 +1,133 @@
+"""
+Site-specific cleanup rules for the free text, kept in a JSON file rather than in the code:
+phrases that mean "nothing to report", abbreviations to expand and local synonyms for HPO terms
+Turn them on for HPOSorter/process_series with: HPOFunc.use_cleanup_rules(HPORules.HPOCleanupRules.load("rules.json"))
+
+The file looks like:
+{
+    "null_phrases": ["none", "nil", "no concerns"],
+    "abbreviations": {"GDD": "Global developmental delay", "ASD": "Autism"},
+    "synonyms": {"fits": "Seizure", "floppy": "HP:0001252"},
+    "abbreviations_ignore_case": ["GDD"]
+}
+Abbreviations match case-sensitively, since plenty of them ("ALL", "ASD") are ordinary words in lower case,
+list any that are safe to match in any case in abbreviations_ignore_case (or set it to true for all of them)
+"""
+import hashlib
+import json
+import re
+
+import HPOFunc
+from HPOMatch import normalise_phrase
+
+RULE_TYPES = ["null_phrases", "abbreviations", "synonyms"]
+RULE_OPTIONS = ["abbreviations_ignore_case"]
+
+class HPOCleanupRules:
+    """
+    The rules, compiled once so that each fragment of a cell only needs a set lookup, one regex pass
+    and a dict lookup however many rules there are
+    null_phrases: a whole cell, or a fragment of one, that's one of these is dropped (ignoring case and punctuation)
+    abbreviations: whole words that get swapped for their expansion, anywhere in a fragment (matching case,
+    unless they're in abbreviations_ignore_case or that's True)
+    synonyms: a fragment that's one of these (ignoring case and punctuation) gets swapped for the HPO name
+    or code it's mapped to, codes ("HP:0001252") get looked up as codes
+    """
+
+    def __init__(self, null_phrases: list[str] = (), abbreviations: dict = None, synonyms: dict = None,
+                 abbreviations_ignore_case=()):
+        self.null_phrases = frozenset(normalise_phrase(phrase) for phrase in null_phrases)
+        self.abbreviations = dict(abbreviations or {})
+        if abbreviations_ignore_case is True:
+            abbreviations_ignore_case = list(self.abbreviations)
+        elif abbreviations_ignore_case is False:
+            abbreviations_ignore_case = []
+        unknown = set(abbreviations_ignore_case) - set(self.abbreviations)
+        if unknown:
+            raise ValueError(f"abbreviations_ignore_case has abbreviations that aren't in abbreviations: {', '.join(sorted(unknown))}")
+        self._ignore_case = {abbreviation.casefold(): self.abbreviations[abbreviation] for abbreviation in abbreviations_ignore_case}
+        self.synonyms = {}
+        for phrase, target in (synonyms or {}).items():
+            target = target.strip()
+            if HPOFunc._HPO_CODE_RE.fullmatch(target.upper()):
+                self.synonyms[normalise_phrase(phrase)] = (target[3:], "Numeric")
+            else:
+                self.synonyms[normalise_phrase(phrase)] = (target, "Non_numeric")
+
+        # All the abbreviations in one alternation, longest first so "ASD" can't cut "ASDH" short,
+        # with only the ones that opted in matched ignoring case
+        self._abbreviation_re = None
+        if self.abbreviations:
+            alternatives = "|".join("(?i:" + re.escape(abbreviation) + ")" if abbreviation.casefold() in self._ignore_case else re.escape(abbreviation)
+                                    for abbreviation in sorted(self.abbreviations, key=len, reverse=True))
+            self._abbreviation_re = re.compile(r'(?<![0-9A-Za-z])(?:' + alternatives + r')(?![0-9A-Za-z])')
+
+        # So anything cached against these rules can tell when they've changed
+        rules = json.dumps([sorted(self.null_phrases), sorted(self.abbreviations.items()), sorted(self.synonyms.items()),
+                            sorted(self._ignore_case)])
+        self._digest = hashlib.blake2b(rules.encode("utf-8"), digest_size=8).hexdigest()
+
+    @classmethod
+    def load(cls, path: str) -> "HPOCleanupRules":
+        """
+        Reads the rules from a JSON file (any of the three sections can be left out)
+        """
+        with open(path) as f:
+            config = json.load(f)
+        unknown = set(config) - set(RULE_TYPES) - set(RULE_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown rule types in {path}: {', '.join(sorted(unknown))} (expected {RULE_TYPES + RULE_OPTIONS})")
+        return cls(**config)
+
+    @property
+    def cache_tag(self) -> str:
+        # HPOResultStore keeps results worked out with these rules apart from ones without them
+        return f"+rules({self._digest})"
+
+    def is_null(self, strg: str) -> bool:
+        """
+        Whether a cell (or fragment) is just one of the null phrases
+        """
+        return normalise_phrase(strg) in self.null_phrases
+
+    def expand(self, strg: str) -> str:
+        """
+        Swaps any abbreviations in strg for their expansions
+        """
+        if self._abbreviation_re is None:
+            return strg
+        return self._abbreviation_re.sub(lambda found: self.abbreviations.get(found.group()) or self._ignore_case[found.group().casefold()], strg)
+
+    def clean(self, strg: str):
+        """
+        Applies the rules to one free text fragment from HPOSorter
+        Returns None if it should be dropped, otherwise (value, Process_Type) for get_hpo_or_error,
+        which is usually (expanded fragment, "Non_numeric") but a synonym for a code comes back as (digits, "Numeric")
+        """
+        key = normalise_phrase(strg)
+        if key in self.null_phrases:
+            return None
+        if key in self.synonyms:
+            return self.synonyms[key]
+        strg = self.expand(strg)
+        return self.synonyms.get(normalise_phrase(strg), (strg, "Non_numeric"))
+
+    def apply(self, numeric_values: list[str], non_numeric_values: list[str]) -> tuple[list[str], list[str]]:
+        """
+        Applies the rules to what HPOSorter split a cell into, and returns the new numeric and non_numeric lists
+        """
+        numeric_values = list(numeric_values)
+        cleaned = []
+        for strg in non_numeric_values:
+            result = self.clean(strg)
+            if result is None:
+                continue
+            value, Process_Type = result
+            if Process_Type == "Numeric":
+                numeric_values.append(value)
+            else:
+                cleaned.append(value)
+        return numeric_values, cleaned
+
+    def __len__(self) -> int:
+        return len(self.null_phrases) + len(self.abbreviations) + len(self.synonyms)
@@ -0,0 +1,305 @@
+"""
+HPO normalisation as a service: an asyncio batch API over the HPOFunc processing, a small stand-in
+HTTP server for it and a load test to see how it holds up
+Run the server with: python HPOService.py serve --port 8080
+and load test it with: python HPOService.py loadtest --port 8080 --rows 5000 --concurrency 16
+(loadtest without --port starts its own server)
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import HPOFunc
+
+def _resolve_tokens(keys: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    # Runs in the executor, one call per batch of new tokens rather than one per token
+    # Gives the term (or error) as text, and what it adds to Problems (see HPOFunc.problem_text)
+    results = [HPOFunc.get_hpo_or_error(strg, Process_Type=Process_Type) for strg, Process_Type in keys]
+    return [(str(result), HPOFunc.problem_text(result)) for result in results]
+
+def _sort_cells(cells: list) -> list[tuple[list[str], list[str]]]:
+    # Also runs in the executor, tokenising a big batch would hold up every other connection
+    return [HPOFunc.HPOSorter(cell) for cell in cells]
+
+def _token_key(strg: str, Process_Type: str) -> tuple[str, str]:
+    # get_hpo_or_error would normalise free text anyway, so "seizure" and "Seizure " only get looked up once
+    return (HPOFunc.normalise_non_numeric(strg) if Process_Type == "Non_numeric" else strg, Process_Type)
+
+class HPONormaliser:
+    """
+    Takes batches of cells from lots of callers at once and gives back (TermList, Problems) for each cell,
+    the same as process_column would
+    Tokens that are already being looked up for another batch aren't looked up again, the second batch
+    just waits for the first one's answer (and still gets it if the first batch is cancelled)
+    The tokenising and lookups run in an executor with max_workers threads (or processes with executor="process",
+    each of which has to load the ontology), so the event loop is never held up by the ontology
+    Backpressure: once max_pending cells are being worked on, new batches wait until there's room
+    (a single batch bigger than max_pending still gets in, on its own)
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 10000, executor: str = "thread"):
+        if executor == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        elif executor == "process":
+            self._executor = ProcessPoolExecutor(max_workers=max_workers, initializer=HPOFunc.preload)
+        else:
+            raise ValueError("executor must be 'thread' or 'process'")
+        self.max_pending = max_pending
+        self._pending = 0
+        self._room = None  # asyncio.Condition, made once there's an event loop running
+        self._in_flight = {}  # token key -> future for its answer
+        self._lookups = set()  # lookup tasks still running, so they don't get garbage collected
+        self.stats = {"batches": 0, "cells": 0, "tokens": 0, "tokens_looked_up": 0, "tokens_shared": 0, "waits": 0}
+
+    async def normalise(self, cells: list) -> list[tuple[str, str]]:
+        """
+        Returns (TermList, Problems) for every cell in cells, in the same order
+        """
+        if self._room is None:
+            self._room = asyncio.Condition()
+        async with self._room:
+            if self._pending and self._pending + len(cells) > self.max_pending:
+                self.stats["waits"] += 1
+                await self._room.wait_for(lambda: not self._pending or self._pending + len(cells) <= self.max_pending)
+            self._pending += len(cells)
+        try:
+            return await self._normalise(cells)
+        finally:
+            async with self._room:
+                self._pending -= len(cells)
+                self._room.notify_all()
+
+    async def _normalise(self, cells: list) -> list[tuple[str, str]]:
+        loop = asyncio.get_running_loop()
+        sorted_cells = await loop.run_in_executor(self._executor, _sort_cells, cells)
+        self.stats["batches"] += 1
+        self.stats["cells"] += len(cells)
+
+        # Work out which tokens nobody has asked for yet, and share the ones somebody has
+        keys = {_token_key(strg, Process_Type)
+                for numeric_values, non_numeric_values in sorted_cells
+                for values, Process_Type in [(numeric_values, "Numeric"), (non_numeric_values, "Non_numeric")]
+                for strg in values}
+        new = [key for key in keys if key not in self._in_flight]
+        self.stats["tokens"] += len(keys)
+        self.stats["tokens_looked_up"] += len(new)
+        self.stats["tokens_shared"] += len(keys) - len(new)
+        for key in new:
+            self._in_flight[key] = loop.create_future()
+        futures = {key: self._in_flight[key] for key in keys}
+
+        if new:
+            # Its own task, so other batches sharing these tokens still get them if this batch is cancelled
+            lookup = loop.create_task(self._look_up(new))
+            self._lookups.add(lookup)
+            lookup.add_done_callback(self._lookups.discard)
+        # Shielded, since cancelling this batch would otherwise cancel the futures other batches are waiting on
+        answers = {key: await asyncio.shield(future) for key, future in futures.items()}
+
+        # Same as HPOOutPutter then HPOSquisher
+        output = []
+        for numeric_values, non_numeric_values in sorted_cells:
+            numeric_answers = [answers[_token_key(strg, "Numeric")] for strg in numeric_values]
+            non_numeric_answers = [answers[_token_key(strg, "Non_numeric")] for strg in non_numeric_values]
+            Problems = HPOFunc.list_to_csv([problem for _, problem in numeric_answers + non_numeric_answers if problem is not None])
+            numeric_terms = [term for term, _ in numeric_answers]
+            non_numeric_terms = [term for term, _ in non_numeric_answers]
+            TermList = HPOFunc.HPOSquisher([term for term in numeric_terms if not term.startswith('Error:')],
+                                           [term for term in non_numeric_terms if not term.startswith('Error:')])
+            output.append((TermList, Problems))
+        return output
+
+    async def _look_up(self, new: list[tuple[str, str]]) -> None:
+        # Looks up new tokens in the executor and hands the answers to whoever is waiting for them
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self._executor, _resolve_tokens, new)
+        except Exception as error:
+            for key in new:
+                self._in_flight[key].set_exception(error)
+        else:
+            for key, result in zip(new, results):
+                self._in_flight[key].set_result(result)
+        finally:
+            for key in new:
+                future = self._in_flight.pop(key)
+                if not future.done():
+                    future.cancel()
+
+    def close(self) -> None:
+        """
+        Shuts down the executor
+        """
+        self._executor.shutdown()
+
+
+def _parse_cells(body: bytes) -> list:
+    # The cells from a {"cells": [...]} body, raising a ValueError for anything else
+    request = json.loads(body)
+    if not isinstance(request, dict) or "cells" not in request:
+        raise ValueError('Expected a JSON object with "cells"')
+    cells = request["cells"]
+    if not isinstance(cells, list) or not all(cell is None or isinstance(cell, str) for cell in cells):
+        raise ValueError('"cells" must be a list of strings (or nulls for empty cells)')
+    return cells
+
+class _BodyTooLarge(ValueError):
+    pass
+
+async def _handle_connection(normaliser: HPONormaliser, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                             max_body: int = 10_000_000) -> None:
+    # Just enough HTTP for POST /normalise with a JSON body of {"cells": [...]}, one request per connection
+    # Every request gets a response, a 400 for anything wrong with it (413 for a body over max_body bytes,
+    # which isn't read in at all) and a 500 if the normaliser fails
+    try:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            try:
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                raise ValueError("Content-Length must be a number") from None
+            if length < 0:
+                raise ValueError("Content-Length must be a number")
+            if length > max_body:
+                raise _BodyTooLarge(f"The body can't be more than {max_body} bytes, send the cells in smaller batches")
+            try:
+                body = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                raise ValueError("The body is shorter than its Content-Length") from None
+
+            if request_line[:2] != ["POST", "/normalise"]:
+                status, response = "404 Not Found", {"error": "POST cells to /normalise"}
+            else:
+                cells = _parse_cells(body)
+                results = await normaliser.normalise(cells)
+                status, response = "200 OK", {"results": [{"TermList": terms, "Problems": problems} for terms, problems in results]}
+        except _BodyTooLarge as error:
+            status, response = "413 Payload Too Large", {"error": str(error)}
+        except ValueError as error:
+            status, response = "400 Bad Request", {"error": str(error)}
+        except Exception as error:
+            status, response = "500 Internal Server Error", {"error": str(error)}
+
+        payload = json.dumps(response).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + payload)
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_server(normaliser: HPONormaliser, host: str = "127.0.0.1", port: int = 8080,
+                       max_body: int = 10_000_000) -> asyncio.Server:
+    """
+    Starts the stand-in HTTP server for normaliser (port=0 picks a free port, see server.sockets[0].getsockname())
+    Requests with a body bigger than max_body bytes are turned away with a 413 before it's read
+    """
+    return await asyncio.start_server(lambda reader, writer: _handle_connection(normaliser, reader, writer, max_body), host, port)
+
+async def post_cells(host: str, port: int, cells: list) -> list[dict]:
+    """
+    Sends a batch of cells to the server and returns its results
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        body = json.dumps({"cells": cells}).encode("utf-8")
+        writer.write(f"POST /normalise HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1.1 200"):
+        raise RuntimeError("Request failed: " + head.split(b"\r\n")[0].decode("latin-1"))
+    return json.loads(payload)["results"]
+
+async def load_test(host: str, port: int, cells: list, batch_size: int = 50, concurrency: int = 8) -> dict:
+    """
+    Sends cells to the server in batches of batch_size, with concurrency batches on the go at once,
+    and returns the throughput (cells per second) and the latency percentiles of the batches
+    """
+    batches = [cells[i:i + batch_size] for i in range(0, len(cells), batch_size)]
+    queue = asyncio.Queue()
+    for batch in batches:
+        queue.put_nowait(batch)
+    latencies = []
+
+    async def client() -> None:
+        while not queue.empty():
+            batch = queue.get_nowait()
+            start = time.perf_counter()
+            await post_cells(host, port, batch)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    total = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1e3
+    result = {"cells": len(cells), "batches": len(batches), "batch_size": batch_size, "concurrency": concurrency,
+              "total_s": total, "cells_per_s": len(cells) / total}
+    for percentile in [50, 95, 99]:
+        result[f"p{percentile}_ms"] = float(np.percentile(latencies_ms, percentile)) if len(latencies_ms) else 0.0
+    result["max_ms"] = float(latencies_ms.max()) if len(latencies_ms) else 0.0
+    return result
+
+async def _serve(args) -> None:
+    HPOFunc.preload()
+    normaliser = HPONormaliser(max_workers=args.workers, max_pending=args.max_pending, executor=args.executor)
+    server = await start_server(normaliser, args.host, args.port, args.max_body)
+    print(f"Serving on http://{args.host}:{args.port}/normalise")
+    async with server:
+        await server.serve_forever()
+
+async def _load_test(args) -> None:
+    import HPOBench
+
+    # Empty cells go as null, since JSON doesn't have NaN
+    cells = [None if pd.isna(cell) else cell for cell in HPOBench.generate_synthetic_cells(args.rows, args.seed)]
+    server = None
+    port = args.port
+    if port is None:
+        HPOFunc.preload()
+        normaliser = HPONormaliser(max_workers=args.workers, max_pending=args.max_pending, executor=args.executor)
+        server = await start_server(normaliser, args.host, 0, args.max_body)
+        port = server.sockets[0].getsockname()[1]
+    try:
+        result = await load_test(args.host, port, cells, args.batch_size, args.concurrency)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            print("Normaliser stats:", normaliser.stats)
+            normaliser.close()
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HPO normalisation service")
+    parser.add_argument("mode", choices=["serve", "loadtest"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Port to serve on (or load test), loadtest starts its own server if not given")
+    parser.add_argument("--workers", type=int, default=4, help="Executor workers for the ontology lookups")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    parser.add_argument("--max-pending", type=int, default=10000, help="Cells in progress before new batches have to wait")
+    parser.add_argument("--max-body", type=int, default=10_000_000, help="Biggest request body (in bytes) the server will read")
+    parser.add_argument("--rows", type=int, default=5000, help="Synthetic cells to send in the load test")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.mode == "serve":
+        if args.port is None:
+            args.port = 8080
+        asyncio.run(_serve(args))
+    else:
+        asyncio.run(_load_test(args))
@@ -0,0 +1,170 @@
+"""
+Semantic similarity between every pair of patients in a cohort, using information content (Resnik or Lin)
+combined over the patients' terms with funSimAvg or BMA, the same as pyhpo's HPOSet.similarity
+but done in blocks of numpy operations rather than a Python loop over every pair of terms
+Needs scipy, same as HPOMatrix
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import HPOFunc
+import HPOMatrix
+
+METHODS = ["resnik", "lin"]
+COMBINES = ["funSimAvg", "BMA"]
+
+class HPOSimilarity:
+    """
+    Precomputes what's needed to compare terms: the information content (IC) of every term
+    and every term's ancestors (from an HPOAncestorClosure), so it's done once rather than for every pair
+    information_content has one value per term, in the same order as closure.terms
+    Build one with from_annotations (IC from pyhpo's OMIM/Orpha/gene annotations)
+    or from_cohort (IC from how often each term turns up in the cohort itself)
+    """
+
+    def __init__(self, information_content: np.ndarray, closure: HPOMatrix.HPOAncestorClosure = None, method: str = "resnik"):
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {METHODS}")
+        self.closure = closure if closure is not None else HPOMatrix.get_ancestor_closure()
+        self.information_content = np.asarray(information_content, dtype=np.float32)
+        self.method = method
+
+    @classmethod
+    def from_annotations(cls, kind: str = "omim", **kwargs) -> "HPOSimilarity":
+        """
+        Uses the information content pyhpo works out from its annotations (kind is "omim", "orpha", "decipher" or "gene"),
+        which gives the same answers as pyhpo's own similarity scores
+        """
+        closure = kwargs.pop("closure", None) or HPOMatrix.get_ancestor_closure()
+        ontology = HPOFunc.get_ontology()
+        information_content = [ontology[int(term_id)].information_content[kind] for term_id in closure.terms]
+        return cls(information_content, closure, **kwargs)
+
+    @classmethod
+    def from_cohort(cls, term_matrix: HPOMatrix.HPOTermMatrix, **kwargs) -> "HPOSimilarity":
+        """
+        Works out the information content from the cohort: -log(fraction of patients with the term or one below it)
+        Patients with no terms at all are left out, and terms nobody has get 0
+        """
+        propagated = term_matrix.propagate()
+        counts = np.asarray(propagated.matrix.sum(axis=0)).ravel()
+        patients = np.count_nonzero(np.diff(propagated.matrix.indptr))
+        with np.errstate(divide="ignore"):
+            information_content = np.where(counts > 0, -np.log(counts / max(patients, 1)), 0.0)
+        return cls(information_content, term_matrix.closure, **kwargs)
+
+    def term_similarity(self, ids) -> np.ndarray:
+        """
+        Similarity between every pair of the given integer term IDs, as a square float32 array
+        Resnik is the IC of their most informative common ancestor, Lin is that divided by the average IC of the two terms
+        """
+        rows = self.closure.columns(ids)
+        # Only the ancestors of these terms matter, so everything is worked out over just those
+        ancestors = self.closure.matrix[rows].tocsr()
+        used, positions = np.unique(ancestors.indices, return_inverse=True)
+        # Which of those ancestors each term has, with a spare column on the end for padding
+        present = np.zeros((len(rows), len(used) + 1), dtype=bool)
+        present[np.repeat(np.arange(len(rows)), np.diff(ancestors.indptr)), positions] = True
+        used_ic = np.append(self.information_content[used], np.float32(0))
+        padded = _pad_rows(np.split(positions, ancestors.indptr[1:-1]), len(used))
+
+        similarity = np.empty((len(rows), len(rows)), dtype=np.float32)
+        # The IC of every ancestor a term shares with every other term, taking the biggest,
+        # a block of terms at a time (sized to keep each block to about 64MB)
+        block_size = max(1, (1 << 24) // max(len(rows) * padded.shape[1], 1))
+        for start in range(0, len(rows), block_size):
+            block = padded[start:start + block_size]
+            shared = present[:, block] * used_ic[block]
+            similarity[:, start:start + block_size] = shared.max(axis=2, initial=0)
+
+        if self.method == "lin":
+            term_ic = self.information_content[rows]
+            total = term_ic[:, None] + term_ic[None, :]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                similarity = np.where(total > 0, 2 * similarity / total, 0).astype(np.float32)
+        return similarity
+
+    def cohort_similarity(self, patients, combine: str = "funSimAvg", block_size: int = 256, workers: int = 1, out: np.ndarray = None) -> np.ndarray:
+        """
+        Similarity between every pair of patients, as an N x N float32 array (row/column order is the same as patients)
+        patients is an HPOTermMatrix (not propagated) or a processed column of TermLists or integer term ID arrays
+        combine is how the term similarities are put together for a pair of patients:
+        "funSimAvg" averages each patient's best matches and takes the mean of the two averages,
+        "BMA" averages all the best matches from both sides together
+        Patients are done block_size at a time (more uses more memory but is quicker), spread over
+        workers threads, and a numpy memmap can be given as out for cohorts too big for memory
+        Patients with no terms have a similarity of 0 to everyone
+        """
+        if combine not in COMBINES:
+            raise ValueError(f"combine must be one of {COMBINES}")
+        if not isinstance(patients, HPOMatrix.HPOTermMatrix):
+            patients = HPOMatrix.build_term_matrix(patients, closure=self.closure)
+        if patients.propagated:
+            raise ValueError("cohort_similarity needs the patients' own terms, not propagated ones")
+
+        # Just the terms somebody in the cohort has
+        matrix = patients.matrix.tocsc()
+        used = np.flatnonzero(np.diff(matrix.indptr))
+        matrix = matrix[:, used].tocsr()
+        n_patients = matrix.shape[0]
+        sizes = np.diff(matrix.indptr)
+        if out is None:
+            out = np.empty((n_patients, n_patients), dtype=np.float32)
+
+        term_similarity = self.term_similarity(self.closure.terms[used])
+        # Spare column of zeros on the end for padding patients with fewer terms
+        term_similarity = np.hstack([term_similarity, np.zeros((len(used), 1), dtype=np.float32)])
+        patient_terms = np.split(matrix.indices, matrix.indptr[1:-1])
+
+        def best_matches(start: int) -> None:
+            # best[t, j] is how well term t is matched by the best of patient j's terms
+            # and out[i, j] ends up as the total of patient i's best matches in patient j
+            block = _pad_rows(patient_terms[start:start + block_size], len(used))
+            best = term_similarity[:, block].max(axis=2, initial=0)
+            out[:, start:start + block_size] = matrix @ best
+
+        starts = range(0, n_patients, block_size)
+        if workers <= 1:
+            for start in starts:
+                best_matches(start)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(best_matches, starts))
+
+        # Put the two directions together, a pair of blocks at a time
+        for start1 in starts:
+            rows = slice(start1, start1 + block_size)
+            for start2 in range(start1, n_patients, block_size):
+                columns = slice(start2, start2 + block_size)
+                totals1 = out[rows, columns].astype(np.float64)
+                totals2 = out[columns, rows].T.astype(np.float64)
+                sizes1 = sizes[rows][:, None].astype(np.float64)
+                sizes2 = sizes[columns][None, :].astype(np.float64)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    if combine == "funSimAvg":
+                        combined = (totals1 / sizes1 + totals2 / sizes2) / 2
+                    else:
+                        combined = (totals1 + totals2) / (sizes1 + sizes2)
+                combined = np.where((sizes1 > 0) & (sizes2 > 0), combined, 0)
+                out[rows, columns] = combined
+                out[columns, rows] = combined.T
+        return out
+
+    def cohort_similarity_frame(self, patients, **kwargs) -> pd.DataFrame:
+        """
+        cohort_similarity as a dataframe, with the patients' index as the rows and columns
+        """
+        if not isinstance(patients, HPOMatrix.HPOTermMatrix):
+            patients = HPOMatrix.build_term_matrix(patients, closure=self.closure)
+        return pd.DataFrame(self.cohort_similarity(patients, **kwargs), index=patients.index, columns=patients.index)
+
+
+def _pad_rows(rows: list[np.ndarray], padding: int) -> np.ndarray:
+    # Stacks ragged rows into one array, filling the short ones with padding
+    width = max((len(row) for row in rows), default=0)
+    padded = np.full((len(rows), max(width, 1)), padding, dtype=np.int64)
+    for i, row in enumerate(rows):
+        padded[i, :len(row)] = row
+    return padded
@@ -0,0 +1,295 @@
+"""
+A prebuilt snapshot of just the parts of the ontology the pipeline uses (IDs, names, synonyms, parents,
+ancestors and depths) saved as flat numpy arrays, so a worker can start up by memory mapping a few files
+instead of spending ~40s parsing the HPO with pyhpo, and lots of workers share the one copy the OS has
+cached rather than each building their own object graph
+Build it once with: python HPOSnapshot.py hpo_snapshot
+then either call HPOFunc.use_ontology(HPOSnapshot.HPOSnapshot.load("hpo_snapshot")) or set HPO_SNAPSHOT=hpo_snapshot
+in the environment before the workers start
+(it doesn't have the disease/gene annotations, so HPOSimilarity.from_annotations still needs pyhpo)
+"""
+import argparse
+import hashlib
+import json
+import os
+from collections import deque
+
+import numpy as np
+
+# Every array that gets saved, as <name>.npy in the snapshot folder
+ARRAYS = ["ids", "obsolete", "depths", "name_data", "name_offsets", "synonym_data", "synonym_offsets", "synonym_indptr",
+          "parent_indptr", "parent_indices", "ancestor_indptr", "ancestor_indices", "lookup_hashes", "lookup_terms"]
+
+def _hash_phrase(phrase: str) -> int:
+    # Stable between processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(phrase.encode("utf-8"), digest_size=8).digest(), "little")
+
+def _pack_strings(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    # All the strings as one UTF-8 buffer, and where each one starts and ends in it
+    encoded = [strg.encode("utf-8") for strg in strings]
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8).copy(), _indptr(encoded)
+
+def _indptr(rows: list) -> np.ndarray:
+    # Where each row starts and ends once the rows are all put end to end
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(row) for row in rows])
+    return indptr
+
+def _csr(rows: list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
+    return _indptr(rows), np.array([value for row in rows for value in row], dtype=np.int32)
+
+class HPOSnapshotTerm:
+    """
+    Stands in for a pyhpo HPOTerm, with the bits of it the pipeline uses (id, name, synonym, parents,
+    all_parents, is_obsolete), worked out from the snapshot's arrays when they're asked for
+    """
+    __slots__ = ("_snapshot", "_position")
+
+    def __init__(self, snapshot: "HPOSnapshot", position: int):
+        self._snapshot = snapshot
+        self._position = position
+
+    @property
+    def index(self) -> int:
+        return int(self._snapshot.ids[self._position])
+
+    @property
+    def id(self) -> str:
+        return f"HP:{self.index:07d}"
+
+    @property
+    def name(self) -> str:
+        return self._snapshot._string("name", self._position)
+
+    @property
+    def synonym(self) -> list[str]:
+        start, end = self._snapshot.synonym_indptr[self._position:self._position + 2]
+        return [self._snapshot._string("synonym", i) for i in range(start, end)]
+
+    @property
+    def parents(self) -> set["HPOSnapshotTerm"]:
+        return self._snapshot._terms("parent", self._position)
+
+    @property
+    def all_parents(self) -> set["HPOSnapshotTerm"]:
+        return self._snapshot._terms("ancestor", self._position)
+
+    @property
+    def is_obsolete(self) -> bool:
+        return bool(self._snapshot.obsolete[self._position])
+
+    @property
+    def depth(self) -> int:
+        # Fewest steps up to HP:0000001, -1 for obsolete terms that aren't connected to it
+        return int(self._snapshot.depths[self._position])
+
+    def __int__(self) -> int:
+        return self.index
+
+    def __hash__(self) -> int:
+        return self.index
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, HPOSnapshotTerm) and self.index == other.index
+
+    def __lt__(self, other) -> bool:
+        return self.index < int(other)
+
+    def __str__(self) -> str:
+        return f"{self.id} | {self.name}"
+
+    def __repr__(self) -> str:
+        return f"HPOSnapshotTerm(id='{self.id}', name='{self.name}')"
+
+
+class HPOSnapshot:
+    """
+    The snapshot itself, which can be used anywhere the pipeline wants the pyhpo Ontology:
+    get_hpo_object(query) finds a term by integer ID, "HP:..." code, name or synonym the same way pyhpo does
+    (names beat synonyms, and a synonym shared by several terms goes to the same one pyhpo picks),
+    snapshot[term_id] gets a term by integer ID, and it can be iterated over and has a len
+    Names and synonyms are found by binary search over sorted hashes, so nothing has to be built when it's loaded
+    Terms are kept in order of ID, and parents/ancestors are CSR arrays of positions in that order
+    """
+
+    # Tells HPOFunc not to build its own index of names and synonyms, since get_hpo_object is already quick for them
+    indexed_names = True
+
+    def __init__(self, arrays: dict, version: str):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.version = version
+
+    @classmethod
+    def build(cls, ontology=None) -> "HPOSnapshot":
+        """
+        Builds a snapshot from the pyhpo ontology (HPOFunc's, if one isn't given)
+        """
+        import HPOFunc
+        if ontology is None:
+            ontology = HPOFunc.get_ontology()
+        terms = sorted(ontology, key=int)
+        ids = np.array([int(term) for term in terms], dtype=np.int32)
+        positions = {int(term): position for position, term in enumerate(terms)}
+
+        arrays = {"ids": ids, "obsolete": np.array([term.is_obsolete for term in terms], dtype=bool)}
+        arrays["name_data"], arrays["name_offsets"] = _pack_strings([term.name for term in terms])
+        synonyms = [list(term.synonym) for term in terms]
+        arrays["synonym_data"], arrays["synonym_offsets"] = _pack_strings([synonym for row in synonyms for synonym in row])
+        arrays["synonym_indptr"] = _indptr(synonyms)
+        parents = [sorted(positions[int(parent)] for parent in term.parents) for term in terms]
+        arrays["parent_indptr"], arrays["parent_indices"] = _csr(parents)
+        arrays["ancestor_indptr"], arrays["ancestor_indices"] = _csr(
+            [sorted(positions[int(ancestor)] for ancestor in term.all_parents) for term in terms])
+
+        # Breadth first down from the root, so each term's depth is the fewest steps up to it
+        children = [[] for _ in terms]
+        for position, row in enumerate(parents):
+            for parent in row:
+                children[parent].append(position)
+        depths = np.full(len(terms), -1, dtype=np.int32)
+        if 1 in positions:
+            depths[positions[1]] = 0
+            queue = deque([positions[1]])
+            while queue:
+                position = queue.popleft()
+                for child in children[position]:
+                    if depths[child] < 0:
+                        depths[child] = depths[position] + 1
+                        queue.append(child)
+        arrays["depths"] = depths
+
+        # Same rules as pyhpo's synonym_match: a name always wins, otherwise the first term
+        # (in the ontology's own order) with that synonym
+        lookup = {}
+        for term in ontology:
+            lookup.setdefault(term.name, positions[int(term)])
+        for term in ontology:
+            for synonym in term.synonym:
+                lookup.setdefault(synonym, positions[int(term)])
+        hashes = np.array([_hash_phrase(phrase) for phrase in lookup], dtype=np.uint64)
+        order = np.argsort(hashes, kind="stable")
+        arrays["lookup_hashes"] = hashes[order]
+        arrays["lookup_terms"] = np.array(list(lookup.values()), dtype=np.int32)[order]
+
+        return cls(arrays, HPOFunc.ontology_version())
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "HPOSnapshot":
+        """
+        Loads a snapshot saved in the folder at path, memory mapped (read only) unless mmap=False
+        """
+        with open(os.path.join(path, "snapshot.json")) as f:
+            info = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None, allow_pickle=False)
+                  for name in ARRAYS}
+        return cls(arrays, info["version"])
+
+    @classmethod
+    def load_or_build(cls, path: str) -> "HPOSnapshot":
+        """
+        Loads the snapshot saved at path, or builds one and saves it there if there isn't one
+        for the current HPO release
+        """
+        import HPOFunc
+        info_path = os.path.join(path, "snapshot.json")
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                if json.load(f)["version"] == HPOFunc.ontology_version():
+                    return cls.load(path)
+        snapshot = cls.build()
+        snapshot.save(path)
+        return snapshot
+
+    def save(self, path: str) -> None:
+        """
+        Saves every array as a .npy file in the folder at path, with snapshot.json (written last) saying
+        which HPO release it's from
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), np.asarray(getattr(self, name)), allow_pickle=False)
+        with open(os.path.join(path, "snapshot.json"), "w") as f:
+            json.dump({"version": self.version, "terms": len(self)}, f)
+
+    def _string(self, kind: str, i: int) -> str:
+        offsets = getattr(self, kind + "_offsets")
+        return bytes(getattr(self, kind + "_data")[offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+    def _terms(self, kind: str, position: int) -> set[HPOSnapshotTerm]:
+        indptr = getattr(self, kind + "_indptr")
+        indices = getattr(self, kind + "_indices")[indptr[position]:indptr[position + 1]]
+        return {HPOSnapshotTerm(self, int(i)) for i in indices}
+
+    def _position(self, term_id: int):
+        position = int(np.searchsorted(self.ids, term_id))
+        if position < len(self.ids) and self.ids[position] == term_id:
+            return position
+        return None
+
+    def _find_phrase(self, phrase: str):
+        # Binary search for the phrase's hash, then check it really is that phrase
+        key = np.uint64(_hash_phrase(phrase))
+        start = int(np.searchsorted(self.lookup_hashes, key, side="left"))
+        end = int(np.searchsorted(self.lookup_hashes, key, side="right"))
+        for i in range(start, end):
+            position = int(self.lookup_terms[i])
+            term = HPOSnapshotTerm(self, position)
+            if term.name == phrase or phrase in term.synonym:
+                return term
+        return None
+
+    def get_hpo_object(self, query) -> HPOSnapshotTerm:
+        """
+        Finds a term by integer ID (1250), "HP:..." code, name or synonym, the same as pyhpo's get_hpo_object
+        Raises a RuntimeError if there isn't one (and a ValueError for a code that isn't a number)
+        """
+        term = None
+        if isinstance(query, str):
+            if query.startswith("HP:"):
+                try:
+                    term_id = int(query.split("!")[0].split(":")[1].strip())
+                except ValueError as error:
+                    raise ValueError(f"Invalid id: {query}") from error
+                position = self._position(term_id)
+                term = None if position is None else HPOSnapshotTerm(self, position)
+            else:
+                term = self._find_phrase(query)
+        elif isinstance(query, (int, np.integer)):
+            position = self._position(int(query))
+            term = None if position is None else HPOSnapshotTerm(self, position)
+        else:
+            raise TypeError('Invalid type {} for parameter "query"'.format(type(query)))
+        if term is None:
+            raise RuntimeError("Unknown HPO term")
+        return term
+
+    def ancestor_ids(self, term_id: int) -> np.ndarray:
+        """
+        Integer IDs of all the ancestors of a term (not including itself), without making any term objects
+        """
+        position = self._position(int(term_id))
+        if position is None:
+            raise KeyError(f"No HPOTerm for index {term_id}")
+        return self.ids[self.ancestor_indices[self.ancestor_indptr[position]:self.ancestor_indptr[position + 1]]]
+
+    def __getitem__(self, term_id: int) -> HPOSnapshotTerm:
+        position = self._position(int(term_id))
+        if position is None:
+            raise KeyError(f"No HPOTerm for index {term_id}")
+        return HPOSnapshotTerm(self, position)
+
+    def __iter__(self):
+        return (HPOSnapshotTerm(self, position) for position in range(len(self.ids)))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a memory mappable snapshot of the HPO for the pipeline's workers")
+    parser.add_argument("path", help="Folder to save the snapshot in")
+    args = parser.parse_args()
+    snapshot = HPOSnapshot.build()
+    snapshot.save(args.path)
+    print(f"Saved {len(snapshot)} terms from {snapshot.version} to {args.path}")
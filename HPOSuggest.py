@@ -0,0 +1,152 @@
+"""
+Suggestions for the free text get_hpo_or_error couldn't match, so the problems can be triaged from a ranked
+list of likely terms instead of searching the HPO website for each one by hand
+Every name and synonym is turned into a TF-IDF vector of its character n-grams once, and a whole batch of
+queries is scored against all of them with one sparse matrix product
+Needs scipy, same as HPOMatrix
+"""
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import HPOFunc
+import HPOMatch
+
+class HPOTermSuggester:
+    """
+    Index for finding the HPO terms whose names or synonyms look most like a query
+    Phrases and queries are compared by the cosine similarity of their character n-gram TF-IDF vectors
+    (the same padded n-grams HPOTermMatcher uses), so n-grams that turn up in lots of phrases, like "abn",
+    count for less than rare ones
+    A term's score is the score of whichever of its name or synonyms is closest
+    """
+
+    def __init__(self, phrases: list[str], term_ids: list[int], version: str):
+        self.phrases = phrases
+        self.term_ids = np.array(term_ids, dtype=np.int32)
+        self.version = version
+
+        phrase_grams = [HPOMatch._grams(phrase) for phrase in phrases]
+        self.vocabulary = {gram: i for i, gram in enumerate(sorted(set().union(*phrase_grams)))}
+        rows = np.repeat(np.arange(len(phrases)), [len(grams) for grams in phrase_grams])
+        columns = np.array([self.vocabulary[gram] for grams in phrase_grams for gram in grams], dtype=np.int32)
+        counts = sparse.csr_matrix((np.ones(len(columns), dtype=np.float32), (rows, columns)),
+                                   shape=(len(phrases), len(self.vocabulary)))
+
+        # Smoothed IDF, and anything a query has that no phrase does counts as if it were in none of them
+        document_frequency = np.bincount(columns, minlength=len(self.vocabulary))
+        self.idf = (np.log((1 + len(phrases)) / (1 + document_frequency)) + 1).astype(np.float32)
+        self.unseen_idf = np.float32(np.log(1 + len(phrases)) + 1)
+        # Stored the other way round (n-gram x phrase) since that's how the queries get multiplied by it
+        self._matrix = _normalise_rows(counts.multiply(self.idf[None, :]).tocsr()).T.tocsr()
+
+    @classmethod
+    def build(cls) -> "HPOTermSuggester":
+        """
+        Builds the index from the names and synonyms of every (non-obsolete) term in the ontology
+        """
+        phrases, term_ids = HPOMatch.term_phrases()
+        return cls(phrases, term_ids, HPOFunc.ontology_version())
+
+    @classmethod
+    def load_or_build(cls, path: str) -> "HPOTermSuggester":
+        """
+        Loads a saved index from path, or builds one and saves it there if there isn't one
+        for the current HPO release
+        """
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                suggester = pickle.load(f)
+            if isinstance(suggester, cls) and suggester.version == HPOFunc.ontology_version():
+                return suggester
+        suggester = cls.build()
+        suggester.save(path)
+        return suggester
+
+    def save(self, path: str) -> None:
+        """
+        Saves the whole index (pickled) so it can be loaded again without the ontology
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _query_matrix(self, queries: list[str]) -> sparse.csr_matrix:
+        # TF-IDF vectors for the queries, normalised including the n-grams no phrase has
+        # (which don't go in the matrix since they can't match anything, but do make the query less like everything)
+        rows = []
+        columns = []
+        norms = np.zeros(len(queries), dtype=np.float32)
+        for row, query in enumerate(queries):
+            query = HPOMatch.normalise_phrase(query)
+            if not query:
+                continue
+            grams = HPOMatch._grams(query)
+            found = [self.vocabulary[gram] for gram in grams if gram in self.vocabulary]
+            norms[row] = np.sqrt(np.sum(self.idf[found] ** 2) + (len(grams) - len(found)) * self.unseen_idf ** 2)
+            rows.extend([row] * len(found))
+            columns.extend(found)
+        columns = np.array(columns, dtype=np.int32)
+        rows = np.array(rows, dtype=np.int32)
+        weights = self.idf[columns] / norms[rows] if len(rows) else np.array([], dtype=np.float32)
+        return sparse.csr_matrix((weights, (rows, columns)), shape=(len(queries), len(self.vocabulary)))
+
+    def suggest_ids(self, queries: list[str], k: int = 5, min_score: float = 0.3, batch_size: int = 1000) -> list[list[tuple[int, float]]]:
+        """
+        Returns up to k (integer term ID, score) suggestions for each query, best first,
+        leaving out anything scoring under min_score (scores go from 0 to 1, 1 being the same n-grams, rounded to 4 places)
+        Queries are scored batch_size at a time, bigger batches are quicker but use more memory
+        Queries that only differ in case, punctuation or spacing are only scored once
+        """
+        keys = [HPOMatch.normalise_phrase(query) for query in queries]
+        unique = list(dict.fromkeys(keys))
+        suggestions = {}
+        for start in range(0, len(unique), batch_size):
+            batch = unique[start:start + batch_size]
+            scores = (self._query_matrix(batch) @ self._matrix).tocsr()
+            for row in range(scores.shape[0]):
+                row_scores = scores.data[scores.indptr[row]:scores.indptr[row + 1]]
+                row_terms = self.term_ids[scores.indices[scores.indptr[row]:scores.indptr[row + 1]]]
+                keep = row_scores >= min_score - 1e-6
+                row_scores = row_scores[keep]
+                row_terms = row_terms[keep]
+                # Best first (ties to the lowest ID), then only the best phrase for each term
+                order = np.lexsort((row_terms, -row_scores))
+                row_terms = row_terms[order]
+                row_scores = row_scores[order]
+                _, first = np.unique(row_terms, return_index=True)
+                suggestions[batch[row]] = [(int(row_terms[i]), round(min(float(row_scores[i]), 1.0), 4)) for i in np.sort(first)[:k]]
+        return [suggestions[key] for key in keys]
+
+    def suggest(self, queries: list[str], k: int = 5, min_score: float = 0.3, batch_size: int = 1000) -> list[list[tuple]]:
+        """
+        suggest_ids, but with the HPOTerm for each suggestion instead of its integer ID
+        """
+        ontology = HPOFunc.get_ontology()
+        return [[(ontology[term_id], score) for term_id, score in row]
+                for row in self.suggest_ids(queries, k, min_score, batch_size)]
+
+    def suggest_frame(self, queries: list[str], k: int = 5, min_score: float = 0.3, batch_size: int = 1000) -> pd.DataFrame:
+        """
+        The suggestions as a long dataframe, one row per suggestion, with Query, Rank (1 is best), Term and Score columns
+        Queries with no suggestions get a single row with an empty Term and a Score of 0
+        """
+        records = []
+        for query, row in zip(queries, self.suggest(queries, k, min_score, batch_size)):
+            if not row:
+                records.append((query, 0, "", 0.0))
+            for rank, (term, score) in enumerate(row, 1):
+                records.append((query, rank, str(term), score))
+        return pd.DataFrame(records, columns=["Query", "Rank", "Term", "Score"])
+
+    def __len__(self) -> int:
+        return len(self.phrases)
+
+
+def _normalise_rows(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    # Scales every row to length 1, so a dot product of two rows is their cosine similarity
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import pandas as pd
+import HPOFunc
+import HPOArrow
+import HPOPipeline
+from testdata import make_test_file
+
+def test_process_file_table():
+    with tempfile.TemporaryDirectory() as folder:
+        input_path = make_test_file(folder)
+        csv_path = os.path.join(folder, "output.csv")
+        HPOPipeline.process_file(input_path, csv_path, ["Doctor", "Parent"])
+        expect = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+
+        # Test case 1: Parquet and Arrow give the same lists as splitting up the CSV version
+        for name in ["output.parquet", "output.arrow"]:
+            output_path = os.path.join(folder, name)
+            rows = HPOArrow.process_file_table(input_path, output_path, ["Doctor", "Parent"], chunksize=3)
+            assert rows == 7, "Expected: 7 Got: " + str(rows)
+            assert not os.path.exists(output_path + ".tmp"), "Expected the temporary file to be moved into place"
+            table = HPOArrow.read_table(output_path)
+            assert str(table.schema.field("Doctor_TermIds").type.value_type) == "int32", "Expected: int32 Got: " + str(table.schema.field("Doctor_TermIds").type)
+            output = table.to_pandas()
+            for column in ["Doctor", "Parent"]:
+                output_ids = [list(ids) for ids in output[column + "_TermIds"]]
+                expect_ids = [list(HPOFunc.parse_term_ids(terms)) for terms in expect[column + "_TermList"]]
+                assert output_ids == expect_ids, "Expected: " + str(expect_ids) + " Got: " + str(output_ids)
+                output_terms = ["; ".join(terms) for terms in output[column + "_TermList"]]
+                assert output_terms == list(expect[column + "_TermList"]), "Expected: " + str(list(expect[column + "_TermList"])) + " Got: " + str(output_terms)
+                output_problems = ["; ".join(problems) for problems in output[column + "_Problems"]]
+                assert output_problems == list(expect[column + "_Problems"]), "Expected: " + str(list(expect[column + "_Problems"])) + " Got: " + str(output_problems)
+            assert list(output["PatientID"]) == list(expect["PatientID"]), "Expected: " + str(list(expect["PatientID"])) + " Got: " + str(list(output["PatientID"]))
+
+        # Test case 2: Just the columns asked for
+        output2 = HPOArrow.read_table(os.path.join(folder, "output.parquet"), columns=["PatientID", "Doctor_TermIds"])
+        assert output2.column_names == ["PatientID", "Doctor_TermIds"], "Expected: ['PatientID', 'Doctor_TermIds'] Got: " + str(output2.column_names)
+
+def test_write_scores():
+    df = pd.DataFrame({"Doctor": ["HP:0001263 | Global developmental delay", pd.NA, "HP:0001250 | Seizure; HP:0000717 | Autism"],
+                       "Parent": ["HP:0000750 | Delayed speech and language development", "HP:0001250 | Seizure", "HP:0001250 | Seizure"]})
+    with tempfile.TemporaryDirectory() as folder:
+        # Test case 1: Codes as strings from score_cohort, and integer IDs from score_cohort_ids
+        for scores, term_ids in [(HPOFunc.score_cohort(df, "Doctor", "Parent"), False),
+                                 (HPOFunc.score_cohort_ids(df.apply(lambda column: column.map(HPOFunc.parse_term_ids)), "Doctor", "Parent"), True)]:
+            path = os.path.join(folder, "scores.parquet")
+            HPOArrow.write_scores(scores, path, term_ids=term_ids)
+            output = HPOArrow.read_table(path).to_pandas()
+            for column in HPOFunc.SCORE_COLUMNS:
+                output_values = [list(value) if column.endswith("_Codes") else value for value in output[column]]
+                assert output_values == list(scores[column]), "Expected: " + str(list(scores[column])) + " Got: " + str(output_values)
+            assert list(output["Row"]) == ["0", "1", "2"], "Expected: ['0', '1', '2'] Got: " + str(list(output["Row"]))
+
+        # Test case 2: The list type comes from the caller, so rows without any codes get the same schema
+        empty = df.iloc[[1]].copy()
+        empty["Parent"] = pd.NA
+        for term_ids, expect in [(False, "dictionary<values=string, indices=int32, ordered=0>"), (True, "int32")]:
+            scorer = HPOFunc.score_cohort_ids if term_ids else HPOFunc.score_cohort
+            frame = empty.apply(lambda column: column.map(HPOFunc.parse_term_ids)) if term_ids else empty
+            table = HPOArrow.scores_table(scorer(frame, "Doctor", "Parent"), term_ids)
+            for column in ["Doctor_Codes", "Parent_Codes"]:
+                output2 = str(table.schema.field(column).type.value_type)
+                assert output2 == expect, "Expected: " + expect + " Got: " + output2
+
+print("Testing process_file_table")
+test_process_file_table()
+
+print("Testing write_scores")
+test_write_scores()
@@ -0,0 +1,48 @@
+import re
+
+import HPOFunc
+import HPOBench
+
+def test_benchmark_HPOSorter():
+    # Just check it runs and gives back sensible numbers, the timings themselves will be all over the place
+    output = HPOBench.benchmark_HPOSorter(number=10)
+    for key in ["legacy_us_per_cell", "HPOSorter_us_per_cell", "speedup"]:
+        assert key in output, "Expected " + key + " in: " + str(output)
+        assert output[key] > 0, "Expected " + key + " to be positive Got: " + str(output[key])
+
+print("Testing benchmark_HPOSorter")
+test_benchmark_HPOSorter()
+
+def test_generate_synthetic_cells():
+    cells = HPOBench.generate_synthetic_cells(200, seed=1)
+    assert len(cells) == 200, "Expected: 200 Got: " + str(len(cells))
+    assert cells.equals(HPOBench.generate_synthetic_cells(200, seed=1)), "Expected the same cells for the same seed"
+    assert not cells.equals(HPOBench.generate_synthetic_cells(200, seed=2)), "Expected different cells for a different seed"
+    text = " ".join(cells.dropna())
+    for prefix in ["HP:", "hp:", "Hp:", "hP:"]:
+        assert prefix in text, "Expected " + prefix + " somewhere in: " + text[:200]
+    assert cells.isna().any(), "Expected some empty cells"
+    assert cells.str.lower().isin(HPOFunc.NullList).any(), "Expected some cells from NullList"
+
+def test_generate_synthetic_pairs():
+    pairs = HPOBench.generate_synthetic_pairs(50, seed=1)
+    assert list(pairs.columns) == ["Doctor", "Parent"], "Expected: ['Doctor', 'Parent'] Got: " + str(list(pairs.columns))
+    assert pairs.equals(HPOBench.generate_synthetic_pairs(50, seed=1)), "Expected the same pairs for the same seed"
+    for codes in HPOFunc.split_hpo_codes(pairs["Doctor"].dropna().iloc[0]):
+        assert re.fullmatch(r"HP:\d{7}", codes), "Expected an HPO code Got: " + codes
+
+def test_run_benchmarks():
+    results = HPOBench.run_benchmarks(20, seed=1, memory=False, workers=1)
+    assert results["metadata"]["seed"] == 1, "Expected: 1 Got: " + str(results["metadata"]["seed"])
+    for stage in ["HPOSorter", "HPOOutPutter", "HPOSquisher", "process_column", "process_series", "HPOScorer", "score_cohort"]:
+        assert results["stages"][stage]["rows_per_s"] > 0, "Expected a positive rows_per_s for " + stage
+    assert results["stages"]["HPOSorter"]["p50_us"] <= results["stages"]["HPOSorter"]["p99_us"], "Expected p50 <= p99 Got: " + str(results["stages"]["HPOSorter"])
+    comparison = HPOBench.compare_results(results, results)
+    assert (comparison["speedup"] == 1).all(), "Expected a speedup of 1 against itself Got: " + str(comparison["speedup"].tolist())
+
+print("Testing generate_synthetic_cells")
+test_generate_synthetic_cells()
+print("Testing generate_synthetic_pairs")
+test_generate_synthetic_pairs()
+print("Testing run_benchmarks")
+test_run_benchmarks()
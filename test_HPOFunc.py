@@ -2,8 +2,12 @@ import pandas as pd
 import re
 import numpy as np
 import itertools
+import json
 import math
-from pyhpo.ontology import Ontology
+import os
+import subprocess
+import sys
+import tempfile
 import HPOFunc
 
 NullList=["none", "none documented", "nil", "(borderline)", "no concerns"]
@@ -78,8 +82,42 @@ def test_HPOSorter():
 print("Testing HPOSorter")
 test_HPOSorter()
 
+def test_tokenize_hpo_cell():
+    # Odd ones where taking something out sticks something else back together, which the old chain of re.subs
+    # then took out as well, so these need to match what it used to do
+    test1 = "HP:0001250, hHP:pizza"
+    test2 = "Seizure 1:1"
+    test3 = "Seizure 12:3, H:P test"
+
+    expect1 = (["0001250"], ["izza"])
+    expect2 = ([], ["Seizure "])
+    expect3 = (["12"], ["Seizure ", " test"])
+
+    output1 = HPOFunc.tokenize_hpo_cell(test1)
+    output2 = HPOFunc.tokenize_hpo_cell(test2)
+    output3 = HPOFunc.tokenize_hpo_cell(test3)
+
+    assert output1 == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+    assert output2 == expect2, "Expected: " + str(expect2) + " Got: " + str(output2)
+    assert output3 == expect3, "Expected: " + str(expect3) + " Got: " + str(output3)
+
+print("Testing tokenize_hpo_cell")
+test_tokenize_hpo_cell()
+
+def test_lazy_ontology():
+    # Importing HPOFunc and using the functions that don't need the ontology shouldn't load it
+    # (done in a fresh python because other tests might have loaded it already)
+    check = "import HPOFunc; HPOFunc.HPOSorter('HP:0001250, Seizure'); HPOFunc.list_to_csv(['a']); print(HPOFunc._ontology is None)"
+    output = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    assert output == "True", "Expected the ontology not to be loaded Got: " + output
+
+    ontology = HPOFunc.preload()
+    assert ontology is HPOFunc.get_ontology(), "Expected get_ontology to give back the preloaded ontology"
+    assert HPOFunc.ontology is ontology, "Expected HPOFunc.ontology to still work"
+
 print("Loading Ontology")
-ontology=Ontology()
+test_lazy_ontology()
 
 def test_get_hpo_or_error():
     # Need to redo these tests
@@ -125,6 +163,116 @@ def test_get_hpo_or_error():
 print("Testing get_hpo_or_error")
 test_get_hpo_or_error()
 
+def test_get_hpo_object():
+    ontology = HPOFunc.get_ontology()
+    owners = {}
+    for term in ontology:
+        for synonym in term.synonym:
+            owners.setdefault(synonym, []).append(term)
+    names = {term.name for term in ontology}
+
+    # Test case 1: Names, synonyms, a synonym shared by several terms, a synonym that's another term's name, codes and misses
+    # all give the same as pyhpo's own (much slower) get_hpo_object
+    shared = next(synonym for synonym, terms in owners.items() if len(terms) > 1 and synonym not in names)
+    named = next(synonym for synonym in owners if synonym in names)
+    queries = ["Arachnodactyly", "Seizure", "Autism", "Nail biting", shared, named, "HP:0001250", "0001250", "Pizza", "seizure", ""]
+    for query in queries:
+        try:
+            expect = ontology.get_hpo_object(query)
+        except RuntimeError:
+            expect = None
+        try:
+            output = HPOFunc._get_hpo_object(ontology, query)
+        except RuntimeError:
+            output = None
+        assert output is expect or output == expect, "Expected: " + str(expect) + " Got: " + str(output) + " for: " + query
+
+print("Testing _get_hpo_object")
+test_get_hpo_object()
+
+def test_HPOResolutionCache():
+    # Test case 1: Least recently used entry gets thrown out once it's full
+    cache = HPOFunc.HPOResolutionCache(maxsize=2)
+    cache.put(("Seizure", "Non_numeric"), "HP:0001250 | Seizure")
+    cache.put(("Pizza", "Non_numeric"), "Error: Pizza")
+    cache.get(("Seizure", "Non_numeric"))
+    cache.put(("0000077", "Numeric"), "HP:0000077 | Abnormality of the kidney")
+
+    assert cache.get(("Pizza", "Non_numeric")) is None, "Expected Pizza to be evicted"
+    assert cache.get(("Seizure", "Non_numeric")) == "HP:0001250 | Seizure", "Expected Seizure to still be cached"
+    expect1 = {"hits": 2, "misses": 1, "evictions": 1, "size": 2, "maxsize": 2}
+    assert cache.stats() == expect1, "Expected: " + str(expect1) + " Got: " + str(cache.stats())
+
+    # Test case 2: Shrinking it evicts straight away, size 0 turns it off
+    cache.resize(1)
+    assert len(cache) == 1, "Expected: 1 Got: " + str(len(cache))
+    cache.resize(0)
+    cache.put(("Seizure", "Non_numeric"), "HP:0001250 | Seizure")
+    assert len(cache) == 0, "Expected: 0 Got: " + str(len(cache))
+
+    # Test case 3: get_hpo_or_error remembers errors too, and the key is the normalised string
+    HPOFunc.resolution_cache.clear()
+    first = HPOFunc.get_hpo_or_error("pizza ", "Non_numeric")
+    second = HPOFunc.get_hpo_or_error("PIZZA", "Non_numeric")
+    assert first == second == "Error: Pizza", "Expected: Error: Pizza Got: " + str(first) + ", " + str(second)
+    stats = HPOFunc.resolution_cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1, "Expected 1 hit and 1 miss Got: " + str(stats)
+
+    # Same string with a different Process_Type is a different entry
+    assert HPOFunc.get_hpo_or_error("Pizza", "None") == "", "Expected: ''"
+    assert HPOFunc.resolution_cache.stats()["misses"] == 2, "Expected: 2 misses Got: " + str(HPOFunc.resolution_cache.stats())
+
+print("Testing HPOResolutionCache")
+test_HPOResolutionCache()
+
+def test_HPOPersistentCache():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "resolutions.sqlite")
+
+        # Test case 1: Results get written to disk, errors and all
+        HPOFunc.resolution_cache.clear()
+        HPOFunc.use_persistent_cache(path)
+        seizure = HPOFunc.get_hpo_or_error("seizure", "Non_numeric")
+        pizza = HPOFunc.get_hpo_or_error("Pizza", "Non_numeric")
+        HPOFunc.persistent_cache.flush()
+
+        cache = HPOFunc.HPOPersistentCache(path)
+        assert cache.get(("Seizure", "Non_numeric")) == ("term", seizure.id), "Expected: " + seizure.id + " Got: " + str(cache.get(("Seizure", "Non_numeric")))
+        assert cache.get(("Pizza", "Non_numeric")) == ("text", pizza), "Expected: " + pizza + " Got: " + str(cache.get(("Pizza", "Non_numeric")))
+        assert cache.get(("Not been looked up", "Non_numeric")) is None, "Expected: None"
+
+        # Test case 2: Next run (empty memory cache) gets it from the disk rather than the ontology,
+        # which we can tell by sneaking a different answer in
+        cache.put(("Nail-biting", "Non_numeric"), "term", "HP:0000717")
+        cache.close()
+        HPOFunc.resolution_cache.clear()
+        output2 = HPOFunc.get_hpo_or_error("Nail-biting", "Non_numeric")
+        assert str(output2) == "HP:0000717 | Autism", "Expected: HP:0000717 | Autism Got: " + str(output2)
+
+        # Test case 3: A different ontology version doesn't see any of it
+        other_version = HPOFunc.HPOPersistentCache(path, version="some other release")
+        assert other_version.get(("Seizure", "Non_numeric")) is None, "Expected: None"
+        assert len(other_version) == 0, "Expected: 0 Got: " + str(len(other_version))
+
+        # Test case 4: ...and opening it doesn't clear out the current version's results, only prune() does
+        other_version.put(("Seizure", "Non_numeric"), "term", "HP:0000717")
+        other_version.flush()
+        current = HPOFunc.HPOPersistentCache(path)
+        assert current.get(("Seizure", "Non_numeric")) == ("term", seizure.id), "Expected: " + seizure.id + " Got: " + str(current.get(("Seizure", "Non_numeric")))
+        output4 = current.prune()
+        assert output4 == 1, "Expected: 1 Got: " + str(output4)
+        assert len(other_version) == 0, "Expected: 0 Got: " + str(len(other_version))
+        assert len(current) > 0, "Expected the current version's results to be kept"
+        current.close()
+        other_version.close()
+
+        HPOFunc.use_persistent_cache(None)
+        HPOFunc.resolution_cache.clear()
+        assert HPOFunc.persistent_cache is None, "Expected the persistent cache to be off"
+
+print("Testing HPOPersistentCache")
+test_HPOPersistentCache()
+
 
 def test_list_to_csv():
     test1 = ["HP:0000001", "HP:0000002", "HP:0000003"]
@@ -294,6 +442,244 @@ def test_process_column():
 print("Testing process_column")
 test_process_column()
 
-# Should probably write some tests for the scoring functions but uh, in the mean time, good job me
+def test_process_series():
+    # The batch version should give exactly the same answers as process_column on every cell
+
+    # Repeats on purpose so that the same tokens turn up in lots of rows, and a non-default index
+    cells = [pd.NA, "None", "Nail-biting, Bipolar affective disorder", "HP:0007302, HP:0012170",
+             "HP:0007302 | Bipolar affective disorder, Nail-biting, Pizza", "hp:0012170 nail-biting,  Pizza, 123456",
+             "HP:0500093 Food allergy Nystagmus HP:0000639"]
+    test = pd.Series(cells * 3, index=[f"Patient{i}" for i in range(len(cells) * 3)])
+
+    termlist, problems = HPOFunc.process_series(test)
+    expect_termlist, expect_problems = zip(*test.map(HPOFunc.process_column))
+
+    assert list(termlist) == list(expect_termlist), "Expected: " + str(expect_termlist) + " Got: " + str(list(termlist))
+    assert list(problems) == list(expect_problems), "Expected: " + str(expect_problems) + " Got: " + str(list(problems))
+    assert termlist.index.equals(test.index), "Expected: " + str(test.index) + " Got: " + str(termlist.index)
+    assert problems.index.equals(test.index), "Expected: " + str(test.index) + " Got: " + str(problems.index)
+
+    # Test case 2: A column with nothing useful in it
+    termlist2, problems2 = HPOFunc.process_series(pd.Series([pd.NA, "nil", ""]))
+    assert list(termlist2) == ["", "", ""], "Expected: ['', '', ''] Got: " + str(list(termlist2))
+    assert list(problems2) == ["", "", ""], "Expected: ['', '', ''] Got: " + str(list(problems2))
+
+print("Testing process_series")
+test_process_series()
+
+def test_term_ids():
+    cells = pd.Series([pd.NA, "Nail-biting, Bipolar affective disorder", "HP:0007302, HP:0012170, Pizza",
+                       "HP:0500093 Food allergy Nystagmus HP:0000639", "nil"], index=[5, 6, 7, 8, 9])
+    termlist, problems = HPOFunc.process_series(cells)
+
+    # Test case 1: The IDs are the same terms as the TermList, sorted and without repeats
+    ids, problems1 = HPOFunc.process_series_ids(cells)
+    assert list(ids[7]) == [7302, 12170], "Expected: [7302, 12170] Got: " + str(list(ids[7]))
+    assert len(ids[5]) == 0 and len(ids[9]) == 0, "Expected empty arrays Got: " + str(list(ids))
+    output1 = [HPOFunc.format_term_ids(row) for row in ids]
+    assert output1 == list(termlist), "Expected: " + str(list(termlist)) + " Got: " + str(output1)
+    assert problems1.equals(problems), "Expected: " + str(list(problems)) + " Got: " + str(list(problems1))
+    assert ids.index.equals(cells.index), "Expected: " + str(cells.index) + " Got: " + str(ids.index)
+
+    # Test case 2: One cell at a time, and back from a TermList string
+    for cell, expect_termlist, expect_problems in zip(cells, termlist, problems):
+        row_ids, row_problems = HPOFunc.process_column_ids(cell)
+        assert HPOFunc.format_term_ids(row_ids) == expect_termlist, "Expected: " + expect_termlist + " Got: " + str(row_ids)
+        assert row_problems == expect_problems, "Expected: " + expect_problems + " Got: " + row_problems
+        assert list(HPOFunc.parse_term_ids(expect_termlist)) == list(row_ids), "Expected: " + str(row_ids) + " Got: " + str(HPOFunc.parse_term_ids(expect_termlist))
+
+    # Test case 3: Codes
+    output3 = HPOFunc.term_ids_to_codes([717, 1250])
+    expect3 = ["HP:0000717", "HP:0001250"]
+    assert output3 == expect3, "Expected: " + str(expect3) + " Got: " + str(output3)
+
+print("Testing term_ids")
+test_term_ids()
+
+def test_HPOPathIndex():
+    # The index should give the same steps as the last two things ontology.path returns
+    pairs = [("HP:0001263", "HP:0000750"), ("HP:0000750", "HP:0001263"), ("HP:0001250", "HP:0001250"),
+             ("HP:0000717", "HP:0000729"), ("HP:0000077", "HP:0000890"), ("HP:0000118", "HP:0001250")]
+    index = HPOFunc.HPOPathIndex()
+    for code1, code2 in pairs:
+        output = index.pair_steps(code1, code2)
+        expect = tuple(HPOFunc.ontology.path(code1, code2)[2:])
+        assert output == expect, "Expected: " + str(expect) + " Got: " + str(output)
+
+    # Test case 2: Things that aren't in the ontology give None rather than an error
+    assert index.pair_steps("HP:0001250", "Pizza") is None, "Expected: None"
+    assert index.pair_steps("HP:", "HP:0001250") is None, "Expected: None"
+
+    # Test case 3: Building it for a whole column up front
+    column = pd.Series(["HP:0001263 | Global developmental delay; HP:0000717 | Autism", pd.NA, "HP:0001250 | Seizure"])
+    index3 = HPOFunc.HPOPathIndex.from_columns(column)
+    assert len(index3) == 3, "Expected: 3 Got: " + str(len(index3))
+
+print("Testing HPOPathIndex")
+test_HPOPathIndex()
+
+def test_HPOScorer():
+    # Test case 1: Parent gives a more specific term than the doctor, and one that's unrelated
+    doctor = "HP:0001263 | Global developmental delay"
+    parent = "HP:0000750 | Delayed speech and language development; HP:0000077 | Abnormality of the kidney"
+    a, b = HPOFunc.ontology.path("HP:0001263", "HP:0000750")[2:]
+    output1 = HPOFunc.HPOScorer(doctor, parent)
+    expect1 = (1, 2, a if b == 0 else 0, b if a == 0 else 0,
+               ["HP:0001263"] if b == 0 and a != 0 else [], ["HP:0000750"] if a == 0 and b != 0 else [])
+    assert output1 == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+
+    # Test case 2: Same answer with a prebuilt index
+    index = HPOFunc.HPOPathIndex.from_columns(pd.Series([doctor, parent]))
+    output2 = HPOFunc.HPOScorer(doctor, parent, path_index=index)
+    assert output2 == expect1, "Expected: " + str(expect1) + " Got: " + str(output2)
+
+    # Test case 3: Missing parent answers, only the doctor quantity counts
+    output3 = HPOFunc.HPOScorer(doctor, pd.NA)
+    expect3 = (1, 0, 0, 0, [], [])
+    assert output3 == expect3, "Expected: " + str(expect3) + " Got: " + str(output3)
+
+print("Testing HPOScorer")
+test_HPOScorer()
+
+def test_score_cohort():
+    df = pd.DataFrame({"Doctor": ["HP:0001263 | Global developmental delay", pd.NA,
+                                  "HP:0001250 | Seizure; HP:0000717 | Autism", "HP:0000750 | Delayed speech and language development"],
+                       "Parent": ["HP:0000750 | Delayed speech and language development", "HP:0001250 | Seizure",
+                                  "HP:0001250 | Seizure", "HP:0001263 | Global developmental delay; HP:0000077 | Abnormality of the kidney"]},
+                      index=[10, 11, 12, 13])
+
+    # Test case 1: Single process should be the same as running HPOScorer on every row
+    output1 = HPOFunc.score_cohort(df, "Doctor", "Parent")
+    expect1 = [HPOFunc.HPOScorer(doc, par) for doc, par in zip(df["Doctor"], df["Parent"])]
+    assert list(output1.columns) == HPOFunc.SCORE_COLUMNS, "Expected: " + str(HPOFunc.SCORE_COLUMNS) + " Got: " + str(list(output1.columns))
+    assert [tuple(row) for row in output1.itertuples(index=False)] == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+    assert output1.index.equals(df.index), "Expected: " + str(df.index) + " Got: " + str(output1.index)
+
+    # Test case 2: Splitting it over a couple of workers shouldn't change anything, including the order
+    output2 = HPOFunc.score_cohort(df, "Doctor", "Parent", workers=2, chunksize=1)
+    assert output2.equals(output1), "Expected: " + str(output1) + " Got: " + str(output2)
+
+    # Test case 3: The same scores from integer term IDs, with the codes as IDs
+    ids = df.map(HPOFunc.parse_term_ids)
+    output3 = HPOFunc.score_cohort_ids(ids, "Doctor", "Parent", workers=2, chunksize=2)
+    for column in ["Doctor_Codes", "Parent_Codes"]:
+        output3[column] = output3[column].map(HPOFunc.term_ids_to_codes)
+    assert output3.equals(output1), "Expected: " + str(output1) + " Got: " + str(output3)
+
+    # Test case 4: Blank and missing cells, an empty TermList counts as a term but a missing one doesn't, from IDs too
+    blanks = pd.DataFrame({"Doctor": ["", "HP:0001250 | Seizure", "", pd.NA],
+                           "Parent": ["HP:0001250 | Seizure", "", "", ""]})
+    output4 = HPOFunc.score_cohort(blanks, "Doctor", "Parent")
+    expect4 = [(1, 1), (1, 1), (1, 1), (0, 1)]
+    assert list(zip(output4["Doctor_Quantity"], output4["Parent_Quantity"])) == expect4, "Expected: " + str(expect4) + " Got: " + str(output4)
+    ids = blanks.map(HPOFunc.parse_term_ids)
+    assert ids["Doctor"][3] is None and len(ids["Doctor"][0]) == 0, "Expected None for NA and an empty array for \"\" Got: " + str(list(ids["Doctor"]))
+    output5 = HPOFunc.score_cohort_ids(ids, "Doctor", "Parent")
+    assert output5.drop(columns=["Doctor_Codes", "Parent_Codes"]).equals(output4.drop(columns=["Doctor_Codes", "Parent_Codes"])), "Expected: " + str(output4) + " Got: " + str(output5)
+
+print("Testing score_cohort")
+test_score_cohort()
+
+def test_score_cohort_pairs():
+    df = pd.DataFrame({"Doctor": ["HP:0001263 | Global developmental delay", pd.NA,
+                                  "HP:0001250 | Seizure; HP:0000717 | Autism", "HP:0000750 | Delayed speech and language development",
+                                  "HP:0001263 | Global developmental delay"],
+                       "Parent": ["HP:0000750 | Delayed speech and language development", "HP:0001250 | Seizure",
+                                  "HP:0001250 | Seizure", "HP:0001263 | Global developmental delay; HP:0000077 | Abnormality of the kidney",
+                                  "HP:0000750 | Delayed speech and language development; HP:0000750 | Delayed speech and language development"]},
+                      index=[10, 11, 12, 13, 14])
+
+    # Test case 1: Same scores as score_cohort, single process and over a couple of workers
+    expect1 = HPOFunc.score_cohort(df, "Doctor", "Parent")
+    output1, pairs1 = HPOFunc.score_cohort_pairs(df, "Doctor", "Parent")
+    assert output1.equals(expect1), "Expected: " + str(expect1) + " Got: " + str(output1)
+    output2, pairs2 = HPOFunc.score_cohort_pairs(df, "Doctor", "Parent", workers=2, chunksize=1)
+    assert output2.equals(expect1), "Expected: " + str(expect1) + " Got: " + str(output2)
+    assert pairs2.equals(pairs1), "Expected: " + str(pairs1) + " Got: " + str(pairs2)
+
+    # Test case 2: Each distinct pair once, most patients first, counting repeats within a patient as occurrences only
+    assert list(pairs1.columns) == HPOFunc.PAIR_COLUMNS, "Expected: " + str(HPOFunc.PAIR_COLUMNS) + " Got: " + str(list(pairs1.columns))
+    output3 = list(zip(pairs1["Doctor_Code"], pairs1["Parent_Code"], pairs1["Occurrences"], pairs1["Patients"]))
+    expect3 = [("HP:0001263", "HP:0000750", 3, 2), ("HP:0001250", "HP:0001250", 1, 1), ("HP:0000717", "HP:0001250", 1, 1),
+               ("HP:0000750", "HP:0001263", 1, 1), ("HP:0000750", "HP:0000077", 1, 1)]
+    assert output3 == expect3, "Expected: " + str(expect3) + " Got: " + str(output3)
+
+    # Test case 3: Steps and relations agree with the ontology's own path
+    a, b = HPOFunc.ontology.path("HP:0001263", "HP:0000750")[2:]
+    output4 = (pairs1["Doctor_Steps"][0], pairs1["Parent_Steps"][0], pairs1["Relation"][1])
+    expect4 = (a, b, "Same")
+    assert output4 == expect4, "Expected: " + str(expect4) + " Got: " + str(output4)
+    expect5 = "Parent_Refines" if a == 0 else "Doctor_Refines" if b == 0 else "Related"
+    assert pairs1["Relation"][0] == expect5, "Expected: " + expect5 + " Got: " + pairs1["Relation"][0]
+
+    # Test case 4: The same from integer term IDs
+    ids = df.map(HPOFunc.parse_term_ids)
+    output6, pairs6 = HPOFunc.score_cohort_pairs(ids, "Doctor", "Parent")
+    expect6 = HPOFunc.score_cohort_ids(ids, "Doctor", "Parent")
+    assert output6.equals(expect6), "Expected: " + str(expect6) + " Got: " + str(output6)
+    # (parse_term_ids drops the repeated code, so only the patient counts are the same)
+    assert list(pairs6["Patients"]) == list(pairs1["Patients"]), "Expected: " + str(list(pairs1["Patients"])) + " Got: " + str(list(pairs6["Patients"]))
+
+    # Test case 5: Cohort summary, which has to go into JSON as it is
+    summary = HPOFunc.cohort_summary(output6, pairs6, top=1)
+    json.dumps(summary)
+    expect7 = (5, 5, 6, 1)
+    output7 = (summary["patients"], summary["distinct_pairs"], summary["pairs_compared"], summary["relations"]["Same"])
+    assert output7 == expect7, "Expected: " + str(expect7) + " Got: " + str(output7)
+    assert len(summary["top_refinements"]) <= 1, "Expected: at most 1 Got: " + str(summary["top_refinements"])
+
+    # Test case 6: Blank answers still count towards the quantities, but don't make pairs
+    blanks = pd.DataFrame({"Doctor": ["", "HP:0001250 | Seizure", "", pd.NA],
+                           "Parent": ["HP:0001250 | Seizure", "", "", ""]})
+    for frame, expect in [(blanks, HPOFunc.score_cohort(blanks, "Doctor", "Parent")),
+                          (blanks.map(HPOFunc.parse_term_ids), HPOFunc.score_cohort_ids(blanks.map(HPOFunc.parse_term_ids), "Doctor", "Parent"))]:
+        output8, pairs8 = HPOFunc.score_cohort_pairs(frame, "Doctor", "Parent")
+        assert output8.equals(expect), "Expected: " + str(expect) + " Got: " + str(output8)
+        assert len(pairs8) == 0, "Expected no pairs Got: " + str(pairs8)
+        summary = HPOFunc.cohort_summary(output8, pairs8)
+        expect8 = (4, 0, 0, {})
+        output8 = (summary["patients"], summary["distinct_pairs"], summary["pairs_compared"], summary["relations"])
+        assert output8 == expect8, "Expected: " + str(expect8) + " Got: " + str(output8)
+
+print("Testing score_cohort_pairs")
+test_score_cohort_pairs()
+
+def test_StageProfiler():
+    HPOFunc.resolution_cache.clear()
+    calls = []
+    with HPOFunc.StageProfiler(callbacks=[lambda stage, seconds: calls.append(stage)]) as profiler:
+        for entry in ["HP:0001250, Seizure", "HP:0001250, Seizure", "Pizza"]:
+            HPOFunc.process_column(entry)
+        HPOFunc.HPOScorer("HP:0001263 | Global developmental delay", "HP:0000750 | Delayed speech and language development")
+        HPOFunc.score_term_ids([1263], [750])
+    report = profiler.summary()
+
+    # Test case 1: Every stage is counted, with the stages inside process_column counted too
+    for stage, expect in [("process_column", 3), ("HPOSorter", 3), ("HPOOutPutter", 3), ("HPOSquisher", 3), ("HPOScorer", 1)]:
+        assert report[stage]["calls"] == expect, "Expected: " + str(expect) + " Got: " + str(report[stage])
+        assert report[stage]["p50_us"] <= report[stage]["p99_us"] <= report[stage]["max_us"], "Expected ordered percentiles Got: " + str(report[stage])
+    assert calls.count("HPOSorter") == 3, "Expected: 3 Got: " + str(calls)
+    # The integer ID version is timed on its own, not added into HPOScorer
+    assert report["score_term_ids"]["calls"] == 1, "Expected: 1 Got: " + str(report["score_term_ids"])
+
+    # Test case 2: The repeated entry is a cache hit for HPOOutPutter (2 lookups the first time, 2 hits the second, 1 miss for Pizza)
+    expect2 = (2, 3)
+    output2 = (report["HPOOutPutter"]["cache_hits"], report["HPOOutPutter"]["cache_misses"])
+    assert output2 == expect2, "Expected: " + str(expect2) + " Got: " + str(output2)
+
+    # Test case 3: Nothing gets recorded once it's turned off, and the JSON has the same in it
+    HPOFunc.HPOSorter("HP:0001250")
+    assert profiler.summary()["HPOSorter"]["calls"] == 3, "Expected: 3 Got: " + str(profiler.summary()["HPOSorter"])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "profile.json")
+        profiler.to_json(path)
+        with open(path) as f:
+            output3 = json.load(f)
+    assert output3 == profiler.summary(), "Expected: " + str(profiler.summary()) + " Got: " + str(output3)
+
+print("Testing StageProfiler")
+test_StageProfiler()
+
+# Should probably write some more tests for the scoring functions but uh, in the mean time, good job me
 
 print("All your tests have passed! You are a super star!")
\ No newline at end of file
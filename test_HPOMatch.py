@@ -0,0 +1,129 @@
+import asyncio
+import pandas as pd
+import os
+import tempfile
+import HPOFunc
+import HPOMatch
+import HPOService
+
+print("Building term matcher")
+matcher = HPOMatch.HPOTermMatcher.build()
+
+def test_normalise_phrase():
+    test1 = "Nail-biting "
+    test2 = "EEG  ABNORMALITY"
+    output1 = HPOMatch.normalise_phrase(test1)
+    output2 = HPOMatch.normalise_phrase(test2)
+    expect1 = "nail biting"
+    expect2 = "eeg abnormality"
+    assert output1 == expect1, "Expected: " + expect1 + " Got: " + output1
+    assert output2 == expect2, "Expected: " + expect2 + " Got: " + output2
+
+print("Testing normalise_phrase")
+test_normalise_phrase()
+
+def test_bounded_levenshtein():
+    assert HPOMatch.bounded_levenshtein("seizure", "seizure", 2) == 0, "Expected: 0"
+    assert HPOMatch.bounded_levenshtein("seizurs", "seizure", 2) == 1, "Expected: 1"
+    assert HPOMatch.bounded_levenshtein("autsm", "autism", 2) == 1, "Expected: 1"
+    # Gives up past max_distance
+    assert HPOMatch.bounded_levenshtein("pizza", "seizure", 2) == 3, "Expected: 3"
+
+print("Testing bounded_levenshtein")
+test_bounded_levenshtein()
+
+def test_HPOTermMatcher():
+    # Test case 1: Exact matches ignoring case and punctuation, including synonyms
+    for query, expect in [("nail biting", "HP:0012170 | Nail-biting"), ("EEG ABNORMALITY", "HP:0002353 | EEG abnormality"),
+                          ("Abnormal electroencephalogram", "HP:0002353 | EEG abnormality")]:
+        term, score = matcher.match(query)
+        assert str(term) == expect, "Expected: " + expect + " Got: " + str(term)
+        assert score == 1, "Expected: 1 Got: " + str(score)
+
+    # Test case 2: Misspellings get matched, with a score under 1
+    term, score = matcher.match("Globel developmental delay")
+    assert str(term) == "HP:0001263 | Global developmental delay", "Expected: HP:0001263 | Global developmental delay Got: " + str(term)
+    assert 0.8 <= score < 1, "Expected a score between 0.8 and 1 Got: " + str(score)
+
+    # Test case 3: Things that aren't anything like a HPO term don't match
+    assert matcher.match("Pizza") is None, "Expected: None Got: " + str(matcher.match("Pizza"))
+    assert matcher.match("") is None, "Expected: None Got: " + str(matcher.match(""))
+
+print("Testing HPOTermMatcher")
+test_HPOTermMatcher()
+
+def test_HPOTermMatcher_save():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "matcher.pkl")
+        matcher.save(path)
+        loaded = HPOMatch.HPOTermMatcher.load_or_build(path, min_score=0.9)
+        assert len(loaded) == len(matcher), "Expected: " + str(len(matcher)) + " Got: " + str(len(loaded))
+        assert loaded.min_score == 0.9, "Expected: 0.9 Got: " + str(loaded.min_score)
+        assert str(loaded.match("seizure")[0]) == "HP:0001250 | Seizure", "Expected: HP:0001250 | Seizure"
+        # Only scores 0.875, so not good enough any more
+        assert loaded.match("seizurs") is None, "Expected: None Got: " + str(loaded.match("seizurs"))
+
+print("Testing HPOTermMatcher save")
+test_HPOTermMatcher_save()
+
+def test_use_term_matcher():
+    # get_hpo_or_error should only use the matcher when it's been turned on
+    HPOFunc.resolution_cache.clear()
+    output1 = HPOFunc.get_hpo_or_error("Seizurs", "Non_numeric")
+    assert output1 == "Error: Seizurs", "Expected: Error: Seizurs Got: " + str(output1)
+
+    HPOFunc.use_term_matcher(matcher)
+    output2 = HPOFunc.get_hpo_or_error("Seizurs", "Non_numeric")
+    assert str(output2) == "HP:0001250 | Seizure", "Expected: HP:0001250 | Seizure Got: " + str(output2)
+    assert (output2.id, output2.text, output2.score) == ("HP:0001250", "Seizurs", matcher.match("Seizurs")[1]), "Expected the match and its score Got: " + repr(output2)
+
+    # Test case 2: Fuzzy matches go in the TermList and get flagged in Problems, the same from every entry point
+    termlist, problems = HPOFunc.process_column("Seizurs, Pizza")
+    expect_problems = "Fuzzy: Seizurs -> HP:0001250 | Seizure (" + f"{output2.score:.2f}" + "); Error: Pizza"
+    assert termlist == "HP:0001250 | Seizure", "Expected: HP:0001250 | Seizure Got: " + termlist
+    assert problems == expect_problems, "Expected: " + expect_problems + " Got: " + problems
+    termlists, problem_cells = HPOFunc.process_series(pd.Series(["Seizurs, Pizza", "Seizure"]))
+    assert list(problem_cells) == [expect_problems, ""], "Expected: " + str([expect_problems, ""]) + " Got: " + str(list(problem_cells))
+    ids, problem_cells = HPOFunc.process_series_ids(pd.Series(["Seizurs, Pizza"]))
+    assert list(ids[0]) == [1250] and problem_cells[0] == expect_problems, "Expected: [1250] " + expect_problems + " Got: " + str(list(ids[0])) + " " + problem_cells[0]
+
+    # Test case 3: ...and come back as fuzzy matches from the persistent cache
+    with tempfile.TemporaryDirectory() as folder:
+        HPOFunc.use_persistent_cache(os.path.join(folder, "resolutions.sqlite"))
+        HPOFunc.resolution_cache.clear()
+        HPOFunc.get_hpo_or_error("Seizurs", "Non_numeric")
+        HPOFunc.persistent_cache.flush()
+        HPOFunc.resolution_cache.clear()
+        output3 = HPOFunc.get_hpo_or_error("Seizurs", "Non_numeric")
+        HPOFunc.use_persistent_cache(None)
+    assert HPOFunc.problem_text(output3) == HPOFunc.problem_text(output2), "Expected: " + HPOFunc.problem_text(output2) + " Got: " + str(HPOFunc.problem_text(output3))
+
+    # Test case 4: An exact match once case and punctuation are ignored is just the term, and isn't a problem
+    # (from the cache, the batch version and the service too)
+    expect4 = ("HP:0012170 | Nail-biting", "")
+    output4 = HPOFunc.get_hpo_or_error("Nail biting", "Non_numeric")
+    assert not isinstance(output4, HPOFunc.HPOFuzzyMatch), "Expected the plain term Got: " + repr(output4)
+    assert HPOFunc.process_column("Nail biting") == expect4, "Expected: " + str(expect4) + " Got: " + str(HPOFunc.process_column("Nail biting"))
+    termlists, problem_cells = HPOFunc.process_series(pd.Series(["Nail biting", "nail-biting"]))
+    assert list(problem_cells) == ["", ""], "Expected no problems Got: " + str(list(problem_cells))
+    normaliser = HPOService.HPONormaliser(max_workers=1)
+    try:
+        output4 = asyncio.run(normaliser.normalise(["Nail biting"]))
+    finally:
+        normaliser.close()
+    assert output4 == [expect4], "Expected: " + str([expect4]) + " Got: " + str(output4)
+
+    # Test case 5: Only matches scoring under review_score get flagged
+    matcher.review_score = output2.score
+    try:
+        output5 = HPOFunc.process_column("Seizurs")
+    finally:
+        matcher.review_score = 1.0
+    assert output5 == ("HP:0001250 | Seizure", ""), "Expected: ('HP:0001250 | Seizure', '') Got: " + str(output5)
+
+    HPOFunc.use_term_matcher(None)
+    output3 = HPOFunc.get_hpo_or_error("Seizurs", "Non_numeric")
+    assert output3 == "Error: Seizurs", "Expected: Error: Seizurs Got: " + str(output3)
+
+print("Testing use_term_matcher")
+test_use_term_matcher()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import HPOFunc
+import HPOMatrix
+
+closure = HPOMatrix.get_ancestor_closure()
+
+def test_HPOAncestorClosure():
+    # Test case 1: Seizure and everything above it
+    output1 = HPOFunc.term_ids_to_codes(closure.ancestors(1250))
+    expect1 = sorted(["HP:0001250"] + [term.id for term in HPOFunc.get_ontology().get_hpo_object("HP:0001250").all_parents])
+    assert output1 == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+
+    # Test case 2: Unknown IDs aren't quietly dropped
+    try:
+        closure.columns([1250, 99999999])
+        raise AssertionError("Expected a ValueError for an ID that isn't in the ontology")
+    except ValueError:
+        pass
+
+    # Test case 3: Saving and loading gives the same closure back
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "closure.npz")
+        closure.save(path)
+        loaded = HPOMatrix.HPOAncestorClosure.load_or_build(path)
+    assert np.array_equal(loaded.terms, closure.terms), "Expected the same terms after loading"
+    assert (loaded.matrix != closure.matrix).nnz == 0, "Expected the same matrix after loading"
+
+print("Testing HPOAncestorClosure")
+test_HPOAncestorClosure()
+
+def test_build_term_matrix():
+    column = pd.Series(["HP:0001250 | Seizure; HP:0000717 | Autism", pd.NA, "HP:0001250 | Seizure", ""],
+                       index=["a", "b", "c", "d"])
+
+    # Test case 1: One row per patient, a 1 for each of their terms
+    matrix = HPOMatrix.build_term_matrix(column)
+    assert matrix.matrix.shape == (4, len(closure)), "Expected: " + str((4, len(closure))) + " Got: " + str(matrix.matrix.shape)
+    assert matrix.index.equals(column.index), "Expected: " + str(column.index) + " Got: " + str(matrix.index)
+    output1 = matrix.term_frequencies().to_dict()
+    expect1 = {"HP:0001250": 2, "HP:0000717": 1}
+    assert output1 == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+
+    # Test case 2: The same from integer term IDs
+    ids = column.map(HPOFunc.parse_term_ids)
+    output2 = HPOMatrix.build_term_matrix(ids)
+    assert (output2.matrix != matrix.matrix).nnz == 0, "Expected the same matrix from IDs as from TermLists"
+
+    # Test case 3: Propagating gives each patient the ancestors too, counted once even when two terms share them
+    propagated = HPOMatrix.build_term_matrix(column, propagate=True)
+    frequencies = propagated.term_frequencies()
+    assert frequencies["HP:0000001"] == 2, "Expected: 2 Got: " + str(frequencies["HP:0000001"])
+    assert frequencies["HP:0000707"] == 2, "Expected: 2 Got: " + str(frequencies["HP:0000707"])
+    expect3 = len(set(closure.ancestors(1250)) | set(closure.ancestors(717)))
+    assert propagated.matrix[0].sum() == expect3, "Expected: " + str(expect3) + " Got: " + str(propagated.matrix[0].sum())
+
+    # Test case 4: Co-occurrence and similarity
+    co_occurrence = matrix.co_occurrence()
+    seizure, autism = closure.columns([1250, 717])
+    assert co_occurrence[seizure, autism] == 1, "Expected: 1 Got: " + str(co_occurrence[seizure, autism])
+    assert co_occurrence[seizure, seizure] == 2, "Expected: 2 Got: " + str(co_occurrence[seizure, seizure])
+    similarity = matrix.jaccard_similarity()
+    assert similarity[0, 2] == 0.5, "Expected: 0.5 Got: " + str(similarity[0, 2])
+    assert similarity[0, 1] == 0, "Expected: 0 Got: " + str(similarity[0, 1])
+
+print("Testing build_term_matrix")
+test_build_term_matrix()
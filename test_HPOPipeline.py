@@ -0,0 +1,200 @@
+import os
+import tempfile
+import pandas as pd
+import HPOFunc
+import HPOPipeline
+from testdata import make_test_file
+
+def test_process_file():
+    with tempfile.TemporaryDirectory() as folder:
+        input_path = make_test_file(folder)
+        output_path = os.path.join(folder, "output.csv")
+
+        # Test case 1: Whole file, a few rows at a time, should be the same as process_column on every cell
+        rows = HPOPipeline.process_file(input_path, output_path, ["Doctor", "Parent"], chunksize=3)
+        assert rows == 7, "Expected: 7 Got: " + str(rows)
+        assert not os.path.exists(output_path + ".progress"), "Expected the progress file to be cleaned up"
+
+        output = pd.read_csv(output_path, dtype=str, keep_default_na=False)
+        original = pd.read_csv(input_path, dtype=str)
+        for column in ["Doctor", "Parent"]:
+            expect_terms, expect_problems = zip(*original[column].map(HPOFunc.process_column))
+            assert list(output[column + "_TermList"]) == list(expect_terms), "Expected: " + str(expect_terms) + " Got: " + str(list(output[column + "_TermList"]))
+            assert list(output[column + "_Problems"]) == list(expect_problems), "Expected: " + str(expect_problems) + " Got: " + str(list(output[column + "_Problems"]))
+        assert output["Doctor_TermList"][2] == "HP:0012170 | Nail-biting", "Expected the leading zeros to survive Got: " + output["Doctor_TermList"][2]
+
+def test_process_file_resume():
+    with tempfile.TemporaryDirectory() as folder:
+        input_path = make_test_file(folder)
+        expect_path = os.path.join(folder, "expect.csv")
+        output_path = os.path.join(folder, "output.csv")
+        HPOPipeline.process_file(input_path, expect_path, ["Doctor"], chunksize=2)
+
+        # Stop after two chunks, then pretend it crashed half way through writing the third one
+        for rows in HPOPipeline.stream_process_file(input_path, output_path, ["Doctor"], chunksize=2):
+            if rows == 4:
+                break
+        assert os.path.exists(output_path + ".progress"), "Expected a progress file after stopping early"
+        with open(output_path, "a") as f:
+            f.write("P4,half a row")
+
+        # Carrying on should only do the last two chunks, and end up with the same file as doing it in one go
+        done = list(HPOPipeline.stream_process_file(input_path, output_path, ["Doctor"], chunksize=2))
+        assert done == [6, 7], "Expected: [6, 7] Got: " + str(done)
+        with open(output_path) as output, open(expect_path) as expect:
+            assert output.read() == expect.read(), "Expected the resumed output to match a run done in one go"
+
+        # Test case 2: Resuming skips the rows that were done
+        output2 = [list(chunk["PatientID"]) for chunk in HPOPipeline.read_in_chunks(input_path, chunksize=2, skip_rows=4)]
+        assert output2 == [["P4", "P5"], ["P6"]], "Expected: [['P4', 'P5'], ['P6']] Got: " + str(output2)
+
+        # Test case 3: Blank lines don't count as rows when working out where to carry on from
+        blank_path = os.path.join(folder, "blank_lines.csv")
+        with open(input_path) as f:
+            lines = f.read().split("\n")
+        with open(blank_path, "w") as f:
+            f.write("\n".join(lines[:2] + [""] + lines[2:]))
+        HPOPipeline.process_file(blank_path, expect_path, ["Doctor"], chunksize=2, resume=False)
+        for rows in HPOPipeline.stream_process_file(blank_path, output_path, ["Doctor"], chunksize=2, resume=False):
+            break
+        HPOPipeline.process_file(blank_path, output_path, ["Doctor"], chunksize=2)
+        with open(output_path) as output, open(expect_path) as expect:
+            assert output.read() == expect.read(), "Expected the resumed output to match a run done in one go"
+
+        # Test case 4: If the input has been edited since, it starts again rather than carrying on
+        for rows in HPOPipeline.stream_process_file(input_path, output_path, ["Doctor"], chunksize=2, resume=False):
+            break
+        with open(input_path, "a") as f:
+            f.write("P7,Seizure,Autism\n")
+        done = list(HPOPipeline.stream_process_file(input_path, output_path, ["Doctor"], chunksize=2))
+        assert done == [2, 4, 6, 8], "Expected: [2, 4, 6, 8] Got: " + str(done)
+
+def test_process_file_empty():
+    with tempfile.TemporaryDirectory() as folder:
+        # Test case 1: Just a header still gives an output file with a header, from a CSV or a spreadsheet
+        empty = pd.DataFrame({"PatientID": [], "Doctor": []})
+        for input_path in [os.path.join(folder, "empty.csv"), os.path.join(folder, "empty.xlsx")]:
+            if input_path.endswith(".csv"):
+                empty.to_csv(input_path, index=False)
+            else:
+                empty.to_excel(input_path, index=False)
+            output_path = os.path.join(folder, "output.csv")
+            rows = HPOPipeline.process_file(input_path, output_path, ["Doctor"], resume=False)
+            with open(output_path) as f:
+                output = f.read()
+            expect = "PatientID,Doctor,Doctor_TermList,Doctor_Problems\n"
+            assert (rows, output) == (0, expect), "Expected: " + str((0, expect)) + " Got: " + str((rows, output))
+
+print("Testing process_file")
+test_process_file()
+
+print("Testing process_file resume")
+test_process_file_resume()
+
+print("Testing process_file on an empty file")
+test_process_file_empty()
+
+def test_incremental_process_series():
+    with tempfile.TemporaryDirectory() as folder:
+        store = HPOPipeline.HPOResultStore(os.path.join(folder, "results.sqlite"))
+        cells = pd.Series(["Nail-biting, Bipolar affective disorder", pd.NA, "HP:0007302, Pizza", "Seizure", "Seizure"],
+                          index=[3, 4, 5, 6, 7])
+
+        # Test case 1: First time round everything gets worked out, same answers as process_series
+        output1 = HPOPipeline.incremental_process_series(cells, store)
+        expect1 = HPOFunc.process_series(cells)
+        for output, expect in zip(output1, expect1):
+            assert output.equals(expect), "Expected: " + str(list(expect)) + " Got: " + str(list(output))
+        assert (store.hits, store.misses) == (0, 5), "Expected: (0, 5) Got: " + str((store.hits, store.misses))
+
+        # Test case 2: Edit one cell and add one, only those two get worked out
+        edited = pd.concat([cells, pd.Series(["Autism"], index=[8])])
+        edited[5] = "HP:0007302"
+        output2 = HPOPipeline.incremental_process_series(edited, store)
+        expect2 = HPOFunc.process_series(edited)
+        for output, expect in zip(output2, expect2):
+            assert output.equals(expect), "Expected: " + str(list(expect)) + " Got: " + str(list(output))
+        assert (store.hits, store.misses) == (4, 7), "Expected: (4, 7) Got: " + str((store.hits, store.misses))
+        store.close()
+
+        # Test case 3: Still there after reopening, but not for a different HPO release
+        reopened = HPOPipeline.HPOResultStore(os.path.join(folder, "results.sqlite"))
+        assert len(reopened) == 6, "Expected: 6 Got: " + str(len(reopened))
+        reopened.close()
+        other_release = HPOPipeline.HPOResultStore(os.path.join(folder, "results.sqlite"), version="hp/releases/1999-01-01")
+        assert len(other_release) == 0, "Expected: 0 Got: " + str(len(other_release))
+
+        # Test case 4: Opening it with another release doesn't clear anything out, prune() does
+        other_release.put("cells", {"abc": ("", "")})
+        reopened = HPOPipeline.HPOResultStore(os.path.join(folder, "results.sqlite"))
+        assert len(reopened) == 6, "Expected: 6 Got: " + str(len(reopened))
+        output4 = reopened.prune()
+        assert output4 == 1 and len(other_release) == 0, "Expected: 1 pruned Got: " + str(output4)
+        assert len(reopened) == 6, "Expected: 6 Got: " + str(len(reopened))
+        reopened.close()
+        other_release.close()
+
+def test_incremental_score_cohort():
+    df = pd.DataFrame({"Doctor": ["HP:0001263 | Global developmental delay", pd.NA, "HP:0001250 | Seizure; HP:0000717 | Autism"],
+                       "Parent": ["HP:0000750 | Delayed speech and language development", "HP:0001250 | Seizure", "HP:0001250 | Seizure"]},
+                      index=[10, 11, 12])
+    with tempfile.TemporaryDirectory() as folder:
+        store = HPOPipeline.HPOResultStore(os.path.join(folder, "results.sqlite"))
+
+        # Test case 1: Same as score_cohort, the first time and when it's all coming from the store
+        for expect_hits in [0, 3]:
+            output = HPOPipeline.incremental_score_cohort(df, "Doctor", "Parent", store)
+            expect = HPOFunc.score_cohort(df, "Doctor", "Parent")
+            assert output.equals(expect), "Expected: " + str(expect) + " Got: " + str(output)
+            assert store.hits == expect_hits, "Expected: " + str(expect_hits) + " Got: " + str(store.hits)
+
+        # Test case 2: Changing the parent's answer means that row is scored again
+        df.loc[12, "Parent"] = "HP:0000729 | Autistic behavior"
+        output2 = HPOPipeline.incremental_score_cohort(df, "Doctor", "Parent", store)
+        expect2 = HPOFunc.score_cohort(df, "Doctor", "Parent")
+        assert output2.equals(expect2), "Expected: " + str(expect2) + " Got: " + str(output2)
+        assert store.misses == 4, "Expected: 4 Got: " + str(store.misses)
+        store.close()
+
+print("Testing incremental_process_series")
+test_incremental_process_series()
+
+print("Testing incremental_score_cohort")
+test_incremental_score_cohort()
+
+def test_problem_report():
+    # Test case 1: Splitting a Problems cell back up
+    output1 = HPOPipeline.split_problems("Error: Pizza; Error: HP:1234567; Error: fish; chips; Fuzzy: Seizurs -> HP:0001250 | Seizure (0.93)")
+    expect1 = ["Error: Pizza", "Error: HP:1234567", "Error: fish; chips", "Fuzzy: Seizurs -> HP:0001250 | Seizure (0.93)"]
+    assert output1 == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+
+    # Test case 2: Same phrase written differently counts as one, most common first
+    report = HPOPipeline.ProblemReport()
+    report.add_series(pd.Series(["Error: Pizza; Error: Hypotonia.", "Error: pizza", "", pd.NA, "Error: PIZZA; Error: Pizza"]), "Doctor")
+    ranked = report.ranked()
+    output2 = list(zip(ranked["Key"], ranked["Count"], ranked["Rows"]))
+    expect2 = [("pizza", 4, 3), ("hypotonia", 1, 1)]
+    assert output2 == expect2, "Expected: " + str(expect2) + " Got: " + str(output2)
+    assert ranked["Phrase"][0] == "Pizza", "Expected: Pizza Got: " + ranked["Phrase"][0]
+    assert ranked["Example_Rows"][0] == "0, 1, 4", "Expected: 0, 1, 4 Got: " + ranked["Example_Rows"][0]
+
+    # Test case 3: Only keeps max_keys phrases, dropping the rare ones
+    small = HPOPipeline.ProblemReport(max_keys=2)
+    for cell in ["Error: a", "Error: a", "Error: b", "Error: c"]:
+        small.add(cell)
+    assert len(small) <= 2 and small.dropped > 0, "Expected some phrases to be dropped Got: " + str(small.ranked())
+    assert small.ranked()["Key"][0] == "a", "Expected the most common one to be kept Got: " + str(small.ranked())
+
+    # Test case 4: Straight from a processed file
+    with tempfile.TemporaryDirectory() as folder:
+        processed_path = os.path.join(folder, "output.csv")
+        report_path = os.path.join(folder, "report.csv")
+        HPOPipeline.process_file(make_test_file(folder), processed_path, ["Doctor", "Parent"])
+        HPOPipeline.problem_report(processed_path, report_path, chunksize=2, id_column="PatientID")
+        output4 = pd.read_csv(report_path, dtype=str, keep_default_na=False)
+    assert list(output4["Phrase"]) == ["Pizza"], "Expected: ['Pizza'] Got: " + str(list(output4["Phrase"]))
+    assert output4["Count"][0] == "2" and output4["Example_Rows"][0] == "P3, P5", "Expected: 2 rows, P3 and P5 Got: " + str(output4.iloc[0].to_dict())
+    assert output4["Columns"][0] == "Doctor_Problems, Parent_Problems", "Expected both columns Got: " + output4["Columns"][0]
+
+print("Testing problem_report")
+test_problem_report()
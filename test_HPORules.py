@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import pandas as pd
+import HPOFunc
+import HPOPipeline
+import HPORules
+
+rules = HPORules.HPOCleanupRules(null_phrases=["none", "not known", "N/A"],
+                                 abbreviations={"GDD": "Global developmental delay", "ASD": "Autism"},
+                                 synonyms={"fits": "Seizure", "floppy": "hp:0001252"},
+                                 abbreviations_ignore_case=["GDD"])
+
+def test_HPOCleanupRules():
+    # Test case 1: Null phrases, ignoring case and punctuation
+    for strg, expect in [("Not Known.", True), ("n/a", True), ("Nothing", False)]:
+        output = rules.is_null(strg)
+        assert output == expect, "Expected: " + str(expect) + " Got: " + str(output)
+
+    # Test case 2: Fragments get dropped, expanded or swapped for their synonym
+    cases = [("none", None), ("GDD", ("Global developmental delay", "Non_numeric")), ("mild gdd", ("mild Global developmental delay", "Non_numeric")),
+             ("GDDX", ("GDDX", "Non_numeric")), ("Fits!", ("Seizure", "Non_numeric")), ("floppy", ("0001252", "Numeric"))]
+    for strg, expect in cases:
+        output = rules.clean(strg)
+        assert output == expect, "Expected: " + str(expect) + " Got: " + str(output)
+
+    # Test case 3: Abbreviations match case unless they opted in, so ordinary lower case words are left alone
+    cases = [("all", "all"), ("all the time", "all the time"), ("ALL", "Acute lymphoblastic leukaemia"), ("asd", "asd"),
+             ("ASD and gdd", "Autism and Global developmental delay")]
+    cased = HPORules.HPOCleanupRules(abbreviations={"ALL": "Acute lymphoblastic leukaemia", "ASD": "Autism", "GDD": "Global developmental delay"},
+                                     abbreviations_ignore_case=["GDD"])
+    for strg, expect in cases:
+        output = cased.expand(strg)
+        assert output == expect, "Expected: " + expect + " Got: " + output
+    output = HPORules.HPOCleanupRules(abbreviations={"ASD": "Autism"}, abbreviations_ignore_case=True).expand("asd")
+    assert output == "Autism", "Expected: Autism Got: " + output
+    assert cased.cache_tag != HPORules.HPOCleanupRules(abbreviations=cased.abbreviations).cache_tag, "Expected abbreviations_ignore_case in the cache tag"
+
+    # Test case 4: Loading from a file, which should complain about anything it doesn't know
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "rules.json")
+        with open(path, "w") as f:
+            json.dump({"null_phrases": ["none", "not known", "N/A"], "abbreviations": {"GDD": "Global developmental delay", "ASD": "Autism"},
+                       "synonyms": {"fits": "Seizure", "floppy": "hp:0001252"}, "abbreviations_ignore_case": ["GDD"]}, f)
+        loaded = HPORules.HPOCleanupRules.load(path)
+        assert loaded.cache_tag == rules.cache_tag, "Expected: " + rules.cache_tag + " Got: " + loaded.cache_tag
+        with open(path, "w") as f:
+            json.dump({"synonym": {"fits": "Seizure"}}, f)
+        try:
+            HPORules.HPOCleanupRules.load(path)
+            assert False, "Expected a ValueError for an unknown rule type"
+        except ValueError:
+            pass
+
+def test_use_cleanup_rules():
+    cells = pd.Series(["GDD, fits", "Not known", "ASD, floppy, none", "HP:0001250, Pizza", pd.NA])
+
+    # Test case 1: Off, the site-specific phrases are just problems
+    output1 = HPOFunc.process_column(cells[0])
+    expect1 = ("", "Error: Gdd; Error: Fits")
+    assert output1 == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+
+    # Test case 2: On, process_column and process_series both use them and still agree
+    HPOFunc.use_cleanup_rules(rules)
+    try:
+        expect2 = [("HP:0001250 | Seizure; HP:0001263 | Global developmental delay", ""), ("", ""),
+                   ("HP:0000717 | Autism; HP:0001252 | Hypotonia", ""), ("HP:0001250 | Seizure", "Error: Pizza"), ("", "")]
+        output2 = [HPOFunc.process_column(cell) for cell in cells]
+        assert output2 == expect2, "Expected: " + str(expect2) + " Got: " + str(output2)
+        TermList, Problems = HPOFunc.process_series(cells)
+        output3 = list(zip(TermList, Problems))
+        assert output3 == expect2, "Expected: " + str(expect2) + " Got: " + str(output3)
+
+        # Test case 3: Results stored with the rules on are kept apart from ones without
+        with tempfile.TemporaryDirectory() as folder:
+            store = HPOPipeline.HPOResultStore(os.path.join(folder, "results.sqlite"))
+            assert store.version.endswith(rules.cache_tag), "Expected the rules in the store version Got: " + store.version
+    finally:
+        HPOFunc.use_cleanup_rules(None)
+
+print("Testing HPOCleanupRules")
+test_HPOCleanupRules()
+
+print("Testing use_cleanup_rules")
+test_use_cleanup_rules()
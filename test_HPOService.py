@@ -0,0 +1,123 @@
+import asyncio
+import threading
+
+import HPOFunc
+import HPOService
+
+cells = ["HP:0001250 Seizure, HP:0000717 Autism", None, "Pizza, seizure", "nil", "hp:0001263,  Nystagmus", "Seizure "]
+
+def test_HPONormaliser():
+    HPOFunc.resolution_cache.clear()
+    normaliser = HPOService.HPONormaliser(max_workers=2, max_pending=12)
+
+    async def run():
+        # Two batches at once with the same tokens, and a third that has to wait for room
+        return await asyncio.gather(normaliser.normalise(cells), normaliser.normalise(cells), normaliser.normalise(cells[:2]))
+
+    try:
+        output1, output2, output3 = asyncio.run(run())
+    finally:
+        normaliser.close()
+
+    # Test case 1: Same as process_column on every cell
+    expect = [HPOFunc.process_column(cell) for cell in cells]
+    assert output1 == expect, "Expected: " + str(expect) + " Got: " + str(output1)
+    assert output2 == expect, "Expected: " + str(expect) + " Got: " + str(output2)
+    assert output3 == expect[:2], "Expected: " + str(expect[:2]) + " Got: " + str(output3)
+
+    # Test case 2: The second batch shared the first one's lookups rather than doing them again
+    # ("seizure" and "Seizure " are the same token once they're normalised)
+    # (the third batch comes after they're done, so it goes to resolution_cache for its 4 instead)
+    assert normaliser.stats["tokens_shared"] == 7, "Expected: 7 Got: " + str(normaliser.stats)
+    assert normaliser.stats["tokens_looked_up"] == 11, "Expected: 11 Got: " + str(normaliser.stats)
+
+    # Test case 3: Only 12 cells at a time, so the third batch had to wait
+    assert normaliser.stats["waits"] >= 1, "Expected at least 1 wait Got: " + str(normaliser.stats)
+
+    # Test case 4: Cancelling a batch doesn't cancel the lookups another batch is sharing with it
+    HPOFunc.resolution_cache.clear()
+    normaliser = HPOService.HPONormaliser(max_workers=2)
+    # Hold the lookups until both batches are waiting on them
+    release = threading.Event()
+    resolve_tokens = HPOService._resolve_tokens
+    HPOService._resolve_tokens = lambda new: release.wait() and resolve_tokens(new)
+
+    async def run_cancelled():
+        first = asyncio.ensure_future(normaliser.normalise(cells))
+        while normaliser.stats["batches"] < 1:
+            await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(normaliser.normalise(cells))
+        while normaliser.stats["batches"] < 2:
+            await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        return await second
+
+    try:
+        output4 = asyncio.run(run_cancelled())
+    finally:
+        HPOService._resolve_tokens = resolve_tokens
+        normaliser.close()
+    assert output4 == expect, "Expected: " + str(expect) + " Got: " + str(output4)
+    assert normaliser.stats["tokens_shared"] > 0, "Expected the second batch to share the first one's lookups Got: " + str(normaliser.stats)
+
+print("Testing HPONormaliser")
+test_HPONormaliser()
+
+async def send(port, request):
+    # A raw request, returning the status line of the response
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(request)
+        writer.write_eof()
+        response = await reader.read()
+    finally:
+        writer.close()
+    return response.split(b"\r\n")[0].decode("latin-1")
+
+def test_server():
+    normaliser = HPOService.HPONormaliser(max_workers=2)
+    bad_requests = [b"POST /normalise HTTP/1.1\r\n\r\n",
+                    b"POST /normalise HTTP/1.1\r\nContent-Length: lots\r\n\r\n",
+                    b"POST /normalise HTTP/1.1\r\nContent-Length: 100\r\n\r\n{\"cells\": []}",
+                    b"POST /normalise HTTP/1.1\r\nContent-Length: 14\r\n\r\n{\"cells\": [1]}",
+                    b"POST /normalise HTTP/1.1\r\nContent-Length: 16\r\n\r\n{\"cells\": \"abc\"}",
+                    b"POST /normalise HTTP/1.1\r\nContent-Length: 2\r\n\r\n[]"]
+
+    async def run():
+        server = await HPOService.start_server(normaliser, port=0, max_body=1000)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            results = await HPOService.post_cells("127.0.0.1", port, cells)
+            load = await HPOService.load_test("127.0.0.1", port, cells * 5, batch_size=4, concurrency=3)
+            bad = [await send(port, request) for request in bad_requests]
+            too_big = await send(port, b"POST /normalise HTTP/1.1\r\nContent-Length: 1001\r\n\r\n")
+        finally:
+            server.close()
+            await server.wait_closed()
+        return results, load, bad, too_big
+
+    try:
+        results, load, bad, too_big = asyncio.run(run())
+    finally:
+        normaliser.close()
+
+    # Test case 1: Results over HTTP are the same as process_column
+    output1 = [(result["TermList"], result["Problems"]) for result in results]
+    expect1 = [HPOFunc.process_column(cell) for cell in cells]
+    assert output1 == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+
+    # Test case 2: The load test got through everything and gives sensible numbers
+    assert load["cells"] == 30 and load["batches"] == 8, "Expected 30 cells in 8 batches Got: " + str(load)
+    assert 0 < load["p50_ms"] <= load["p99_ms"] <= load["max_ms"], "Expected ordered latencies Got: " + str(load)
+
+    # Test case 3: Missing or broken Content-Length, a short body and cells that aren't strings all get a 400
+    expect3 = ["HTTP/1.1 400 Bad Request"] * len(bad_requests)
+    assert bad == expect3, "Expected: " + str(expect3) + " Got: " + str(bad)
+
+    # Test case 4: A body bigger than max_body gets turned away before it's read
+    assert too_big == "HTTP/1.1 413 Payload Too Large", "Expected: HTTP/1.1 413 Payload Too Large Got: " + too_big
+
+print("Testing server")
+test_server()
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+from pyhpo import HPOSet
+
+import HPOFunc
+import HPOMatrix
+import HPOSimilarity
+
+column = pd.Series(["HP:0001250 | Seizure; HP:0000717 | Autism",
+                    "HP:0001263 | Global developmental delay; HP:0000750 | Delayed speech and language development",
+                    pd.NA,
+                    "HP:0002069 | Bilateral tonic-clonic seizure",
+                    "HP:0000729 | Autistic behavior; HP:0001263 | Global developmental delay; HP:0000639 | Nystagmus"],
+                   index=["a", "b", "c", "d", "e"])
+
+# pyhpo's HPOSet needs the ontology to already be loaded
+HPOFunc.preload()
+
+def test_cohort_similarity():
+    sets = [HPOSet.from_queries(HPOFunc.split_hpo_codes(cell)) if pd.notna(cell) else HPOSet([]) for cell in column]
+    for method in ["resnik", "lin"]:
+        similarity = HPOSimilarity.HPOSimilarity.from_annotations("omim", method=method)
+        for combine in ["funSimAvg", "BMA"]:
+            # Test case 1: Same as pyhpo's HPOSet.similarity for every pair, whatever the block size
+            expect = np.array([[set1.similarity(set2, kind="omim", method=method, combine=combine) for set2 in sets] for set1 in sets])
+            for block_size in [2, 256]:
+                output = similarity.cohort_similarity(column, combine=combine, block_size=block_size)
+                assert np.allclose(output, expect, atol=1e-5), method + " " + combine + " Expected: " + str(expect) + " Got: " + str(output)
+
+    # Test case 2: The patient with nothing is 0 to everyone, and it's symmetrical
+    output2 = HPOSimilarity.HPOSimilarity.from_annotations().cohort_similarity_frame(column)
+    assert (output2.loc["c"] == 0).all(), "Expected all 0 Got: " + str(output2.loc["c"])
+    assert np.array_equal(output2.values, output2.values.T), "Expected a symmetrical matrix Got: " + str(output2)
+    assert list(output2.index) == list(column.index), "Expected: " + str(list(column.index)) + " Got: " + str(list(output2.index))
+
+    # Test case 3: Propagated matrices aren't what it needs
+    try:
+        similarity.cohort_similarity(HPOMatrix.build_term_matrix(column, propagate=True))
+        raise AssertionError("Expected a ValueError for a propagated matrix")
+    except ValueError:
+        pass
+
+print("Testing cohort_similarity")
+test_cohort_similarity()
+
+def test_from_cohort():
+    matrix = HPOMatrix.build_term_matrix(column)
+    similarity = HPOSimilarity.HPOSimilarity.from_cohort(matrix)
+
+    # Test case 1: Everyone with terms has the root term, so it carries no information
+    root = similarity.closure.columns([1])[0]
+    assert similarity.information_content[root] == 0, "Expected: 0 Got: " + str(similarity.information_content[root])
+
+    # Test case 2: Only one of the 4 patients with terms has HP:0002069
+    seizure = similarity.closure.columns([2069])[0]
+    expect2 = -np.log(1 / 4)
+    assert np.isclose(similarity.information_content[seizure], expect2), "Expected: " + str(expect2) + " Got: " + str(similarity.information_content[seizure])
+
+    # Test case 3: Term similarity of a term with itself is its own IC
+    output3 = similarity.term_similarity([2069])[0, 0]
+    assert np.isclose(output3, expect2), "Expected: " + str(expect2) + " Got: " + str(output3)
+
+print("Testing from_cohort")
+test_from_cohort()
@@ -0,0 +1,81 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import pandas as pd
+import HPOFunc
+import HPOSnapshot
+
+ontology = HPOFunc.get_ontology()
+snapshot = HPOSnapshot.HPOSnapshot.build()
+
+def test_HPOSnapshot():
+    with tempfile.TemporaryDirectory() as folder:
+        snapshot.save(folder)
+        loaded = HPOSnapshot.HPOSnapshot.load(folder, mmap=False)
+    assert len(loaded) == len(ontology), "Expected: " + str(len(ontology)) + " Got: " + str(len(loaded))
+    assert loaded.version == HPOFunc.ontology_version(), "Expected: " + HPOFunc.ontology_version() + " Got: " + loaded.version
+
+    # Test case 1: Same answers as pyhpo's get_hpo_object, including the ones it can't find
+    queries = ["Seizure", "Seizures", "Epileptic seizure", "HP:0001250", "HP:1250", 1250, "seizure", "0001250",
+               "HP:1234567", "Pizza", "Autism", "Nail-biting", "Bipolar affective disorder", "Global developmental delay", 1]
+    for query in queries:
+        try:
+            expect = str(ontology.get_hpo_object(query))
+        except RuntimeError:
+            expect = "RuntimeError"
+        try:
+            output = str(loaded.get_hpo_object(query))
+        except RuntimeError:
+            output = "RuntimeError"
+        assert output == expect, "Expected: " + expect + " Got: " + output + " for " + str(query)
+
+    # Test case 2: Parents, ancestors and depth
+    term = loaded[1250]
+    output2 = sorted(str(parent) for parent in term.parents)
+    expect2 = sorted(str(parent) for parent in ontology[1250].parents)
+    assert output2 == expect2, "Expected: " + str(expect2) + " Got: " + str(output2)
+    output3 = sorted(int(ancestor) for ancestor in term.all_parents)
+    expect3 = sorted(int(ancestor) for ancestor in ontology[1250].all_parents)
+    assert output3 == expect3, "Expected: " + str(expect3) + " Got: " + str(output3)
+    assert sorted(loaded.ancestor_ids(1250).tolist()) == expect3, "Expected: " + str(expect3) + " Got: " + str(loaded.ancestor_ids(1250))
+    assert (loaded[1].depth, term.depth) == (0, 4), "Expected: (0, 4) Got: " + str((loaded[1].depth, term.depth))
+
+def test_use_ontology():
+    cells = pd.Series(["Nail-biting, Bipolar affective disorder", "HP:0007302, Pizza", "0012170", "Seizures", pd.NA, "none"])
+    expect_terms, expect_problems = HPOFunc.process_series(cells)
+    expect_scores = HPOFunc.score_cohort(pd.DataFrame({"Doctor": expect_terms, "Parent": expect_terms[::-1].values}), "Doctor", "Parent")
+
+    with tempfile.TemporaryDirectory() as folder:
+        snapshot.save(folder)
+
+        # Test case 1: Everything comes out the same with the snapshot
+        HPOFunc.use_ontology(HPOSnapshot.HPOSnapshot.load(folder))
+        try:
+            output_terms, output_problems = HPOFunc.process_series(cells)
+            assert output_terms.equals(expect_terms), "Expected: " + str(list(expect_terms)) + " Got: " + str(list(output_terms))
+            assert output_problems.equals(expect_problems), "Expected: " + str(list(expect_problems)) + " Got: " + str(list(output_problems))
+            output_scores = HPOFunc.score_cohort(pd.DataFrame({"Doctor": output_terms, "Parent": output_terms[::-1].values}), "Doctor", "Parent")
+            assert output_scores.equals(expect_scores), "Expected: " + str(expect_scores) + " Got: " + str(output_scores)
+        finally:
+            HPOFunc.use_ontology(ontology)
+
+        # Test case 2: A new process with HPO_SNAPSHOT set doesn't need to load pyhpo's ontology at all
+        code = "import sys, HPOFunc; print(HPOFunc.process_column('Seizures')[0]); print('pyhpo.ontology' in sys.modules)"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                env=dict(os.environ, HPO_SNAPSHOT=folder), cwd=os.path.dirname(os.path.abspath(HPOFunc.__file__))).stdout.split("\n")
+        assert output[:2] == ["HP:0001250 | Seizure", "False"], "Expected: ['HP:0001250 | Seizure', 'False'] Got: " + str(output)
+
+        # Test case 3: A snapshot from a different release than pyhpo's is refused rather than quietly used
+        with open(os.path.join(folder, "snapshot.json"), "w") as f:
+            json.dump({"version": "hp/releases/1999-01-01", "terms": len(snapshot)}, f)
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                env=dict(os.environ, HPO_SNAPSHOT=folder), cwd=os.path.dirname(os.path.abspath(HPOFunc.__file__)))
+        assert result.returncode != 0 and "hp/releases/1999-01-01" in result.stderr, "Expected a RuntimeError Got: " + result.stdout + result.stderr
+
+print("Testing HPOSnapshot")
+test_HPOSnapshot()
+
+print("Testing use_ontology")
+test_use_ontology()
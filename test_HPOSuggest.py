@@ -0,0 +1,71 @@
+import os
+import tempfile
+import pandas as pd
+import HPOFunc
+import HPOPipeline
+import HPOSuggest
+
+print("Building term suggester")
+suggester = HPOSuggest.HPOTermSuggester.build()
+
+def test_HPOTermSuggester():
+    # Test case 1: Misspellings and near misses get the term they meant first
+    queries = ["Globel developmental delay", "seizurs", "speach delay", "Autsm"]
+    expect1 = ["HP:0001263 | Global developmental delay", "HP:0001250 | Seizure",
+               "HP:0000750 | Delayed speech and language development", "HP:0000717 | Autism"]
+    output1 = [str(row[0][0]) for row in suggester.suggest(queries, k=3)]
+    assert output1 == expect1, "Expected: " + str(expect1) + " Got: " + str(output1)
+
+    # Test case 2: Up to k suggestions, best first, and an exact name or synonym scores 1
+    output2 = suggester.suggest_ids(["Hypotonia", "low muscle tone"], k=3)
+    for row in output2:
+        assert len(row) == 3, "Expected 3 suggestions Got: " + str(row)
+        assert row[0] == (1252, 1.0), "Expected: (1252, 1.0) Got: " + str(row[0])
+        assert [score for _, score in row] == sorted([score for _, score in row], reverse=True), "Expected best first Got: " + str(row)
+
+    # Test case 3: Nothing for things that aren't like any term, in batches or not
+    output3 = suggester.suggest_ids(["Pizza", "", "seizurs!"], batch_size=1)
+    assert output3[:2] == [[], []], "Expected: [[], []] Got: " + str(output3[:2])
+    assert output3[2] == suggester.suggest_ids(["Seizurs"])[0], "Expected punctuation and case not to matter Got: " + str(output3[2])
+
+    # Test case 4: As a dataframe
+    output4 = suggester.suggest_frame(["seizurs", "Pizza"], k=2)
+    assert list(output4["Query"]) == ["seizurs", "seizurs", "Pizza"], "Expected: ['seizurs', 'seizurs', 'Pizza'] Got: " + str(list(output4["Query"]))
+    assert list(output4["Rank"]) == [1, 2, 0], "Expected: [1, 2, 0] Got: " + str(list(output4["Rank"]))
+
+def test_HPOTermSuggester_save():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "suggester.pkl")
+        suggester.save(path)
+        loaded = HPOSuggest.HPOTermSuggester.load_or_build(path)
+        assert len(loaded) == len(suggester), "Expected: " + str(len(suggester)) + " Got: " + str(len(loaded))
+        assert loaded.suggest_ids(["seizurs"]) == suggester.suggest_ids(["seizurs"]), "Expected the same suggestions after loading"
+
+def test_problem_report_suggestions():
+    report = HPOPipeline.ProblemReport()
+    report.add_series(pd.Series(["Error: Seizurs; Error: Pizza", "Error: seizurs"]), "Doctor_Problems")
+    output = report.ranked(suggester=suggester, k=1)
+    expect = ["HP:0001250 | Seizure (0.72)", ""]
+    assert list(output["Suggestions"]) == expect, "Expected: " + str(expect) + " Got: " + str(list(output["Suggestions"]))
+    assert list(output.columns[-2:]) == ["Suggestions", "Fix"], "Expected Suggestions just before Fix Got: " + str(list(output.columns))
+
+    # Test case 2: k and min_score get passed all the way through from problem_report
+    with tempfile.TemporaryDirectory() as folder:
+        processed_path = os.path.join(folder, "processed.csv")
+        report_path = os.path.join(folder, "report.csv")
+        pd.DataFrame({"Doctor_Problems": ["Error: Seizurs; Error: Pizza", "Error: seizurs"]}).to_csv(processed_path, index=False)
+        # (Seizurs has 5 suggestions over 0.3, but only 2 over 0.5)
+        for k, min_score, expect_count in [(1, 0.3, 1), (3, 0.5, 2)]:
+            HPOPipeline.problem_report(processed_path, report_path, suggester=suggester, k=k, min_score=min_score)
+            output2 = pd.read_csv(report_path, keep_default_na=False)["Suggestions"][0].split("; ")
+            expect2 = [HPOPipeline._format_suggestions([suggestion]) for suggestion in suggester.suggest(["Seizurs"], k=k, min_score=min_score)[0]]
+            assert output2 == expect2 and len(output2) == expect_count, "Expected: " + str(expect2) + " Got: " + str(output2)
+
+print("Testing HPOTermSuggester")
+test_HPOTermSuggester()
+
+print("Testing HPOTermSuggester save")
+test_HPOTermSuggester_save()
+
+print("Testing problem_report suggestions")
+test_problem_report_suggestions()
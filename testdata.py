@@ -0,0 +1,15 @@
+"""
+Made up data shared by the tests
+"""
+import os
+import pandas as pd
+
+def make_test_file(folder: str) -> str:
+    # Small made up export, with an ID that would lose its leading zeros if it got read in as a number
+    df = pd.DataFrame({"PatientID": [f"P{i}" for i in range(7)],
+                       "Doctor": ["Nail-biting, Bipolar affective disorder", "", "0012170", "HP:0007302, Pizza",
+                                  "None", "hp:0000717", "Seizure"],
+                       "Parent": ["Autism", "HP:0001250", "", "nil", "Nail-biting", "Pizza", "HP:0000717"]})
+    path = os.path.join(folder, "export.csv")
+    df.to_csv(path, index=False)
+    return path